@@ -0,0 +1,92 @@
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from utils.model_utils.plots import get_surface_sliding
+from train.train_utils import load_device, get_model, get_dataloader
+from inference import load_config, load_model, inputs_to_device
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('per-object latency of the inference mesh extraction')
+    parser.add_argument('--config', type=str, required=True, help='configure file for training or testing.')
+    parser.add_argument('--cpu', action='store_true', help='force cpu, the same as device.use_gpu False.')
+    parser.add_argument('--threads', type=int, default=None, help='torch cpu threads, overrides device.num_threads.')
+    parser.add_argument('--num_objects', type=int, default=5, help='objects of the test split to time.')
+    parser.add_argument('--resolution', type=int, nargs='+', default=[256], help='get_surface_sliding resolutions, multiples of 256 for the dense extractor.')
+    parser.add_argument('--extractor', type=str, default=None, help='sparse or dense, overrides eval.mesh_extractor.')
+    parser.add_argument('--random_init', action='store_true', help='time a randomly initialized model, no weight needed.')
+    return parser.parse_args()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+if __name__=="__main__":
+    args = parse_args()
+    cfg = load_config(args.config)
+    config = cfg.config
+    if args.cpu:
+        config['device']['use_gpu'] = False
+    if args.threads is not None:
+        config['device']['num_threads'] = args.threads
+
+    device = load_device(cfg)
+    infer_loader = get_dataloader(config, mode='test')
+    if args.random_init:
+        model = get_model(config, device=device).float().eval()
+        if config['device'].get('channels_last', False):
+            model = model.to(memory_format=torch.channels_last)
+    else:
+        model = load_model(cfg, device)
+
+    extractor = args.extractor or config['eval'].get('mesh_extractor', 'dense')
+    channels_last = config['device'].get('channels_last', False)
+    inference_mode = config['device'].get('inference_mode', False)
+    cfg.log_string(f'device {device}, {torch.get_num_threads()} threads, inference_mode {inference_mode}, '
+                   f'channels_last {channels_last}, {extractor} extractor, resolution {args.resolution}')
+
+    latency = {'load': [], 'encode': []}
+    latency.update({f'extract_{resolution}': [] for resolution in args.resolution})
+    start = time.perf_counter()
+    for batch_id, (indices, model_input, ground_truth) in enumerate(infer_loader):
+        if batch_id >= args.num_objects:
+            break
+        model_input = inputs_to_device(model_input, device, channels_last)
+        synchronize(device)
+        latency['load'].append(time.perf_counter() - start)
+
+        with torch.inference_mode(inference_mode):
+            start = time.perf_counter()
+            model.encoder(model_input['image'])
+            synchronize(device)
+            latency['encode'].append(time.perf_counter() - start)
+
+            # get_surface_sliding runs the encoder again, extract is the whole per-object mesh extraction
+            for resolution in args.resolution:
+                start = time.perf_counter()
+                get_surface_sliding(
+                    path="", epoch="",
+                    model=model, img=model_input["image"],
+                    intrinsics=model_input["intrinsics"],
+                    extrinsics=model_input["extrinsics"],
+                    model_input=model_input,
+                    ground_truth=ground_truth,
+                    resolution=resolution,
+                    grid_boundary=ground_truth['bdb_3d'][0],
+                    return_mesh=True,
+                    delta=0.03,
+                    extractor=extractor,
+                )
+                synchronize(device)
+                latency[f'extract_{resolution}'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+
+    for stage, values in latency.items():
+        values = np.array(values[1:] if len(values) > 1 else values) * 1000        # the first object warms up
+        cfg.log_string(f'{stage}: mean {values.mean():.1f} ms, median {np.median(values):.1f} ms per object')
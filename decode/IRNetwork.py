@@ -1,12 +1,110 @@
 import torch
 from torch import nn
+import torch.nn.functional as F
 import numpy as np
 
 from net.embed import get_embedder
+from net.hash_grid import get_hash_grid
 from train.train_utils import repeat_interleave
 
 
-class ImplicitNetwork(nn.Module):
+def linear_weight(lin):
+    """
+    :return weight, bias of an nn.Linear, also with nn.utils.weight_norm (weight = g * v / ||v||)
+    """
+    if hasattr(lin, 'weight_v'):
+        weight_v = lin.weight_v
+        return lin.weight_g * weight_v / weight_v.norm(dim=1, keepdim=True), lin.bias
+    return lin.weight, lin.bias
+
+
+class SDFNetwork(nn.Module):
+    """
+    sdf, feature vectors and gradients of an implicit network whose forward(x, latent_feature, cat_feature)
+    returns [sdf, feature_vectors], latent_feature / cat_feature rows are repeated over consecutive points
+    """
+    def gradient(self, x, latent_feature, cat_feature):
+        x.requires_grad_(True)
+        y = self.forward(x, latent_feature, cat_feature)[:,:1]
+        d_output = torch.ones_like(y, requires_grad=False, device=y.device)
+        gradients = torch.autograd.grad(
+            outputs=y,
+            inputs=x,
+            grad_outputs=d_output,
+            create_graph=True,
+            retain_graph=True,
+            only_inputs=True)[0]
+        return gradients
+
+    def get_outputs(self, x, latent_feature, cat_feature, gradient_mode='graph'):
+        """
+        :params gradient_mode, how the sdf gradients (normals) are computed
+            'graph': autograd with create_graph, the gradients can be backpropagated (training)
+            'autograd': autograd without graph, detached gradients, also under torch.no_grad (not torch.inference_mode);
+                with grad enabled (training) the sdf / feature_vectors keep their graph, only the gradients are detached
+            'finite_difference': central differences, the 6 neighbour points in the same forward pass
+            'none': no gradients, returns None
+        :return sdf [N, 1], feature_vectors [N, feature_vector_size], gradients [N, 3]
+        """
+        if gradient_mode == 'finite_difference':
+            return self.get_outputs_finite_difference(x, latent_feature, cat_feature)
+        if gradient_mode == 'none':
+            output = self.forward(x, latent_feature, cat_feature)
+            return self.clamp_sdf(output[:, :1], x), output[:, 1:], None
+        if gradient_mode not in ['graph', 'autograd']:
+            raise ValueError('gradient_mode must be graph, autograd, finite_difference or none !')
+
+        create_graph = gradient_mode == 'graph'
+        retain_graph = create_graph or torch.is_grad_enabled()            # the losses backpropagate through the sdf
+        with torch.enable_grad():
+            if not retain_graph:
+                x = x.detach()
+            x.requires_grad_(True)                      ###### get gradients
+            output = self.forward(x, latent_feature, cat_feature)
+            sdf = self.clamp_sdf(output[:,:1], x)
+            feature_vectors = output[:, 1:]
+            d_output = torch.ones_like(sdf, requires_grad=False, device=sdf.device)
+            gradients = torch.autograd.grad(
+                outputs=sdf,
+                inputs=x,
+                grad_outputs=d_output,
+                create_graph=create_graph,
+                retain_graph=retain_graph,
+                only_inputs=True)[0]
+
+        if not retain_graph:
+            sdf, feature_vectors = sdf.detach(), feature_vectors.detach()
+        return sdf, feature_vectors, gradients
+
+    def get_outputs_finite_difference(self, x, latent_feature, cat_feature):
+        """
+        every point is followed by its +-eps neighbours along x, y, z, so the features
+        (repeated over consecutive points in forward) stay aligned, 7N points in one forward pass
+        """
+        eps = self.finite_difference_eps
+        offsets = torch.cat([x.new_zeros(1, 3), torch.eye(3, dtype=x.dtype, device=x.device).repeat_interleave(2, dim=0)], 0)
+        offsets[2::2] *= -1                                                 # [0, +x, -x, +y, -y, +z, -z]
+        x_fd = (x.unsqueeze(1) + eps * offsets).reshape(-1, 3)              # [7N, 3]
+
+        output = self.forward(x_fd, latent_feature, cat_feature)
+        sdf = self.clamp_sdf(output[:, :1], x_fd).reshape(-1, 7)
+        gradients = (sdf[:, 1::2] - sdf[:, 2::2]) / (2 * eps)              # [N, 3]
+        feature_vectors = output.reshape(x.shape[0], 7, -1)[:, 0, 1:]
+        return sdf[:, :1], feature_vectors, gradients
+
+    def clamp_sdf(self, sdf, x):
+        ''' Clamping the SDF with the scene bounding sphere, so that all rays are eventually occluded '''
+        if self.sdf_bounding_sphere > 0.0:
+            sphere_sdf = self.sphere_scale * (self.sdf_bounding_sphere - x.norm(2,1, keepdim=True))
+            sdf = torch.minimum(sdf, sphere_sdf)
+        return sdf
+
+    def get_sdf_vals(self, x, latent_feature, cat_feature):
+        sdf = self.forward(x, latent_feature, cat_feature)[:,:1]
+        return self.clamp_sdf(sdf, x)
+
+
+class ImplicitNetwork(SDFNetwork):
     def __init__(
             self,
             config,
@@ -22,6 +120,8 @@ class ImplicitNetwork(nn.Module):
             multires=0,
             sphere_scale=1.0,
             inside_outside=False,
+            factorized=False,
+            finite_difference_eps=1e-3,
     ):
         super().__init__()
 
@@ -49,6 +149,10 @@ class ImplicitNetwork(nn.Module):
         print(multires, dims)
         self.num_layers = len(dims)                             # 9
         self.skip_in = skip_in
+        # evaluate layer 0 and the skip layer by input block, see factorized_forward (same outputs)
+        self.factorized = factorized
+        # central differences step of get_outputs(gradient_mode='finite_difference'), in cube coords
+        self.finite_difference_eps = finite_difference_eps
 
         for l in range(0, self.num_layers - 1):
 
@@ -87,6 +191,9 @@ class ImplicitNetwork(nn.Module):
         if self.embed_fn is not None:
             input = self.embed_fn(input)                                    # [B*N_ray*N_sample, 39]
 
+        if self.factorized:
+            return self.factorized_forward(input, latent_feature, cat_feature)
+
         x = input                                                           # [B*N_ray*N_sample, 39]
 
         num_repeats = x.shape[0] // cat_feature.shape[0]
@@ -118,46 +225,210 @@ class ImplicitNetwork(nn.Module):
 
         return x
 
-    def gradient(self, x, latent_feature, cat_feature):
-        x.requires_grad_(True)
-        y = self.forward(x, latent_feature, cat_feature)[:,:1]
-        d_output = torch.ones_like(y, requires_grad=False, device=y.device)
-        gradients = torch.autograd.grad(
-            outputs=y,
-            inputs=x,
-            grad_outputs=d_output,
-            create_graph=True,
-            retain_graph=True,
-            only_inputs=True)[0]
-        return gradients
+    def factorized_forward(self, input, latent_feature, cat_feature):
+        """
+        forward with layer 0 and the skip layer evaluated by input block,
+        lin(cat([input, cat_feature, latent_feature])) = lin_point(per point blocks) + lin_shared(shared blocks),
+        a block shared by consecutive sample points (e.g. cat_feature, one row per object) is projected once per row
+        and broadcast to its points instead of being repeated
+        """
+        num_points = input.shape[0]                                         # B*N_ray*N_sample
+        point_blocks, shared_blocks = [], []
+        offset = 0
+        for feature in [input, cat_feature, latent_feature]:                # column blocks of the layer 0 input
+            blocks = point_blocks if feature.shape[0] == num_points else shared_blocks
+            blocks.append((feature, offset))
+            offset += feature.shape[1]
+        point_input = torch.cat([feature for feature, _ in point_blocks], dim=1)
+        point_columns = [(o, feature.shape[1]) for feature, o in point_blocks]
+
+        projections = {}
+        for l in [0] + list(self.skip_in):
+            weight, _ = linear_weight(getattr(self, "lin" + str(l)))
+            projections[l] = [F.linear(feature, weight[:, o:o + feature.shape[1]]) for feature, o in shared_blocks]
+
+        return self.blocked_forward(point_input, point_columns, projections)
+
+    def project_features(self, latent_feature, cat_feature):
+        """
+        project the per-ray features with their blocks of layer 0 and the skip layer once,
+        so that the samples of the rays can be evaluated by get_sdf_vals_projected
+        :params latent_feature, [N_rays, latent_size]
+        :params cat_feature, [N_rays, c0]
+        :return {layer: [N_rays, out_dim]}
+        """
+        feature = torch.cat([cat_feature, latent_feature], dim=1)          # the last columns of the layer 0 input
+        projections = {}
+        for l in [0] + list(self.skip_in):
+            weight, _ = linear_weight(getattr(self, "lin" + str(l)))
+            projections[l] = F.linear(feature, weight[:, -feature.shape[1]:])
+        return projections
+
+    def get_sdf_vals_projected(self, x, projections):
+        """
+        get_sdf_vals of the samples of rays whose features are projected by project_features
+        :params x, [N_rays*N_samples, 3], consecutive N_samples points of every ray
+        """
+        input = x
+        if self.embed_fn is not None:
+            input = self.embed_fn(input)
+        output = self.blocked_forward(input, [(0, input.shape[1])], {l: [projection] for l, projection in projections.items()})
+        return self.clamp_sdf(output[:,:1], x)
+
+    def blocked_forward(self, point_input, point_columns, projections):
+        """
+        :params point_input, per point blocks of the layer 0 input, at point_columns [(offset, width)] of it
+        :params projections, {layer: [projection [N_rows, out_dim]]} of the shared blocks, broadcast to N/N_rows consecutive points
+        """
+        x = point_input
+        for l in range(0, self.num_layers - 1):
+            lin = getattr(self, "lin" + str(l))
 
-    def get_outputs(self, x, latent_feature, cat_feature):
-        x.requires_grad_(True)                      ###### get gradients
-        output = self.forward(x, latent_feature, cat_feature)
-        sdf = output[:,:1]
-        ''' Clamping the SDF with the scene bounding sphere, so that all rays are eventually occluded '''
-        if self.sdf_bounding_sphere > 0.0:
-            sphere_sdf = self.sphere_scale * (self.sdf_bounding_sphere - x.norm(2,1, keepdim=True))
-            sdf = torch.minimum(sdf, sphere_sdf)
-        feature_vectors = output[:, 1:]
-        d_output = torch.ones_like(sdf, requires_grad=False, device=sdf.device)
-        gradients = torch.autograd.grad(
-            outputs=sdf,
-            inputs=x,
-            grad_outputs=d_output,
-            create_graph=True,
-            retain_graph=True,
-            only_inputs=True)[0]
+            if l == 0 or l in self.skip_in:
+                weight, bias = linear_weight(lin)
+                point_weight = torch.cat([weight[:, o:o + width] for o, width in point_columns], dim=1)
+                y = F.linear(point_input, point_weight, bias)
+                if l in self.skip_in:
+                    y = y + F.linear(x, weight)                             # lin(x + skip_feature)
+                for projection in projections[l]:
+                    y = (y.view(projection.shape[0], -1, y.shape[1]) + projection.unsqueeze(1)).view(y.shape)
+                x = y
+            else:
+                x = lin(x)
 
-        return sdf, feature_vectors, gradients
+            if l < self.num_layers - 2:
+                x = self.softplus(x)
 
-    def get_sdf_vals(self, x, latent_feature, cat_feature):
-        sdf = self.forward(x, latent_feature, cat_feature)[:,:1]
-        ''' Clamping the SDF with the scene bounding sphere, so that all rays are eventually occluded '''
-        if self.sdf_bounding_sphere > 0.0:
-            sphere_sdf = self.sphere_scale * (self.sdf_bounding_sphere - x.norm(2,1, keepdim=True))
-            sdf = torch.minimum(sdf, sphere_sdf)
-        return sdf
+        return x
+
+
+class ImplicitNetworkGrid(SDFNetwork):
+    """
+    multi-resolution hash grid backbone (model.Grid_MLP), the hash grid feature of the cube coords and
+    the positional encoding feed a small MLP, conditioned on cat_feature / latent_feature like ImplicitNetwork:
+    layer 0 input is [embed(x), grid feature, cat_feature, latent_feature], the shared blocks are projected once per row
+    """
+    def __init__(
+            self,
+            config,
+            feature_vector_size,
+            sdf_bounding_sphere,
+            d_in,
+            d_out,
+            dims,
+            geometric_init=True,
+            bias=1.0,
+            weight_norm=True,
+            multires=0,
+            sphere_scale=1.0,
+            inside_outside=False,
+            divide_factor=1.5,
+            use_grid_feature=True,
+            num_levels=16,
+            level_dim=2,
+            base_size=16,
+            end_size=2048,
+            log2_hashmap_size=19,
+            finite_difference_eps=1e-3,
+    ):
+        super().__init__()
+
+        self.sdf_bounding_sphere = sdf_bounding_sphere
+        self.sphere_scale = sphere_scale
+        self.finite_difference_eps = finite_difference_eps
+
+        # cube coords in [-divide_factor, divide_factor] are covered by the grid
+        self.divide_factor = divide_factor
+        self.use_grid_feature = use_grid_feature           # if False, zero grid feature (only the small MLP)
+        self.encoding, self.grid_feature_dim = get_hash_grid(num_levels, level_dim, base_size, end_size, log2_hashmap_size, bound=divide_factor)
+
+        self.embed_fn = None
+        input_ch = d_in
+        if multires > 0:
+            self.embed_fn, input_ch = get_embedder(multires, input_dims=d_in)
+        self.point_dim = input_ch + self.grid_feature_dim
+
+        cat_dim = 256 * config['model']['latent_feature']['use_global_encoder'] + 9 * config['model']['latent_feature']['use_cls_encoder']
+        dims = [self.point_dim + cat_dim + 256] + dims + [d_out + feature_vector_size]     # + 256(pixel align feature)
+        print('grid', self.grid_feature_dim, dims)
+        self.num_layers = len(dims)
+
+        for l in range(0, self.num_layers - 1):
+            out_dim = dims[l + 1]
+            lin = nn.Linear(dims[l], out_dim)
+
+            if geometric_init:
+                if l == self.num_layers - 2:
+                    if not inside_outside:
+                        torch.nn.init.normal_(lin.weight, mean=np.sqrt(np.pi) / np.sqrt(dims[l]), std=0.0001)
+                        torch.nn.init.constant_(lin.bias, -bias)
+                    else:
+                        torch.nn.init.normal_(lin.weight, mean=-np.sqrt(np.pi) / np.sqrt(dims[l]), std=0.0001)
+                        torch.nn.init.constant_(lin.bias, bias)
+                elif l == 0:
+                    # a sphere of the xyz columns, the grid and the image features start from zero
+                    torch.nn.init.constant_(lin.bias, 0.0)
+                    torch.nn.init.constant_(lin.weight[:, 3:], 0.0)
+                    torch.nn.init.normal_(lin.weight[:, :3], 0.0, np.sqrt(2) / np.sqrt(out_dim))
+                else:
+                    torch.nn.init.constant_(lin.bias, 0.0)
+                    torch.nn.init.normal_(lin.weight, 0.0, np.sqrt(2) / np.sqrt(out_dim))
+
+            if weight_norm:
+                lin = nn.utils.weight_norm(lin)
+
+            setattr(self, "lin" + str(l), lin)
+
+        self.softplus = nn.Softplus(beta=100)
+
+    def point_input(self, x):
+        """
+        :return per point block of the layer 0 input [embed(x), grid feature]
+        """
+        embedded = self.embed_fn(x) if self.embed_fn is not None else x
+        if self.use_grid_feature:
+            grid_feature = self.encoding(x)
+        else:
+            grid_feature = x.new_zeros(x.shape[0], self.grid_feature_dim)
+        return torch.cat([embedded, grid_feature], dim=1)
+
+    def forward(self, input, latent_feature, cat_feature):
+        # cat_feature (one row per object) and latent_feature (one row per ray or point) are projected by their own rows
+        weight, _ = linear_weight(self.lin0)
+        cat_weight = weight[:, self.point_dim:self.point_dim + cat_feature.shape[1]]
+        latent_weight = weight[:, -latent_feature.shape[1]:]
+        return self.projected_forward(input, [F.linear(cat_feature, cat_weight), F.linear(latent_feature, latent_weight)])
+
+    def project_features(self, latent_feature, cat_feature):
+        """
+        the same as ImplicitNetwork.project_features
+        :params latent_feature, [N_rays, latent_size]
+        :params cat_feature, [N_rays, c0]
+        :return {0: [N_rays, out_dim]}
+        """
+        feature = torch.cat([cat_feature, latent_feature], dim=1)          # the last columns of the layer 0 input
+        weight, _ = linear_weight(self.lin0)
+        return {0: F.linear(feature, weight[:, -feature.shape[1]:])}
+
+    def get_sdf_vals_projected(self, x, projections):
+        output = self.projected_forward(x, [projections[0]])
+        return self.clamp_sdf(output[:,:1], x)
+
+    def projected_forward(self, x, projections):
+        """
+        :params projections, [projection [N_rows, out_dim]] of layer 0, broadcast to N/N_rows consecutive points
+        """
+        weight, bias = linear_weight(self.lin0)
+        y = F.linear(self.point_input(x), weight[:, :self.point_dim], bias)
+        for projection in projections:
+            y = (y.view(projection.shape[0], -1, y.shape[1]) + projection.unsqueeze(1)).view(y.shape)
+        x = self.softplus(y)
+
+        for l in range(1, self.num_layers - 1):
+            x = getattr(self, "lin" + str(l))(x)
+            if l < self.num_layers - 2:
+                x = self.softplus(x)
+        return x
 
 
 class RenderingNetwork(nn.Module):
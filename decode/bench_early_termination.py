@@ -0,0 +1,86 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import yaml
+import torch
+
+from net.density import LaplaceDensity
+from decode.IRNetwork import RenderingNetwork
+from decode.early_termination import early_termination_rendering
+from decode.bench_implicit_network import make_network, bench
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('cpu micro-benchmark of the early ray termination rendering')
+    parser.add_argument('--config', type=str, default='train.yaml', help='configure file for training or testing.')
+    parser.add_argument('--num_rays', type=int, default=1024)
+    parser.add_argument('--num_samples', type=int, default=None, help='points per ray, default N_samples + N_samples_extra.')
+    parser.add_argument('--chunk_size', type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument('--threads', type=int, default=None, help='torch cpu threads.')
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+def full_rendering(implicit_network, rendering_network, density, z_vals, points, dirs, latent_feature, cat_feature):
+    """
+    the Net.forward volume rendering of every sample
+    """
+    sdf, feature_vectors, gradients = implicit_network.get_outputs(points, latent_feature, cat_feature, 'autograd')
+    with torch.no_grad():
+        rgb = rendering_network(points, gradients, dirs, feature_vectors, None).reshape(*z_vals.shape, 3)
+        free_energy = torch.cat([z_vals[:, 1:] - z_vals[:, :-1], torch.full_like(z_vals[:, :1], 1e10)], -1) * density(sdf).reshape(z_vals.shape)
+        shifted_free_energy = torch.cat([torch.zeros_like(free_energy[:, :1]), free_energy[:, :-1]], dim=-1)
+        weights = (1 - torch.exp(-free_energy)) * torch.exp(-torch.cumsum(shifted_free_energy, dim=-1))
+    return rgb, weights
+
+
+if __name__=="__main__":
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    num_samples = args.num_samples or config['model']['ray_sampler']['N_samples'] + config['model']['ray_sampler']['N_samples_extra']
+    conf_rendering = config['model']['rendering_network']
+    conf_early_termination = config['model'].get('early_termination', {})
+    threshold = conf_early_termination.get('threshold', 1e-4)
+    weight_threshold = conf_early_termination.get('weight_threshold', 1e-4)
+
+    # rays from a camera at (0, 0, -3) through the geometric init sphere
+    torch.manual_seed(0)
+    implicit_network = make_network(config, factorized=True)
+    rendering_network = RenderingNetwork(
+        feature_vector_size=config['model']['feature_vector_size'],    mode=conf_rendering['mode'],
+        d_in=conf_rendering['d_in'],                                    d_out=conf_rendering['d_out'],
+        dims=conf_rendering['dims'],                                    weight_norm=conf_rendering['weight_norm'],
+        multires_view=conf_rendering['multires_view'],                  per_image_code=False
+    )
+    density = LaplaceDensity({'beta': 0.01}, config['model']['density']['beta_min'])     # a trained, sharp surface
+
+    cam_loc = torch.tensor([0., 0., -3.])
+    ray_dirs = torch.nn.functional.normalize(torch.tensor([0., 0., 1.]) + 0.25 * torch.randn(args.num_rays, 3), dim=-1)
+    near, far = config['model']['ray_sampler']['near'], config['model']['ray_sampler']['far']
+    z_vals = torch.linspace(near, far, steps=num_samples).repeat(args.num_rays, 1)
+    points = (cam_loc + z_vals.unsqueeze(2) * ray_dirs.unsqueeze(1)).reshape(-1, 3)
+    dirs = ray_dirs.unsqueeze(1).expand(-1, num_samples, -1).reshape(-1, 3)
+    latent_feature, cat_feature = torch.randn(args.num_rays, 256), torch.randn(1, 265)
+    ones = torch.ones(args.num_rays, 1)
+
+    rgb, weights = full_rendering(implicit_network, rendering_network, density, z_vals, points, dirs, latent_feature, cat_feature)
+    full_latency = bench(lambda: full_rendering(implicit_network, rendering_network, density, z_vals, points, dirs, latent_feature, cat_feature), args.repeat)
+    print(f'{args.num_rays} rays x {num_samples} samples, full rendering mean {full_latency.mean():.1f} ms')
+
+    for chunk_size in args.chunk_size:
+        def rendering():
+            return early_termination_rendering(
+                implicit_network, rendering_network, density, z_vals, points, points, dirs, latent_feature,
+                cat_feature.expand(args.num_rays, -1), ones, ones, None, chunk_size, threshold, weight_threshold)
+
+        _, _, chunk_rgb, chunk_weights, _, skipped_implicit, skipped_rendering = rendering()
+        latency = bench(rendering, args.repeat)
+        rgb_values, chunk_rgb_values = (weights.unsqueeze(-1) * rgb).sum(1), (chunk_weights.unsqueeze(-1) * chunk_rgb).sum(1)
+        print(f'chunk_size={chunk_size}: mean {latency.mean():.1f} ms, skipped implicit {skipped_implicit:.3f}, '
+              f'skipped rendering {skipped_rendering:.3f}, max |rgb_values diff| {(rgb_values - chunk_rgb_values).abs().max().item():.2e}, '
+              f'max |weights diff| {(weights - chunk_weights).abs().max().item():.2e}')
@@ -0,0 +1,199 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import time
+import yaml
+import numpy as np
+import torch
+
+from decode.IRNetwork import ImplicitNetwork, ImplicitNetworkGrid, RenderingNetwork
+from decode.export import SDFHead, ColorHead, script_head, fold_weight_norm
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('cpu micro-benchmark of the factorized ImplicitNetwork layer 0 / skip layer')
+    parser.add_argument('--config', type=str, default='train.yaml', help='configure file for training or testing.')
+    parser.add_argument('--batch_size', type=int, default=None, help='objects per batch, default data.batch_size.train.')
+    parser.add_argument('--num_pixels', type=int, default=None, help='rays per object, default data.num_pixels.train.')
+    parser.add_argument('--num_samples', type=int, default=None, help='points per ray, default N_samples + N_samples_extra.')
+    parser.add_argument('--threads', type=int, default=None, help='torch cpu threads.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--gradient_modes', action='store_true', help='also time get_outputs of every gradient_mode.')
+    parser.add_argument('--grid', action='store_true', help='also compare the points/sec of the Grid_MLP backbone.')
+    parser.add_argument('--export', action='store_true', help='also compare the points/sec of the folded / TorchScript heads.')
+    return parser.parse_args()
+
+
+def make_network(config, factorized):
+    conf_implicit = config['model']['implicit_network']
+    return ImplicitNetwork(
+        config=config,                                  feature_vector_size=config['model']['feature_vector_size'],
+        sdf_bounding_sphere=0.0,
+        d_in=conf_implicit['d_in'],                     d_out=conf_implicit['d_out'],
+        dims=conf_implicit['dims'],                     geometric_init=conf_implicit['geometric_init'],
+        bias=conf_implicit['bias'],                     skip_in=conf_implicit['skip_in'],
+        weight_norm=conf_implicit['weight_norm'],       multires=conf_implicit['multires'],
+        sphere_scale=conf_implicit['sphere_scale'],     inside_outside=conf_implicit['inside_outside'],
+        factorized=factorized
+    )
+
+
+def make_grid_network(config):
+    conf_implicit = config['model']['implicit_network']
+    conf_grid = conf_implicit['grid']
+    return ImplicitNetworkGrid(
+        config=config,                                  feature_vector_size=config['model']['feature_vector_size'],
+        sdf_bounding_sphere=0.0,
+        d_in=conf_implicit['d_in'],                     d_out=conf_implicit['d_out'],
+        dims=conf_grid['dims'],                         geometric_init=conf_implicit['geometric_init'],
+        bias=conf_implicit['bias'],                     weight_norm=conf_implicit['weight_norm'],
+        multires=conf_implicit['multires'],             sphere_scale=conf_implicit['sphere_scale'],
+        inside_outside=conf_implicit['inside_outside'], divide_factor=conf_implicit['divide_factor'],
+        use_grid_feature=conf_implicit['use_grid_feature'],
+        num_levels=conf_grid['num_levels'],             level_dim=conf_grid['level_dim'],
+        base_size=conf_grid['base_size'],               end_size=conf_grid['end_size'],
+        log2_hashmap_size=conf_grid['log2_hashmap_size'],
+    )
+
+
+def bench(fn, repeat):
+    fn()                                # warm up
+    latency = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latency.append(time.perf_counter() - start)
+    return np.array(latency) * 1000
+
+
+if __name__=="__main__":
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    batch_size = args.batch_size or config['data']['batch_size']['train']
+    num_pixels = args.num_pixels or config['data']['num_pixels']['train']
+    num_samples = args.num_samples or config['model']['ray_sampler']['N_samples'] + config['model']['ray_sampler']['N_samples_extra']
+    num_points = batch_size * num_pixels * num_samples
+    cat_dim = 256 * config['model']['latent_feature']['use_global_encoder'] + 9 * config['model']['latent_feature']['use_cls_encoder']
+
+    torch.manual_seed(0)
+    network = make_network(config, factorized=False)
+    factorized_network = make_network(config, factorized=True)
+    factorized_network.load_state_dict(network.state_dict())
+
+    points = torch.rand(num_points, 3) * 2 - 1
+    latent_feature = torch.randn(num_points, 256)               # pixel-aligned feature of every sample point
+    cat_feature = torch.randn(batch_size, cat_dim)              # global + cls feature of every object
+
+    with torch.no_grad():
+        sdf = network.get_sdf_vals(points, latent_feature, cat_feature)
+        factorized_sdf = factorized_network.get_sdf_vals(points, latent_feature, cat_feature)
+    print(f'{batch_size} objects x {num_pixels} rays x {num_samples} points, max |sdf diff| {(sdf - factorized_sdf).abs().max().item():.2e}')
+
+    for name, net in [('concat', network), ('factorized', factorized_network)]:
+        def get_sdf_vals():
+            with torch.no_grad():
+                net.get_sdf_vals(points, latent_feature, cat_feature)
+
+        def train_step():
+            net.zero_grad()
+            sdf, feature_vectors, gradients = net.get_outputs(points.clone(), latent_feature, cat_feature)
+            (sdf.sum() + feature_vectors.sum() + gradients.sum()).backward()
+
+        eval_latency = bench(get_sdf_vals, args.repeat)
+        train_latency = bench(train_step, args.repeat)
+        print(f'{name}: get_sdf_vals mean {eval_latency.mean():.1f} ms, '
+              f'get_outputs + backward mean {train_latency.mean():.1f} ms')
+
+    if args.grid:
+        # points/sec of the eval sdf queries and the training get_outputs + backward (eikonal / normals graph)
+        grid_network = make_grid_network(config)
+        for name, net in [('mlp', factorized_network), ('grid', grid_network)]:
+            def get_sdf_vals():
+                with torch.no_grad():
+                    net.get_sdf_vals(points, latent_feature, cat_feature)
+
+            def train_step():
+                net.zero_grad()
+                sdf, feature_vectors, gradients = net.get_outputs(points.clone(), latent_feature, cat_feature)
+                (sdf.sum() + feature_vectors.sum() + gradients.sum()).backward()
+
+            eval_latency = bench(get_sdf_vals, args.repeat)
+            train_latency = bench(train_step, args.repeat)
+            num_params = sum(param.numel() for param in net.parameters())
+            print(f'{name} ({num_params / 1e6:.2f}M params): get_sdf_vals {num_points / eval_latency.mean() * 1000:.0f} points/sec, '
+                  f'get_outputs + backward {num_points / train_latency.mean() * 1000:.0f} points/sec')
+
+    if args.export:
+        # inference sdf queries and colors, weight norm / folded / TorchScript (frozen) / optimize_for_inference
+        conf_rendering = config['model']['rendering_network']
+        def make_rendering_network():
+            return RenderingNetwork(
+                feature_vector_size=config['model']['feature_vector_size'],    mode=conf_rendering['mode'],
+                d_in=conf_rendering['d_in'],                                    d_out=conf_rendering['d_out'],
+                dims=conf_rendering['dims'],                                    weight_norm=conf_rendering['weight_norm'],
+                multires_view=conf_rendering['multires_view'],                  per_image_code=False
+            )
+
+        rendering_network, folded_rendering_network = make_rendering_network(), make_rendering_network()
+        folded_rendering_network.load_state_dict(rendering_network.state_dict())
+        folded_network = make_network(config, factorized=True)
+        folded_network.load_state_dict(factorized_network.state_dict())
+        fold_weight_norm(folded_network)
+        fold_weight_norm(folded_rendering_network)
+        heads = [
+            ('weight norm', factorized_network, lambda *inputs: rendering_network(*inputs, None)),
+            ('folded', folded_network, lambda *inputs: folded_rendering_network(*inputs, None)),
+            ('torchscript', script_head(SDFHead(factorized_network)), script_head(ColorHead(rendering_network))),
+            ('torchscript optimized', script_head(SDFHead(factorized_network), True), script_head(ColorHead(rendering_network), True)),
+        ]
+        dirs, normals = torch.nn.functional.normalize(torch.randn(num_points, 3), dim=-1), torch.randn(num_points, 3)
+        with torch.no_grad():
+            sdf, feature_vectors = network(points, latent_feature, cat_feature).split([1, config['model']['feature_vector_size']], dim=1)
+            rgb = rendering_network(points, normals, dirs, feature_vectors, None)
+        for name, sdf_head, color_head in heads:
+            def query_sdf():
+                with torch.no_grad():
+                    return sdf_head(points, latent_feature, cat_feature)
+
+            def query_color():
+                with torch.no_grad():
+                    return color_head(points, normals, dirs, feature_vectors)
+
+            sdf_latency, color_latency = bench(query_sdf, args.repeat), bench(query_color, args.repeat)
+            print(f'{name}: sdf {num_points / sdf_latency.mean() * 1000:.0f} points/sec (max |diff| {(query_sdf()[:, :1] - sdf).abs().max().item():.1e}), '
+                  f'color {num_points / color_latency.mean() * 1000:.0f} points/sec (max |diff| {(query_color() - rgb).abs().max().item():.1e})')
+
+    if args.gradient_modes:
+        # eval forward / mesh colouring, the gradients of every mode against autograd
+        with torch.no_grad():
+            _, _, autograd_gradients = factorized_network.get_outputs(points, latent_feature, cat_feature, 'autograd')
+        for gradient_mode in ['graph', 'autograd', 'finite_difference', 'none']:
+            def get_outputs():
+                if gradient_mode == 'graph':
+                    return factorized_network.get_outputs(points.clone(), latent_feature, cat_feature, gradient_mode)
+                with torch.no_grad():
+                    return factorized_network.get_outputs(points, latent_feature, cat_feature, gradient_mode)
+
+            _, _, gradients = get_outputs()
+            latency = bench(get_outputs, args.repeat)
+            diff = f', max |gradients diff| {(gradients - autograd_gradients).abs().max().item():.2e}' if gradients is not None else ''
+            print(f'get_outputs {gradient_mode}: mean {latency.mean():.1f} ms{diff}')
+
+        # a training step of every mode has to reach the implicit network parameters
+        for gradient_mode in ['graph', 'autograd', 'finite_difference', 'none']:
+            factorized_network.zero_grad()
+            sdf, feature_vectors, gradients = factorized_network.get_outputs(points.clone(), latent_feature, cat_feature, gradient_mode)
+            loss = sdf.sum() + feature_vectors.sum()
+            if gradients is not None and gradients.requires_grad:
+                loss = loss + gradients.sum()
+            loss.backward()
+            grad_norm = sum(param.grad.abs().sum().item() for param in factorized_network.parameters() if param.grad is not None)
+            if grad_norm == 0:
+                raise RuntimeError(f'get_outputs {gradient_mode}: no gradients on the implicit network in a training step !')
+            print(f'get_outputs {gradient_mode} training step: |grad| of the implicit network {grad_norm:.2e}')
@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+
+
+def early_termination_rendering(implicit_network, rendering_network, density, z_vals, cube_coords, points_obj, dirs_obj,
+                                latent_feature, cat_feature, none_equal_scale, scene_scale, indices,
+                                chunk_size=16, threshold=1e-4, weight_threshold=1e-4, gradient_mode='autograd'):
+    """
+    volume rendering of Net.forward in front-to-back chunks of chunk_size samples, for the novel view rendering (show_rendering):
+    a ray stops once its transmittance is below threshold, so its later samples are not evaluated,
+    and rendering_network only runs on the samples whose weight is above weight_threshold.
+    Not evaluated samples have zero sdf, gradients, rgb and weights, the outputs are detached.
+    :params z_vals, [N_rays, N_samples]
+    :params cube_coords, points_obj, dirs_obj, [N_rays*N_samples, 3]
+    :params latent_feature, [N_rays, latent_size] or [N_rays*N_samples, latent_size]
+    :params cat_feature, [N_rays, c0], one row per ray
+    :params none_equal_scale, scene_scale, [N_rays, 1], cube sdf to volume rendering sdf
+    :params gradient_mode, of implicit_network.get_outputs, gradients is None with 'none'
+    :return sdf [N_rays, N_samples], gradients [N_rays, N_samples, 3], rgb [N_rays, N_samples, 3],
+            weights [N_rays, N_samples], ray_mask [N_rays], skipped fraction of the implicit and rendering evaluations
+    """
+    num_rays, num_samples = z_vals.shape
+    cube_coords, points_obj, dirs_obj = [t.reshape(num_rays, num_samples, 3) for t in [cube_coords, points_obj, dirs_obj]]
+    per_point_latent = latent_feature.shape[0] == num_rays * num_samples
+    if per_point_latent:
+        latent_feature = latent_feature.reshape(num_rays, num_samples, -1)
+
+    dists = z_vals[:, 1:] - z_vals[:, :-1]
+    dists = torch.cat([dists, torch.full_like(dists[:, :1], 1e10)], -1)
+
+    sdf = torch.zeros_like(z_vals)
+    weights = torch.zeros_like(z_vals)
+    gradients = z_vals.new_zeros(num_rays, num_samples, 3) if gradient_mode != 'none' else None
+    rgb = z_vals.new_zeros(num_rays, num_samples, 3)
+    free_energy_sum = z_vals.new_zeros(num_rays)            # -log transmittance in front of the chunk
+    last_transmittance = z_vals.new_zeros(num_rays)         # transmittance in front of the last sample, 0 for stopped rays
+    max_free_energy = -float(np.log(threshold)) if threshold > 0 else float('inf')
+    num_implicit, num_rendering = 0, 0
+
+    for start in range(0, num_samples, chunk_size):
+        end = min(start + chunk_size, num_samples)
+        rays = torch.nonzero(free_energy_sum < max_free_energy).squeeze(1)         # transmittance > threshold
+        if rays.shape[0] == 0:
+            break
+
+        if per_point_latent:
+            chunk_latent = latent_feature[rays, start:end].reshape(-1, latent_feature.shape[-1])
+        else:
+            chunk_latent = latent_feature[rays]
+        chunk_sdf, chunk_features, chunk_gradients = implicit_network.get_outputs(
+            cube_coords[rays, start:end].reshape(-1, 3), chunk_latent, cat_feature[rays], gradient_mode)
+        num_implicit += chunk_sdf.shape[0]
+        chunk_sdf = chunk_sdf.detach().reshape(rays.shape[0], -1)
+        if gradients is not None:
+            chunk_gradients = chunk_gradients.detach().reshape(rays.shape[0], -1, 3)
+            gradients[rays, start:end] = chunk_gradients
+        chunk_features = chunk_features.detach().reshape(rays.shape[0], end - start, -1)
+
+        with torch.no_grad():
+            # LOG SPACE, the same as Net.volume_rendering with the free energy of the previous chunks in front
+            scale_sdf = chunk_sdf / none_equal_scale[rays] * scene_scale[rays]
+            free_energy = dists[rays, start:end] * density(scale_sdf.reshape(-1, 1)).reshape(scale_sdf.shape)
+            shifted_free_energy = free_energy_sum[rays].unsqueeze(-1) + torch.cumsum(free_energy, dim=-1) - free_energy
+            transmittance = torch.exp(-shifted_free_energy)
+            chunk_weights = (1 - torch.exp(-free_energy)) * transmittance
+
+            visible = chunk_weights > weight_threshold
+            num_visible = int(visible.sum())
+            if num_visible > 0:
+                chunk_rgb = rgb.new_zeros(rays.shape[0], end - start, 3)
+                chunk_normals = chunk_gradients[visible] if gradients is not None else None
+                chunk_rgb[visible] = rendering_network(points_obj[rays, start:end][visible], chunk_normals,
+                                                       dirs_obj[rays, start:end][visible], chunk_features[visible], indices)
+                rgb[rays, start:end] = chunk_rgb
+            num_rendering += num_visible
+
+        sdf[rays, start:end] = chunk_sdf
+        weights[rays, start:end] = chunk_weights
+        free_energy_sum[rays] += free_energy.sum(-1)
+        if end == num_samples:
+            last_transmittance[rays] = transmittance[:, -1]
+
+    ray_mask = 1 - last_transmittance
+    total = num_rays * num_samples
+    return sdf, gradients, rgb, weights, ray_mask, 1 - num_implicit / total, 1 - num_rendering / total
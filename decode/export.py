@@ -0,0 +1,209 @@
+import os
+import json
+from typing import List, Optional
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from .IRNetwork import SDFNetwork, ImplicitNetworkGrid
+
+""" Inference preparation of the implicit / rendering networks: weight norm folding and TorchScript export. """
+
+SDF_HEAD = 'sdf_head.pt'
+COLOR_HEAD = 'color_head.pt'
+
+
+def fold_weight_norm(module):
+    """
+    fold nn.utils.weight_norm of every linear of module into its plain weight (g * v / ||v||)
+    and remove the hooks, in place. The outputs stay the same, the forward skips the weight recomputation
+    """
+    for m in module.modules():
+        if hasattr(m, 'weight_g'):
+            nn.utils.remove_weight_norm(m)
+    return module
+
+
+def plain_linear(lin):
+    """
+    :return a copy of lin as a plain nn.Linear (weight norm folded)
+    """
+    weight = lin.weight_g * lin.weight_v / lin.weight_v.norm(dim=1, keepdim=True) if hasattr(lin, 'weight_g') else lin.weight
+    plain = nn.Linear(lin.in_features, lin.out_features)
+    plain.weight.data.copy_(weight.detach())
+    plain.bias.data.copy_(lin.bias.detach())
+    return plain
+
+
+class ScriptEmbedder(nn.Module):
+    """
+    TorchScript version of net.embed.Embedder (get_embedder, sin and cos), inputs [N, d], the same cpu / cuda paths
+    """
+    def __init__(self, embedder):
+        super().__init__()
+        self.register_buffer('freq_bands', embedder.freq_bands.detach().clone())
+        self.include_input: bool = embedder.kwargs['include_input']
+        self.freqs: List[float] = embedder.freq_bands[:, 0].tolist()
+
+    def forward(self, inputs):
+        if not inputs.is_cuda:
+            embedded: List[torch.Tensor] = [inputs] if self.include_input else []
+            for freq in self.freqs:
+                embedded.append(torch.sin(inputs * freq))
+                embedded.append(torch.cos(inputs * freq))
+            return torch.cat(embedded, dim=-1)
+        x = inputs.unsqueeze(-2) * self.freq_bands
+        embedded = torch.stack([torch.sin(x), torch.cos(x)], dim=-2).reshape(inputs.shape[0], -1)
+        if self.include_input:
+            embedded = torch.cat([inputs, embedded], dim=-1)
+        return embedded
+
+
+def broadcast_add(y, projection):
+    """
+    add projection [N_rows, C] to y [N, C], every row to N/N_rows consecutive points
+    """
+    return (y.view(projection.shape[0], -1, y.shape[1]) + projection.unsqueeze(1)).view(y.shape)
+
+
+class SDFHead(nn.Module):
+    """
+    scriptable ImplicitNetwork / ImplicitNetworkGrid forward with plain (folded) weights,
+    layer 0 and the skip layer evaluated by input block as ImplicitNetwork.factorized_forward
+    """
+    skip_in: List[int]
+
+    def __init__(self, network):
+        super().__init__()
+        self.embed = ScriptEmbedder(network.embed_fn) if network.embed_fn is not None else nn.Identity()
+        self.point_dim: int = network.embed_fn.out_dim if network.embed_fn is not None else 3
+        self.encoding = nn.Identity()
+        self.use_grid: bool = isinstance(network, ImplicitNetworkGrid) and network.use_grid_feature
+        self.grid_feature_dim: int = 0
+        if isinstance(network, ImplicitNetworkGrid):
+            self.encoding = network.encoding
+            self.grid_feature_dim = network.grid_feature_dim
+            self.point_dim = network.point_dim
+        self.skip_in = list(getattr(network, 'skip_in', []))             # ImplicitNetworkGrid has no skip
+        self.layers = nn.ModuleList([plain_linear(getattr(network, "lin" + str(l))) for l in range(network.num_layers - 1)])
+
+    def forward(self, x, latent_feature, cat_feature):
+        point = self.embed(x)
+        if self.grid_feature_dim > 0:
+            grid_feature = self.encoding(x) if self.use_grid else x.new_zeros(x.shape[0], self.grid_feature_dim)
+            point = torch.cat([point, grid_feature], dim=1)
+
+        h = point
+        num_layers = len(self.layers)
+        for l, layer in enumerate(self.layers):
+            if l == 0 or l in self.skip_in:
+                weight = layer.weight
+                y = F.linear(point, weight[:, :self.point_dim], layer.bias)
+                if l != 0:
+                    y = y + F.linear(h, weight)                                 # lin(h + skip_feature)
+                y = broadcast_add(y, F.linear(cat_feature, weight[:, self.point_dim:self.point_dim + cat_feature.shape[1]]))
+                y = broadcast_add(y, F.linear(latent_feature, weight[:, weight.shape[1] - latent_feature.shape[1]:]))
+                h = y
+            else:
+                h = layer(h)
+
+            if l < num_layers - 1:
+                h = F.softplus(h, beta=100.)
+        return h
+
+
+class ColorHead(nn.Module):
+    """
+    scriptable RenderingNetwork forward with plain (folded) weights, no per_image_code
+    """
+    def __init__(self, network):
+        super().__init__()
+        if network.per_image_code:
+            raise ValueError('per_image_code rendering network can not be exported !')
+        self.embedview = ScriptEmbedder(network.embedview_fn) if network.embedview_fn is not None else nn.Identity()
+        self.idr: bool = network.mode == 'idr'
+        self.layers = nn.ModuleList([plain_linear(getattr(network, "lin" + str(l))) for l in range(network.num_layers - 1)])
+
+    def forward(self, points, normals: Optional[torch.Tensor], view_dirs, feature_vectors):
+        view_dirs = self.embedview(view_dirs)
+        if self.idr:
+            assert normals is not None
+            x = torch.cat([points, view_dirs, normals, feature_vectors], dim=-1)
+        else:
+            x = torch.cat([view_dirs, feature_vectors], dim=-1)
+
+        num_layers = len(self.layers)
+        for l, layer in enumerate(self.layers):
+            x = layer(x)
+            if l < num_layers - 1:
+                x = F.relu(x)
+        return torch.sigmoid(x)
+
+
+class ExportedImplicitNetwork(SDFNetwork):
+    """
+    ImplicitNetwork interface (forward, get_sdf_vals, get_outputs, gradient) of an exported sdf head
+    """
+    def __init__(self, head, sdf_bounding_sphere, sphere_scale, finite_difference_eps):
+        super().__init__()
+        self.head = head
+        self.sdf_bounding_sphere = sdf_bounding_sphere
+        self.sphere_scale = sphere_scale
+        self.finite_difference_eps = finite_difference_eps
+
+    def forward(self, input, latent_feature, cat_feature):
+        return self.head(input, latent_feature, cat_feature)
+
+
+class ExportedRenderingNetwork(nn.Module):
+    """
+    RenderingNetwork interface of an exported color head
+    """
+    def __init__(self, head):
+        super().__init__()
+        self.head = head
+
+    def forward(self, points, normals, view_dirs, feature_vectors, indices):
+        return self.head(points, normals, view_dirs, feature_vectors)
+
+
+def script_head(head, optimize=False):
+    """
+    TorchScript, frozen (weights as constants) in eval mode,
+    optimize runs torch.jit.optimize_for_inference (fuses linear / activation where the backend supports it, no autograd)
+    """
+    scripted = torch.jit.freeze(torch.jit.script(head.eval()))
+    if optimize:
+        scripted = torch.jit.optimize_for_inference(scripted)
+    return scripted
+
+
+def export_heads(model, path, optimize=False):
+    """
+    save the sdf head (model.implicit_network) and the color head (model.rendering_network) of a Net
+    as TorchScript artifacts in path, the sdf clamp parameters are stored in the extra files
+    """
+    os.makedirs(path, exist_ok=True)
+    implicit_network = model.implicit_network
+    meta = {
+        'sdf_bounding_sphere': implicit_network.sdf_bounding_sphere,
+        'sphere_scale': implicit_network.sphere_scale,
+        'finite_difference_eps': implicit_network.finite_difference_eps,
+        'optimize': optimize,
+    }
+    torch.jit.save(script_head(SDFHead(implicit_network), optimize), os.path.join(path, SDF_HEAD),
+                   _extra_files={'meta.json': json.dumps(meta)})
+    torch.jit.save(script_head(ColorHead(model.rendering_network), optimize), os.path.join(path, COLOR_HEAD))
+
+
+def load_exported_heads(model, path, device):
+    """
+    replace model.implicit_network / model.rendering_network by the exported heads of export_heads, in place
+    """
+    extra_files = {'meta.json': ''}
+    sdf_head = torch.jit.load(os.path.join(path, SDF_HEAD), map_location=device, _extra_files=extra_files)
+    meta = json.loads(extra_files['meta.json'])
+    model.implicit_network = ExportedImplicitNetwork(sdf_head, meta['sdf_bounding_sphere'], meta['sphere_scale'], meta['finite_difference_eps'])
+    model.rendering_network = ExportedRenderingNetwork(torch.jit.load(os.path.join(path, COLOR_HEAD), map_location=device))
+    return meta
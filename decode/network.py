@@ -5,13 +5,15 @@ from torch import nn
 import torch.nn.functional as F
 import numpy as np
 import trimesh
+from transformers import AutoModel
 
 from net.resnet import resnet18_small_stride
 from encode.encoder import make_encoder
-from .IRNetwork import ImplicitNetwork, RenderingNetwork
+from .IRNetwork import ImplicitNetwork, ImplicitNetworkGrid, RenderingNetwork
+from .early_termination import early_termination_rendering
 from net.density import LaplaceDensity
 from net.sample import ErrorBoundSampler, UniformSampler
-from utils.model_utils import render_utils, sdf_utils
+from utils.model_utils import render_utils as rend_util, sdf_utils as sdf_util
 from train.train_utils import repeat_interleave
 from encode.attention import Attention_RoI_Module
 
@@ -71,7 +73,9 @@ class Net(torch.nn.Module):                                                 # mo
         else:
             self.fusion_scene = False
 
-        self.bg_color = torch.tensor(conf['model']['bg_color']).float().cuda()
+        self.register_buffer('bg_color', torch.tensor(conf['model']['bg_color']).float(), persistent=False)
+        # constant last section of the volume rendering dists, follows the module device
+        self.register_buffer('last_dist', torch.full((1, 1), 1e10), persistent=False)
 
         self.encoder = make_encoder(conf['model']['latent_feature']['encoder'])
         self.use_encoder = conf['model']['latent_feature']['use_encoder']           # whether use image features
@@ -86,7 +90,7 @@ class Net(torch.nn.Module):                                                 # mo
 
         if self.use_global_encoder:
             # object bdb2d global image feature
-            self.global_encoder = GlobalEncoder().cuda()
+            self.global_encoder = GlobalEncoder()
 
         self.use_cls_encoder = conf['model']['latent_feature']['use_cls_encoder']
         self.use_depthStream = self.config['model']['latent_feature']['encoder']['use_depthStream']  
@@ -104,15 +108,35 @@ class Net(torch.nn.Module):                                                 # mo
             self.post_op=Attention_RoI_Module(img_feat_channel=256, global_dim=256+9)
 
         conf_implicit = conf['model']['implicit_network']
-        self.implicit_network = ImplicitNetwork(
-            config=conf,                                    feature_vector_size=self.feature_vector_size,                   
-            sdf_bounding_sphere=0.0 if self.white_bkgd else self.scene_bounding_sphere, 
-            d_in=conf_implicit['d_in'],                     d_out=conf_implicit['d_out'],
-            dims=conf_implicit['dims'],                     geometric_init=conf_implicit['geometric_init'],
-            bias=conf_implicit['bias'],                     skip_in=conf_implicit['skip_in'],
-            weight_norm=conf_implicit['weight_norm'],       multires=conf_implicit['multires'],
-            sphere_scale=conf_implicit['sphere_scale'],     inside_outside=conf_implicit['inside_outside']
-        )
+        if conf['model']['Grid_MLP']:
+            # hash grid + small MLP backbone
+            conf_grid = conf_implicit['grid']
+            self.implicit_network = ImplicitNetworkGrid(
+                config=conf,                                    feature_vector_size=self.feature_vector_size,
+                sdf_bounding_sphere=0.0 if self.white_bkgd else self.scene_bounding_sphere,
+                d_in=conf_implicit['d_in'],                     d_out=conf_implicit['d_out'],
+                dims=conf_grid['dims'],                         geometric_init=conf_implicit['geometric_init'],
+                bias=conf_implicit['bias'],                     weight_norm=conf_implicit['weight_norm'],
+                multires=conf_implicit['multires'],             sphere_scale=conf_implicit['sphere_scale'],
+                inside_outside=conf_implicit['inside_outside'], divide_factor=conf_implicit['divide_factor'],
+                use_grid_feature=conf_implicit['use_grid_feature'],
+                num_levels=conf_grid['num_levels'],             level_dim=conf_grid['level_dim'],
+                base_size=conf_grid['base_size'],               end_size=conf_grid['end_size'],
+                log2_hashmap_size=conf_grid['log2_hashmap_size'],
+                finite_difference_eps=conf_implicit.get('finite_difference_eps', 1e-3)
+            )
+        else:
+            self.implicit_network = ImplicitNetwork(
+                config=conf,                                    feature_vector_size=self.feature_vector_size,                   
+                sdf_bounding_sphere=0.0 if self.white_bkgd else self.scene_bounding_sphere, 
+                d_in=conf_implicit['d_in'],                     d_out=conf_implicit['d_out'],
+                dims=conf_implicit['dims'],                     geometric_init=conf_implicit['geometric_init'],
+                bias=conf_implicit['bias'],                     skip_in=conf_implicit['skip_in'],
+                weight_norm=conf_implicit['weight_norm'],       multires=conf_implicit['multires'],
+                sphere_scale=conf_implicit['sphere_scale'],     inside_outside=conf_implicit['inside_outside'],
+                factorized=conf_implicit.get('factorized', False),
+                finite_difference_eps=conf_implicit.get('finite_difference_eps', 1e-3)
+            )
 
         conf_rendering = conf['model']['rendering_network']
         self.rendering_network = RenderingNetwork(
@@ -122,7 +146,32 @@ class Net(torch.nn.Module):                                                 # mo
             multires_view=conf_rendering['multires_view'],  per_image_code=conf_rendering['per_image_code']
         )                                                
 
+        # sdf gradients mode of get_outputs in training / eval forward and the mesh color, auto picks the cheapest
+        # one: a graph only for the losses backpropagated through the normals, no gradients when nothing uses them
+        # (in training 'autograd' detaches only the gradients, the sdf and features keep their graph)
+        use_normal = conf['data']['use_normal']
+        normal_loss = use_normal and (conf['loss']['normal_l1_weight'] > 0 or conf['loss']['normal_cos_weight'] > 0 or conf['loss']['use_curriculum_normal'])
+        rendering_normal = conf_rendering['mode'] == 'idr'                         # nerf mode doesn't use the normals
+        gradient_mode = conf_implicit.get('gradient_mode', 'auto')
+        if gradient_mode == 'auto':
+            self.train_gradient_mode = 'graph' if normal_loss or rendering_normal else ('autograd' if use_normal else 'none')
+            self.eval_gradient_mode = 'autograd' if use_normal or rendering_normal else 'none'
+            self.mesh_gradient_mode = 'autograd' if rendering_normal else 'none'
+        elif gradient_mode == 'none' and (use_normal or rendering_normal):
+            raise ValueError('gradient_mode none, but data.use_normal or idr rendering network needs the normals !')
+        else:
+            self.train_gradient_mode = self.eval_gradient_mode = self.mesh_gradient_mode = gradient_mode
+
         self.density = LaplaceDensity(conf['model']['density']['params_init'], conf['model']['density']['beta_min'])
+
+        # novel view rendering in front-to-back chunks, stop the rays whose transmittance is below threshold
+        conf_early_termination = conf['model'].get('early_termination', {})
+        self.early_termination = conf_early_termination.get('enabled', False)
+        self.early_termination_params = {
+            'chunk_size': conf_early_termination.get('chunk_size', 16),
+            'threshold': conf_early_termination.get('threshold', 1e-4),
+            'weight_threshold': conf_early_termination.get('weight_threshold', 1e-4),
+        }
         
         self.sampling_method = conf['model']['sampling_method']
         conf_ray_sampler = conf['model']['ray_sampler']
@@ -139,7 +188,8 @@ class Net(torch.nn.Module):                                                 # mo
                 N_samples_extra=conf_ray_sampler['N_samples_extra'],    eps=conf_ray_sampler['eps'],
                 beta_iters=conf_ray_sampler['beta_iters'],              max_total_iters=conf_ray_sampler['max_total_iters'],
                 take_sphere_intersection=self.take_sphere_intersection, far=conf_ray_sampler['far'], 
-                encoder=self.encoder,
+                encoder=self.encoder,                                   incremental=conf_ray_sampler.get('incremental', False),
+                beta_search_k=conf_ray_sampler.get('beta_search_k', 2),
             )
         elif self.sampling_method == "uniform":
             self.ray_sampler = UniformSampler(
@@ -165,23 +215,26 @@ class Net(torch.nn.Module):                                                 # mo
                 nn.Sigmoid()
             )
 
-    def get_feature(self, input, uv, z_vals_pnts):
+    def get_feature_context(self, input):
+        """
+        object level features of get_feature, computed once per (image, object) after self.encoder(image):
+        cat_feature (bdb2d ROI GlobalEncoder feature + cls feature), roi_feat and the depth mixed latent of the encoder,
+        get_feature with the context only indexes the pixel-aligned features (e.g. every point chunk of the mesh extraction)
+        """
         image = input["image"]                              # [B, 3, H, W]
-        self.image_shape = torch.empty(2).cuda()
-        self.image_shape[0] = image.shape[-1]               # W
-        self.image_shape[1] = image.shape[-2]               # H
+        self.image_shape = torch.tensor([image.shape[-1], image.shape[-2]], dtype=torch.float32, device=image.device)      # [W, H]
 
         cat_feature = None
 
         if self.use_global_encoder:
-            bdb_grid = input["bdb_grid"].cuda().to(torch.float32)                                               # [B, 64, 64, 2]
+            bdb_grid = input["bdb_grid"].to(image.device, torch.float32)                                               # [B, 64, 64, 2]
             bdb_roi_feature = F.grid_sample(self.encoder.latent, bdb_grid, align_corners=True, mode='bilinear')     # [B, latent_size, 64, 64]
             global_latent = self.global_encoder(bdb_roi_feature)                        # [B, 256]
 
             cat_feature = global_latent
 
         if self.use_cls_encoder:
-            cls_encoder = input['cls_encoder'].cuda().to(torch.float32)             # [B, 9]
+            cls_encoder = input['cls_encoder'].to(image.device, torch.float32)             # [B, 9]
             
             if cat_feature is None:
                 cat_feature = cls_encoder
@@ -195,12 +248,24 @@ class Net(torch.nn.Module):                                                 # mo
             ret_dict=self.post_op(self.encoder.latent, cat_feature, bdb_grid)
             roi_feat=ret_dict["roi_feat"]
 
+        if self.use_encoder and self.use_depthStream and self.encoder.use_diffu_prior:
+            # depth_prior.shape = torch.Size([12, 484, 648])
+            self.encoder.mix_depth_prior(input['depth_prior'], image_index=input.get('image_index', None))
+
+        return {'image_shape': self.image_shape, 'cat_feature': cat_feature, 'roi_feat': roi_feat}
+
+    def get_feature(self, input, uv, z_vals_pnts, context=None):
+        """
+        :params context, get_feature_context of the same input and encoder latent, None computes it
+        """
+        if context is None:
+            context = self.get_feature_context(input)
+        cat_feature = context['cat_feature']
+
         if self.use_encoder:
-            if self.use_depthStream:
-                depth_prior = input['depth_prior']  # depth_prior.shape = torch.Size([12, 484, 648])
             latent = self.encoder.index(
-                uv, None, self.image_shape, depth_prior, roi_feat=roi_feat
-            )  # (B, latent_size, N_ray)
+                uv, None, context['image_shape'], roi_feat=context['roi_feat']
+            )  # (B, latent_size, N_ray), the depth mixed latent of get_feature_context
             if self.stop_encoder_grad:
                 latent = latent.detach()
             latent = latent.transpose(1, 2).reshape(
@@ -211,7 +276,13 @@ class Net(torch.nn.Module):                                                 # mo
         return latent_feature, cat_feature
 
 
-    def forward(self, input, indices, new_pose=None, mesh=None, mesh_coords='canonical'):
+    def forward(self, input, indices, new_pose=None, mesh=None, mesh_coords='canonical', mesh_writer=None):
+        """
+        :params mesh, predict the vertex colors of the mesh: in the mesh_coords frame (canonical, camera, world),
+                      :return the color and none color trimesh, or streamed by mesh_writer (ColorMeshWriter of
+                      utils/model_utils/mesh_writer.py, chunk by chunk) and :return the written paths; the seams of the
+                      extraction crops are welded first (in place), as the trimesh process of the trimesh outputs does
+        """
 
         intrinsics = input["intrinsics"]
         image = input["image"]                              # [B, 3, H, W]
@@ -225,15 +296,18 @@ class Net(torch.nn.Module):                                                 # mo
         # if get mesh, predict every point color for colormesh
         if mesh != None:
             batch_size = image.shape[0]
+            if mesh_writer is not None:
+                mesh.merge_vertices()           # duplicate vertices of the crop / block seams
+                mesh_writer.open(mesh.vertices.shape[0], mesh.faces.shape[0])
             verts = mesh.vertices
             faces = mesh.faces
-            normals = mesh.face_normals
-            verts = torch.from_numpy(verts).cuda().to(torch.float32)
+            verts = torch.from_numpy(verts).to(image.device, torch.float32)
+
+            # the object features once for all the vertex chunks
+            context = self.get_feature_context(input)
 
             verts_rgb = []
-            pnts_obj_list = []
-            pnts_world_list = []
-            pnts_camera_list = []
+            pnts_frame_list = []                # only the mesh_coords frame
 
             for _, pnts in enumerate(torch.split(verts, 100000, dim=0)):
                 # get obj points
@@ -242,72 +316,65 @@ class Net(torch.nn.Module):                                                 # mo
                 scene_obj = scene_obj[None, None, ...]                                                                      # [1, 1, N, 3]
                 world_coords = sdf_util.obj2world(scene_obj, input['obj_rot'], input['obj_tran'])                        # [1, 1, N, 3]
 
-                pnts_camera = rend_util.world_to_camera(world_coords.reshape(-1, 3), extrinsics)                          # [1, 3, N]
-                pnts_camera_list.append(pnts_camera.permute(0, 2, 1).reshape(-1, 3).detach().cpu().numpy())
-                pnts_world_list.append(world_coords.reshape(-1, 3).detach().cpu().numpy())
+                if mesh_coords == 'canonical':
+                    pnts_frame = scene_obj.reshape(-1, 3)                                                                   # in obj coordinate
+                elif mesh_coords == 'camera':
+                    pnts_camera = rend_util.world_to_camera(world_coords.reshape(-1, 3), extrinsics)                      # [1, 3, N]
+                    pnts_frame = pnts_camera.permute(0, 2, 1).reshape(-1, 3)
+                else:
+                    pnts_frame = world_coords.reshape(-1, 3)                                                                # in world coordinate
 
-                latent_feature, cat_feature = rend_util.get_latent_feature(self, world_coords.reshape(-1, 3), intrinsics, extrinsics, input)
+                latent_feature, cat_feature = rend_util.get_latent_feature(self, world_coords.reshape(-1, 3), intrinsics, extrinsics, input, context)
 
                 # get obj dirs
-                cam_loc_incam = torch.tensor([0, 0, 0]).cuda().float()
+                cam_loc_incam = torch.zeros(3, device=pnts.device)
                 cam_loc_temp = cam_loc_incam[None, None, None, :]                                                   # [1, 1, 1, 3]
                 cam_loc_obj = sdf_util.camera2obj(cam_loc_temp, input['pose'], input['world_to_obj'])               # [1, 1, 1, 3]
                 cam_loc_obj = cam_loc_obj.squeeze(0).squeeze(0)                 # [1, 3]
                 ray_dirs_obj = scene_obj.reshape(-1, 3) - cam_loc_obj           # [N, 3]
                 ray_dirs_obj = F.normalize(ray_dirs_obj, dim=1)                 # [N, 3]
 
-                sdf, feature_vectors, gradients = self.implicit_network.get_outputs(pnts.reshape(-1, 3), latent_feature, cat_feature)
+                sdf, feature_vectors, gradients = self.implicit_network.get_outputs(pnts.reshape(-1, 3), latent_feature, cat_feature, self.mesh_gradient_mode)
                 
                 # color use scene obj
                 rgb_flat = self.rendering_network(scene_obj.reshape(-1, 3), gradients, ray_dirs_obj, feature_vectors, indices=None)
 
-                verts_rgb.append(rgb_flat.detach().cpu().numpy())
-                pnts_obj_list.append(scene_obj.reshape(-1, 3).detach().cpu().numpy())
+                if mesh_writer is not None:
+                    mesh_writer.write_vertices(pnts_frame, rgb_flat)            # both files from the one vertex chunk
+                else:
+                    verts_rgb.append(rgb_flat.detach().cpu().numpy())
+                    pnts_frame_list.append(pnts_frame.detach().cpu().numpy())
 
-            verts = verts.detach().cpu().numpy()
+            if mesh_writer is not None:
+                return mesh_writer.close(faces)
 
             vertex_colors = np.concatenate(verts_rgb, axis=0)
-            verts_obj = np.concatenate(pnts_obj_list, axis=0)
-            verts_world = np.concatenate(pnts_world_list, axis=0)
-            verts_camera = np.concatenate(pnts_camera_list, axis=0)
-
-            if mesh_coords == 'canonical':
-                # in obj coordinate
-                meshcolor = trimesh.Trimesh(verts_obj, faces, normals, vertex_colors=vertex_colors)
-                meshnonecolor = trimesh.Trimesh(verts_obj, faces, normals)
-            
-            elif mesh_coords == 'camera':
-                # in camera coordinate
-                meshcolor = trimesh.Trimesh(verts_camera, faces, normals, vertex_colors=vertex_colors)
-                meshnonecolor = trimesh.Trimesh(verts_camera, faces, normals)
+            verts_frame = np.concatenate(pnts_frame_list, axis=0)
+            normals = mesh.face_normals
 
-            else:
-                # in world coordinate
-                meshcolor = trimesh.Trimesh(verts_world, faces, normals, vertex_colors=vertex_colors)
-                meshnonecolor = trimesh.Trimesh(verts_world, faces, normals)
+            meshcolor = trimesh.Trimesh(verts_frame, faces, normals, vertex_colors=vertex_colors)
+            meshnonecolor = trimesh.Trimesh(verts_frame, faces, normals)
 
             return meshcolor, meshnonecolor
 
         batch_size, num_pixels, _ = uv.shape
 
-        self.image_shape = torch.empty(2).cuda()
-        self.image_shape[0] = image.shape[-1]               # W
-        self.image_shape[1] = image.shape[-2]               # H
+        self.image_shape = torch.tensor([image.shape[-1], image.shape[-2]], dtype=torch.float32, device=image.device)      # [W, H]
 
         cat_feature = None
         
         # encoder the image
-        self.encoder(image)           # [B, latent_size, H', W']
+        self.encoder(image, image_index=input.get('image_index', None))           # [B, latent_size, H', W'], image-grouped batch encodes unique images once
 
         if self.use_global_encoder:
-            bdb_grid = input["bdb_grid"].cuda().to(torch.float32)                                               # [B, 64, 64]
+            bdb_grid = input["bdb_grid"].to(image.device, torch.float32)                                               # [B, 64, 64]
             bdb_roi_feature = F.grid_sample(self.encoder.latent, bdb_grid, align_corners=True, mode='bilinear')     # [B, latent_size, 64, 64]
             global_latent = self.global_encoder(bdb_roi_feature)                        # [B, 256]
 
             cat_feature = global_latent
 
         if self.use_cls_encoder:
-            cls_encoder = input['cls_encoder'].cuda().to(torch.float32)             # [B, 9]
+            cls_encoder = input['cls_encoder'].to(image.device, torch.float32)             # [B, 9]
             
             if cat_feature is None:
                 cat_feature = cls_encoder
@@ -328,10 +395,11 @@ class Net(torch.nn.Module):                                                 # mo
                 pred_mask = self.mask_decoder(bdb_roi_feature)                                                  # [B, 1, 64, 64]
 
         if self.use_encoder:
+            depth_prior = None
             if self.use_depthStream:
                 depth_prior = input['depth_prior']  # depth_prior.shape = torch.Size([12, 484, 648])
             latent = self.encoder.index(
-                uv, None, self.image_shape, depth_prior, roi_feat=roi_feat
+                uv, None, self.image_shape, depth_prior, roi_feat=roi_feat, image_index=input.get('image_index', None)
             )  # (B, latent_size, N_ray)
             if self.stop_encoder_grad:
                 latent = latent.detach()
@@ -394,30 +462,45 @@ class Net(torch.nn.Module):                                                 # mo
         # ray in obj coords
         # NOTE: though points input implicit network is object coords normalize (object points - centroid)
         #       but translation don't impact ray direction
-        dirs_obj = ray_dirs_obj.unsqueeze(1).repeat(1,N_samples,1)          # obj coords
+        dirs_obj = ray_dirs_obj.unsqueeze(1).expand(-1, N_samples, -1)      # obj coords
         dirs_obj_flat = dirs_obj.reshape(-1, 3)                             # (B*N_uv*N_pts_per_ray, 3)
 
         ###### points_obj is the obj coordinate, gradients in obj coords too
         # transfer to cube coords
         cube_coords = sdf_util.scene_obj2cube_coords(points_obj, input['scene_scale'], input['centroid'], input['none_equal_scale'])    # (B*N_uv*N_pts_per_ray, 3)
-        sdf, feature_vectors, gradients = self.implicit_network.get_outputs(cube_coords, latent_feature, cat_feature)
-
-        ###### indices just is __getitem__ index
-        # use canonical coords also
-        rgb_flat = self.rendering_network(points_obj, gradients, dirs_obj_flat, feature_vectors, indices)
-        rgb = rgb_flat.reshape(-1, N_samples, 3)
 
         # cube sdf scale to volume rendering sdf
         mean_none_equal_scale = torch.mean(input['none_equal_scale'], dim=1, keepdim=True).unsqueeze(-1)
         mean_scene_scale = torch.mean(input['scene_scale'], dim=1, keepdim=True).unsqueeze(-1)
-        scale_sdf = sdf.reshape(batch_size, -1, 1) / mean_none_equal_scale * mean_scene_scale
 
-        if self.fusion_scene:
-            # fusion one image
-            weights, sort_idx, z_vals, ray_mask = self.fusion_volume_rendering(z_vals, sdf, batch_size)
-            rgb = self.cat_rgb(rgb, sort_idx, batch_size, num_pixels)
+        # the validation losses need the sdf of every sample, early termination only for the novel view rendering
+        early_termination = self.early_termination and self.show_rendering and not self.training and not self.fusion_scene
+        gradient_mode = self.train_gradient_mode if self.training else self.eval_gradient_mode
+        if early_termination:
+            # the samples behind the surface are skipped, their sdf, gradients and rgb are zero
+            sdf, gradients, rgb, weights, ray_mask, skipped_implicit, skipped_rendering = early_termination_rendering(
+                self.implicit_network, self.rendering_network, self.density, z_vals, cube_coords, points_obj, dirs_obj_flat,
+                latent_feature, repeat_interleave(cat_feature, num_pixels),
+                repeat_interleave(mean_none_equal_scale.reshape(-1, 1), num_pixels),
+                repeat_interleave(mean_scene_scale.reshape(-1, 1), num_pixels),
+                indices, gradient_mode=gradient_mode, **self.early_termination_params
+            )
         else:
-            weights, ray_mask = self.volume_rendering(z_vals, scale_sdf.reshape(-1, 1))
+            sdf, feature_vectors, gradients = self.implicit_network.get_outputs(cube_coords, latent_feature, cat_feature, gradient_mode)
+
+            ###### indices just is __getitem__ index
+            # use canonical coords also
+            rgb_flat = self.rendering_network(points_obj, gradients, dirs_obj_flat, feature_vectors, indices)
+            rgb = rgb_flat.reshape(-1, N_samples, 3)
+
+            scale_sdf = sdf.reshape(batch_size, -1, 1) / mean_none_equal_scale * mean_scene_scale
+
+            if self.fusion_scene:
+                # fusion one image
+                weights, sort_idx, z_vals, ray_mask = self.fusion_volume_rendering(z_vals, sdf, batch_size)
+                rgb = self.cat_rgb(rgb, sort_idx, batch_size, num_pixels)
+            else:
+                weights, ray_mask = self.volume_rendering(z_vals, scale_sdf.reshape(-1, 1))
         rgb_values = torch.sum(weights.unsqueeze(-1) * rgb, 1)
 
         depth_values = torch.sum(weights * z_vals, 1, keepdims=True) / (weights.sum(dim=1, keepdims=True) +1e-8)        # pixel depth values
@@ -451,6 +534,17 @@ class Net(torch.nn.Module):                                                 # mo
 
         if self.use_depthStream:
             output['depth_weight'] = self.encoder.depth_weight
+
+        if self.sampling_method == 'errorbounded' and self.ray_sampler.incremental:
+            # rays evaluated in every round of the error bounded sampler, [max_total_iters]
+            active_rays = torch.zeros(self.ray_sampler.max_total_iters, dtype=torch.long, device=z_vals.device)
+            active_rays[:len(self.ray_sampler.active_rays)] = torch.tensor(self.ray_sampler.active_rays, dtype=torch.long)
+            output['sampler_active_rays'] = active_rays
+
+        if early_termination:
+            # fraction of the implicit / rendering network evaluations skipped by the early ray termination
+            output['skipped_implicit'] = skipped_implicit
+            output['skipped_rendering'] = skipped_rendering
             
         if self.use_instance_mask:
             output['pred_mask'] = pred_mask
@@ -478,32 +572,34 @@ class Net(torch.nn.Module):                                                 # mo
             output['grad_theta'] = grad_theta[:grad_theta.shape[0]//2]
             output['grad_theta_nei'] = grad_theta[grad_theta.shape[0]//2:]
         
-        # gradient from obj coords to camera coords, gradient [N, 3]
-        gradients = gradients.reshape(batch_size, -1, 3)                    # [B, N_uv*N_pts_per_ray, 3]
-        rot1 = obj_rot
-        if new_pose != None:
-            new_extrinsics = torch.linalg.inv(new_pose)
-            rot2 = new_extrinsics[:, :3, :3]
-        else:
-            rot2 = extrinsics[:, :3, :3]
-        gradients_world = torch.bmm(rot1, gradients.permute(0, 2, 1))       # [B, 3, N_uv*N_pts_per_ray]
-        gradients_cam = torch.bmm(rot2, gradients_world)                    # [B, 3, N_uv*N_pts_per_ray]
-        gradients_cam = gradients_cam.permute(0, 2, 1).contiguous()         # [B, N_uv*N_pts_per_ray, 3]
-        
-        # compute normal map, camera coords
-        normals = gradients_cam / (gradients_cam.norm(2, -1, keepdim=True) + 1e-6)
-        normals = normals.reshape(-1, N_samples, 3)
+        # no normal map without the sdf gradients, see gradient_mode
+        if gradients is not None:
+            # gradient from obj coords to camera coords, gradient [N, 3]
+            gradients = gradients.reshape(batch_size, -1, 3)                    # [B, N_uv*N_pts_per_ray, 3]
+            rot1 = obj_rot
+            if new_pose != None:
+                new_extrinsics = torch.linalg.inv(new_pose)
+                rot2 = new_extrinsics[:, :3, :3]
+            else:
+                rot2 = extrinsics[:, :3, :3]
+            gradients_world = torch.bmm(rot1, gradients.permute(0, 2, 1))       # [B, 3, N_uv*N_pts_per_ray]
+            gradients_cam = torch.bmm(rot2, gradients_world)                    # [B, 3, N_uv*N_pts_per_ray]
+            gradients_cam = gradients_cam.permute(0, 2, 1).contiguous()         # [B, N_uv*N_pts_per_ray, 3]
 
-        if self.fusion_scene:
-            # fusion one image
-            normals = self.cat_rgb(normals, sort_idx, batch_size, num_pixels)
+            # compute normal map, camera coords
+            normals = gradients_cam / (gradients_cam.norm(2, -1, keepdim=True) + 1e-6)
+            normals = normals.reshape(-1, N_samples, 3)
+
+            if self.fusion_scene:
+                # fusion one image
+                normals = self.cat_rgb(normals, sort_idx, batch_size, num_pixels)
 
-        normal_map = torch.sum(weights.unsqueeze(-1) * normals, 1)
+            normal_map = torch.sum(weights.unsqueeze(-1) * normals, 1)
 
-        output['normal_map'] = normal_map
+            output['normal_map'] = normal_map
 
         if self.add_bdb3d_points:
-            add_points_world = input["add_points_world"].cuda().to(torch.float32)        # [B, N_uv, N_add, 3]
+            add_points_world = input["add_points_world"].to(image.device, torch.float32)    # [B, N_uv, N_add, 3]
             add_latent_feature, add_cat_feature = rend_util.get_latent_feature(self, add_points_world, intrinsics, extrinsics, input)
 
             # get obj coords
@@ -523,11 +619,11 @@ class Net(torch.nn.Module):                                                 # mo
         density = density_flat.reshape(-1, z_vals.shape[1])  # (batch_size * num_pixels) x N_samples
 
         dists = z_vals[:, 1:] - z_vals[:, :-1]
-        dists = torch.cat([dists, torch.tensor([1e10]).cuda().unsqueeze(0).repeat(dists.shape[0], 1)], -1)
+        dists = torch.cat([dists, self.last_dist.to(dists.dtype).expand(dists.shape[0], 1)], -1)
 
         # LOG SPACE
         free_energy = dists * density
-        shifted_free_energy = torch.cat([torch.zeros(dists.shape[0], 1).cuda(), free_energy[:, :-1]], dim=-1)  # shift one step
+        shifted_free_energy = torch.cat([torch.zeros_like(free_energy[:, :1]), free_energy[:, :-1]], dim=-1)  # shift one step
         alpha = 1 - torch.exp(-free_energy)  # probability of it is not empty here
         transmittance = torch.exp(-torch.cumsum(shifted_free_energy, dim=-1))  # probability of everything is empty up to now
 
@@ -555,11 +651,11 @@ class Net(torch.nn.Module):                                                 # mo
         cat_density = torch.gather(cat_density, 1, sort_idx)
 
         dists = cat_z_vals[:, 1:] - cat_z_vals[:, :-1]
-        dists = torch.cat([dists, torch.tensor([1e10]).cuda().unsqueeze(0).repeat(dists.shape[0], 1)], -1)
+        dists = torch.cat([dists, self.last_dist.to(dists.dtype).expand(dists.shape[0], 1)], -1)
 
         # LOG SPACE
         free_energy = dists * cat_density
-        shifted_free_energy = torch.cat([torch.zeros(dists.shape[0], 1).cuda(), free_energy[:, :-1]], dim=-1)  # shift one step
+        shifted_free_energy = torch.cat([torch.zeros_like(free_energy[:, :1]), free_energy[:, :-1]], dim=-1)  # shift one step
         alpha = 1 - torch.exp(-free_energy)  # probability of it is not empty here
         transmittance = torch.exp(-torch.cumsum(shifted_free_energy, dim=-1))  # probability of everything is empty up to now
 
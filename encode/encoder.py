@@ -131,7 +131,7 @@ class SpatialEncoder(nn.Module):
 
         # self.latent (B, L, H, W)
     
-    def index(self, uv, cam_z=None, image_size=(), diffu_prior=None, roi_feat=None, z_bounds=None, offset_xy=None):
+    def index(self, uv, cam_z=None, image_size=(), diffu_prior=None, roi_feat=None, z_bounds=None, offset_xy=None, image_index=None):
         """
         Get pixel-aligned image features at 2D image coordinates
         :param uv (B, N_uv, 2) image points (x,y)
@@ -141,13 +141,12 @@ class SpatialEncoder(nn.Module):
         :param z_bounds ignored (for compatibility)
         :param offset_xy, if use deformable attention, x y offset, [-1, 1]
         :param sample_size, if use deformable attention, get sample_size pixel img feature mean
+        :param image_index, (B,) image-grouped batch, diffu_prior has one row per unique image, image_index is the row of each object
         :return (B, L, N) L is latent size
         """
-        if self.use_diffu_prior:
-            diffu_prior = diffu_prior.cuda().to(torch.float32)
-            self.diffu_latent = self.model_D(diffu_prior)
-            # self.latent_mix = self.diffu_weight * self.diffu_latent + (1-self.diffu_weight) * self.latent
-            self.latent_mix = self.diffu_latent
+        if self.use_diffu_prior and diffu_prior is not None:
+            self.mix_depth_prior(diffu_prior, image_index)
+        # diffu_prior None indexes the latent_mix of the last mix_depth_prior (same image, e.g. Net.get_feature_context)
 
 
         with profiler.record_function("encoder_index"):
@@ -183,10 +182,25 @@ class SpatialEncoder(nn.Module):
 
             return samples[:, :, :, 0]  # (B, C, N)
 
-    def forward(self, x):
+    def mix_depth_prior(self, diffu_prior, image_index=None):
+        """
+        depth stream latent of the depth prior, indexed by index
+        :param diffu_prior, (B, H, W) depth prior
+        :param image_index, (B,) image-grouped batch, diffu_prior has one row per unique image, image_index is the row of each object
+        """
+        diffu_prior = diffu_prior.to(self.latent.device, torch.float32)
+        self.diffu_latent = self.model_D(diffu_prior)
+        if image_index is not None:
+            self.diffu_latent = self.diffu_latent[image_index.to(self.diffu_latent.device)]
+        # self.latent_mix = self.diffu_weight * self.diffu_latent + (1-self.diffu_weight) * self.latent
+        self.latent_mix = self.diffu_latent
+        return self.latent_mix
+
+    def forward(self, x, image_index=None):
         """
         For extracting ResNet's features.
         :param x image (B, C, H, W)
+        :param image_index, (B',) image-grouped batch, x has one row per unique image, latent is gathered to one row per object
         :return latent (B, latent_size, H, W)
         """
         if self.feature_scale != 1.0:
@@ -220,6 +234,8 @@ class SpatialEncoder(nn.Module):
 
         # 使用可训练的权重进行自适应融合
         latent = f2 
+        if image_index is not None:
+            latent = latent[image_index.to(latent.device)]       # encode each unique image once
 
         self.latent = latent
 
@@ -273,10 +289,11 @@ class ImageEncoder(nn.Module):
         """
         return self.latent.unsqueeze(-1).expand(-1, -1, uv.shape[1])
 
-    def forward(self, x):
+    def forward(self, x, image_index=None):
         """
         For extracting ResNet's features.
         :param x image (B, C, H, W)
+        :param image_index, (B',) image-grouped batch, x has one row per unique image, latent is gathered to one row per object
         :return latent (B, latent_size)
         """
         x = x.to(device=self.latent.device)
@@ -295,6 +312,8 @@ class ImageEncoder(nn.Module):
 
         if self.latent_size != 512:
             x = self.fc(x)
+        if image_index is not None:
+            x = x[image_index.to(x.device)]
 
         self.latent = x  # (B, latent_size)
         return self.latent
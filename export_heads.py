@@ -0,0 +1,31 @@
+import os
+import argparse
+
+from train.train_utils import load_device
+from inference import load_config, load_model
+from decode.export import export_heads
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('export the sdf / color heads of a weight as TorchScript for inference')
+    parser.add_argument('--config', type=str, required=True, help='configure file for training or testing.')
+    parser.add_argument('--out', type=str, default=None, help='output directory, default save_root_path/exp_name/heads.')
+    parser.add_argument('--cpu', action='store_true', help='export on cpu, the same as device.use_gpu False.')
+    parser.add_argument('--optimize', action='store_true', help='torch.jit.optimize_for_inference, not with autograd normals.')
+    return parser.parse_args()
+
+
+if __name__=="__main__":
+    args = parse_args()
+    cfg = load_config(args.config)
+    config = cfg.config
+    if args.cpu:
+        config['device']['use_gpu'] = False
+    config['eval']['exported_heads'] = None                 # export from the weight
+
+    device = load_device(cfg)
+    model = load_model(cfg, device)
+    out = args.out or os.path.join(config['save_root_path'], config['exp_name'], 'heads')
+    export_heads(model, out, optimize=args.optimize)
+    cfg.log_string('Exported heads to %s, set eval.exported_heads: %s to use them in inference.' % (out, out))
@@ -7,6 +7,10 @@ import torch
 from utils.model_utils.plots import *
 from utils.config_utils.config_utils import CONFIG
 from train.train_utils import load_device, get_model, get_dataloader, CheckpointIO, load_checkpoint
+from decode.export import fold_weight_norm, load_exported_heads
+from inference_pipeline import run_pipeline, object_done
+from utils.DataProcess.gt_mesh_cache import GTMeshCache, batch_gt_mesh_key
+from utils.model_utils.mesh_writer import ColorMeshWriter, write_mesh
 
 dirname = os.path.dirname(cv2.__file__)
 plugin_path = os.path.join(dirname, 'plugins', 'platforms')
@@ -20,6 +24,64 @@ def parse_args():
     return parser.parse_args()
 
 
+# model inputs moved to the device, float32
+INPUT_KEYS = ['image', 'intrinsics', 'uv', 'pose', 'extrinsics', 'obj_rot', 'obj_tran', 'world_to_obj',
+              'centroid', 'none_equal_scale', 'scene_scale', 'voxel_range']
+
+
+def load_config(config_path):
+    """
+    the test CONFIG of a yaml, with the inference overrides
+    """
+    import yaml
+    with open(config_path, 'r') as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+
+    cfg['model']['ray_sampler']['add_bdb3d_points'] = False          # in inference, not add points
+    if 'ray_noise' not in cfg['model']:
+        cfg['model']['ray_noise'] = False             # old version yaml not set this item
+
+    if cfg['data']['mask_filter'] or cfg['data']['bdb2d_filter']:
+        print('mask_filter and bdb2d_filter must be False in inference')
+        cfg['data']['mask_filter'] = False
+        cfg['data']['bdb2d_filter'] = False
+
+    return CONFIG(cfg, mode='test')
+
+
+def load_model(cfg, device):
+    """
+    the eval model on device with the config weight, convolutions in channels-last if device.channels_last,
+    the implicit / rendering networks are the eval.exported_heads TorchScript heads or with the weight norm folded
+    """
+    config = cfg.config
+    model = get_model(config, device=device).float()
+    if config['device'].get('channels_last', False):
+        model = model.to(memory_format=torch.channels_last)
+
+    cfg.log_string('Loading weight.')
+    ckpt_path = os.path.join(config['save_root_path'], config['exp_name'], config['weight'])
+    load_checkpoint(ckpt_path, model)
+    model.eval()
+
+    exported_heads = config['eval'].get('exported_heads', None)
+    if exported_heads:
+        cfg.log_string('Loading exported heads from %s.' % exported_heads)
+        load_exported_heads(model, exported_heads, device)
+    elif config['eval'].get('fold_weight_norm', False):
+        fold_weight_norm(model.implicit_network)
+        fold_weight_norm(model.rendering_network)
+    return model
+
+
+def inputs_to_device(model_input, device, channels_last=False):
+    for key in INPUT_KEYS:
+        model_input[key] = model_input[key].to(device, torch.float32)      # cpu -> device
+    if channels_last:
+        model_input['image'] = model_input['image'].contiguous(memory_format=torch.channels_last)
+    return model_input
+
+
 def run(cfg):
     torch.set_default_dtype(torch.float32)
     config = cfg.config
@@ -33,19 +95,22 @@ def run(cfg):
     cfg.log_string('Loading device settings.')
     device = load_device(cfg)
 
+    pipeline = config['eval'].get('pipeline', {}).get('enabled', False)
+    if pipeline:
+        # the pipeline model stage only has the batched sparse extraction (get_surface_cells)
+        if config['eval'].get('mesh_extractor', 'dense') != 'sparse':
+            raise ValueError('eval.pipeline.enabled needs eval.mesh_extractor sparse !')
+        # objects evaluated together by the pipeline model stage
+        config['data']['batch_size']['test'] = config['eval']['pipeline']['objects_per_step']
+
     cfg.log_string('Loading dataset.')
     infer_loader = get_dataloader(cfg.config, mode='test')
 
     cfg.log_string('Loading model.')
-    model = get_model(cfg.config, device=device).cuda().float()
+    model = load_model(cfg, device)
     checkpoint.register_modules(net=model)
 
-    cfg.log_string('Loading weight.')
-    ckpt_path = os.path.join(evals_folder_name, config['weight'])
-    load_checkpoint(ckpt_path, model)
-
     cfg.log_string('Inference begin.')
-    model.eval()
 
     extract_mesh = config['eval']['extract_mesh']
 
@@ -67,23 +132,39 @@ def run(cfg):
     else:
         mesh_coords = config['eval']['mesh_coords']
 
+    color_mesh_format = config['eval'].get('color_mesh_format', 'ply')
+    mesh_extractor = config['eval'].get('mesh_extractor', 'dense')
+    mesh_resolution = config['eval'].get('mesh_resolution', 256)
+
+    # label meshes of utils/DataProcess/build_gt_mesh_cache.py, shared by the experiments
+    gt_mesh_cache = None
+    if config['eval'].get('gt_mesh_cache', None):
+        gt_mesh_cache = GTMeshCache(config['eval']['gt_mesh_cache'])
+
+    channels_last = config['device'].get('channels_last', False)
+    # autograd normals of the mesh colouring (idr rendering network) go through the encoder latent of the extraction,
+    # so it can not be an inference tensor
+    autograd_color_mesh = export_color_mesh and model.mesh_gradient_mode in ['graph', 'autograd']
+    inference_mode = config['device'].get('inference_mode', False) and not autograd_color_mesh
+
+    if pipeline and extract_mesh:
+        cfg.log_string('Pipelined inference, sparse extractor, %d objects per step.' % config['eval']['pipeline']['objects_per_step'])
+        run_pipeline(cfg, model, infer_loader, device, evals_output_name, inputs_to_device, inference_mode,
+                     channels_last=channels_last, export_color_mesh=export_color_mesh, mesh_coords=mesh_coords,
+                     resolution=mesh_resolution, gt_mesh_cache=gt_mesh_cache, color_mesh_format=color_mesh_format,
+                     mesh_extractor=mesh_extractor)
+        cfg.log_string('loader: {}'.format(infer_loader.dataset.metrics.report()))
+        if gt_mesh_cache is not None:
+            cfg.log_string(gt_mesh_cache.report())
+        cfg.log_string('Inference finished.')
+        return
+
     for batch_id, (indices, model_input, ground_truth) in enumerate(infer_loader):
         img_id = ground_truth['img_id'][0].split('.')[0].split('/')[-1]
         obj_id = ground_truth['object_id'][0].numpy()
         cname = ground_truth['cname'][0]
         print(img_id)
-        model_input["image"] = model_input["image"].cuda().to(torch.float32)
-        model_input["intrinsics"] = model_input["intrinsics"].cuda().to(torch.float32)      # cpu -> gpu
-        model_input["uv"] = model_input["uv"].cuda().to(torch.float32)                      # [B, N, 2]
-        model_input['pose'] = model_input['pose'].cuda().to(torch.float32)
-        model_input['extrinsics'] = model_input['extrinsics'].cuda().to(torch.float32)
-        model_input['obj_rot'] = model_input['obj_rot'].cuda().to(torch.float32)
-        model_input['obj_tran'] = model_input['obj_tran'].cuda().to(torch.float32)
-        model_input['world_to_obj'] = model_input['world_to_obj'].cuda().to(torch.float32)
-        model_input['centroid'] = model_input['centroid'].cuda().to(torch.float32)
-        model_input['none_equal_scale'] = model_input['none_equal_scale'].cuda().to(torch.float32)
-        model_input['scene_scale'] = model_input['scene_scale'].cuda().to(torch.float32)
-        model_input['voxel_range'] = model_input['voxel_range'].cuda().to(torch.float32)
+        model_input = inputs_to_device(model_input, device, channels_last)
 
         batch_size, num_samples, _ =  model_input["uv"].shape
         total_pixels = min(total_pixels, num_samples)  # if mask filter, although there is not pixel sample, num_samples is less than total pixels
@@ -93,52 +174,64 @@ def run(cfg):
             mesh_folder = os.path.join(evals_output_name, cname, f'{str(img_id)}_{str(obj_id)}')
             os.makedirs(mesh_folder, exist_ok=True)
 
-            if os.path.exists(os.path.join(mesh_folder, f'label_cube.ply')):
+            if object_done(mesh_folder, export_color_mesh, color_mesh_format):
                 msg = 'continue {}/{}'.format(batch_id, total_number)
                 print(msg)
                 continue
 
             # else:
-            mesh = get_surface_sliding(
-                path="", epoch="",
-                model=model, img=model_input["image"],
-                intrinsics=model_input["intrinsics"],
-                extrinsics=model_input["extrinsics"],
-                model_input=model_input,
-                ground_truth=ground_truth,
-                resolution=256,
-                grid_boundary=grid_boundary,
-                return_mesh=True,
-                delta=0.03,
-                export_color_mesh=export_color_mesh,
-            )
-
-            # if render mesh, do not export cube mesh, cube mesh is for evaluation
-            # Beacuse InstPIFu use cube mesh for evaluation
-            if not export_color_mesh:
-                try:
-                    mesh.export(os.path.join(mesh_folder, f'pred_cube.ply'))
-                    cfg.log_string('Pred mesh export successfully!')
-                except:
-                    cfg.log_string(f'{str(img_id)}_{str(obj_id)} pred mesh failed!')
-                    continue
-
-                mesh_gt = get_surface_sliding(
+            with torch.inference_mode(inference_mode):
+                mesh = get_surface_sliding(
                     path="", epoch="",
                     model=model, img=model_input["image"],
                     intrinsics=model_input["intrinsics"],
                     extrinsics=model_input["extrinsics"],
                     model_input=model_input,
                     ground_truth=ground_truth,
-                    resolution=256,
+                    resolution=mesh_resolution,
                     grid_boundary=grid_boundary,
                     return_mesh=True,
                     delta=0.03,
-                    eval_gt=True,
                     export_color_mesh=export_color_mesh,
+                    extractor=mesh_extractor,
                 )
+
+            # if render mesh, do not export cube mesh, cube mesh is for evaluation
+            # Beacuse InstPIFu use cube mesh for evaluation
+            if not export_color_mesh:
                 try:
-                    mesh_gt.export(os.path.join(mesh_folder, f'label_cube.ply'))
+                    write_mesh(mesh, os.path.join(mesh_folder, f'pred_cube.ply'))
+                    cfg.log_string('Pred mesh export successfully!')
+                except:
+                    cfg.log_string(f'{str(img_id)}_{str(obj_id)} pred mesh failed!')
+                    continue
+
+                label_path = os.path.join(mesh_folder, f'label_cube.ply')
+                gt_key, gt_fields = batch_gt_mesh_key(ground_truth, 0, mesh_resolution, mesh_extractor, delta=0.03)
+                if gt_mesh_cache is not None and gt_mesh_cache.get(gt_key, label_path):
+                    cfg.log_string('Label mesh from the gt mesh cache!')
+                    continue
+
+                with torch.inference_mode(inference_mode):
+                    mesh_gt = get_surface_sliding(
+                        path="", epoch="",
+                        model=model, img=model_input["image"],
+                        intrinsics=model_input["intrinsics"],
+                        extrinsics=model_input["extrinsics"],
+                        model_input=model_input,
+                        ground_truth=ground_truth,
+                        resolution=mesh_resolution,
+                        grid_boundary=grid_boundary,
+                        return_mesh=True,
+                        delta=0.03,
+                        eval_gt=True,
+                        export_color_mesh=export_color_mesh,
+                        extractor=mesh_extractor,
+                    )
+                try:
+                    write_mesh(mesh_gt, label_path)
+                    if gt_mesh_cache is not None:
+                        gt_mesh_cache.put(gt_key, gt_fields, label_path)
                     cfg.log_string('Label mesh export successfully!')
                 except:
                     cfg.log_string(f'{str(img_id)}_{str(obj_id)} gt mesh failed!')
@@ -146,33 +239,23 @@ def run(cfg):
 
         # for visualization, export mesh with color and in original size of object
         if export_color_mesh:
-            meshcolor, meshnonecolor = model(model_input, indices, mesh=mesh, mesh_coords=mesh_coords)  # mesh coords: camera, world, canonical(default)
-            meshcolor.export(os.path.join(mesh_folder, f'mesh_color.ply'))              # original size
-            meshnonecolor.export(os.path.join(mesh_folder, f'mesh_none_color.ply'))     # original size
+            # mesh_color / mesh_none_color streamed chunk by chunk, original size
+            with ColorMeshWriter(mesh_folder, color_mesh_format) as mesh_writer:
+                model(model_input, indices, mesh=mesh, mesh_coords=mesh_coords, mesh_writer=mesh_writer)  # mesh coords: camera, world, canonical(default)
             cfg.log_string('mesh export successfully!')
 
         cfg.log_string(f'inference {batch_id}/{total_number}')
 
+    cfg.log_string('loader: {}'.format(infer_loader.dataset.metrics.report()))
+    if gt_mesh_cache is not None:
+        cfg.log_string(gt_mesh_cache.report())
     cfg.log_string('Inference finished.')
 
 
 if __name__=="__main__":
     args=parse_args()
 
-    import yaml
-    with open(args.config, 'r') as f:
-        cfg = yaml.load(f, Loader=yaml.FullLoader)
-
-    cfg['model']['ray_sampler']['add_bdb3d_points'] = False          # in inference, not add points
-    if 'ray_noise' not in cfg['model']:
-        cfg['model']['ray_noise'] = False             # old version yaml not set this item
-
-    if cfg['data']['mask_filter'] or cfg['data']['bdb2d_filter']:
-        print('mask_filter and bdb2d_filter must be False in inference')
-        cfg['data']['mask_filter'] = False
-        cfg['data']['bdb2d_filter'] = False
-
-    cfg=CONFIG(cfg, mode='test')
+    cfg=load_config(args.config)
     cfg.update_config(args.__dict__)
 
     cfg.log_string('Loading configuration')
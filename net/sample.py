@@ -1,8 +1,9 @@
 import abc
+import math
 from tkinter.messagebox import NO
 import torch
 
-from utils.model_utils import render_utils, sdf_utils
+from utils.model_utils import render_utils as rend_util, sdf_utils as sdf_util
 from train.train_utils import repeat_interleave
 
 
@@ -10,6 +11,30 @@ class RaySampler(metaclass=abc.ABCMeta):
     def __init__(self,near, far):
         self.near = near
         self.far = far
+        self.constants = {}             # constant tensors per device and dtype, see get_constant
+
+    def get_constant(self, name, device, dtype, make):
+        """
+        constant tensor made by make() once per (name, device, dtype) and cached, instead of rebuilding it on every call
+        """
+        key = (name, device, dtype)
+        if key not in self.constants:
+            self.constants[key] = make().to(device=device, dtype=dtype)
+        return self.constants[key]
+
+    def get_linspace(self, steps, device, dtype):
+        """
+        :return torch.linspace(0., 1., steps), (steps,)
+        """
+        return self.get_constant(('linspace', steps), device, dtype, lambda: torch.linspace(0., 1., steps=steps))
+
+    def get_near_far(self, num_rays, device, dtype):
+        """
+        :return near and far of every ray, (num_rays, 1) views of cached scalars
+        """
+        near = self.get_constant('near', device, dtype, lambda: torch.full((1, 1), self.near))
+        far = self.get_constant('far', device, dtype, lambda: torch.full((1, 1), self.far))
+        return near.expand(num_rays, 1), far.expand(num_rays, 1)
 
     @abc.abstractmethod
     def get_z_vals(self, ray_dirs, cam_loc, model):
@@ -26,14 +51,13 @@ class UniformSampler(RaySampler):
 
     # dtu and bmvs
     def get_z_vals_dtu_bmvs(self, ray_dirs, cam_loc, model):
-        if not self.take_sphere_intersection:
-            near, far = self.near * torch.ones(ray_dirs.shape[0], 1).cuda(), self.far * torch.ones(ray_dirs.shape[0], 1).cuda()
-        else:
+        device, dtype = ray_dirs.device, ray_dirs.dtype
+        near, far = self.get_near_far(ray_dirs.shape[0], device, dtype)
+        if self.take_sphere_intersection:
             sphere_intersections = rend_util.get_sphere_intersections(cam_loc, ray_dirs, r=self.scene_bounding_sphere)
-            near = self.near * torch.ones(ray_dirs.shape[0], 1).cuda()
             far = sphere_intersections[:,1:]
 
-        t_vals = torch.linspace(0., 1., steps=self.N_samples).cuda()
+        t_vals = self.get_linspace(self.N_samples, device, dtype)
         z_vals = near * (1. - t_vals) + far * (t_vals)
 
         if model.training:
@@ -42,7 +66,7 @@ class UniformSampler(RaySampler):
             upper = torch.cat([mids, z_vals[..., -1:]], -1)
             lower = torch.cat([z_vals[..., :1], mids], -1)
             # stratified samples in those intervals
-            t_rand = torch.rand(z_vals.shape).cuda()
+            t_rand = torch.rand(z_vals.shape, device=device, dtype=dtype)
 
             z_vals = lower + (upper - lower) * t_rand
 
@@ -64,13 +88,12 @@ class UniformSampler(RaySampler):
 
     # currently this is used for replica scannet and T&T
     def get_z_vals(self, ray_dirs, cam_loc, model):
-        if not self.take_sphere_intersection:
-            near, far = self.near * torch.ones(ray_dirs.shape[0], 1).cuda(), self.far * torch.ones(ray_dirs.shape[0], 1).cuda()
-        else:
+        device, dtype = ray_dirs.device, ray_dirs.dtype
+        near, far = self.get_near_far(ray_dirs.shape[0], device, dtype)
+        if self.take_sphere_intersection:
             _, far = self.near_far_from_cube(cam_loc, ray_dirs, bound=self.scene_bounding_sphere)
-            near = self.near * torch.ones(ray_dirs.shape[0], 1).cuda()
         
-        t_vals = torch.linspace(0., 1., steps=self.N_samples).cuda()
+        t_vals = self.get_linspace(self.N_samples, device, dtype)
         z_vals = near * (1. - t_vals) + far * (t_vals)
 
         if model.training:
@@ -79,7 +102,7 @@ class UniformSampler(RaySampler):
             upper = torch.cat([mids, z_vals[..., -1:]], -1)
             lower = torch.cat([z_vals[..., :1], mids], -1)
             # stratified samples in those intervals
-            t_rand = torch.rand(z_vals.shape).cuda()
+            t_rand = torch.rand(z_vals.shape, device=device, dtype=dtype)
 
             z_vals = lower + (upper - lower) * t_rand
 
@@ -89,7 +112,7 @@ class UniformSampler(RaySampler):
 class ErrorBoundSampler(RaySampler):
     def __init__(self, scene_bounding_sphere, near, far, N_samples, N_samples_eval, N_samples_extra,
                  eps, beta_iters, max_total_iters, take_sphere_intersection, encoder,
-                 inverse_sphere_bg=False, N_samples_inverse_sphere=0, add_tiny=1.0e-6):
+                 inverse_sphere_bg=False, N_samples_inverse_sphere=0, add_tiny=1.0e-6, incremental=False, beta_search_k=2):
         #super().__init__(near, 2.0 * scene_bounding_sphere)
         super().__init__(near, 2.0 * scene_bounding_sphere * 1.75 if far == -1 else far)  # default far is 2*R
         
@@ -104,14 +127,25 @@ class ErrorBoundSampler(RaySampler):
 
         self.eps = eps
         self.beta_iters = beta_iters
+        # K-ary beta search, K-1 candidates per ray in every round, rounds reach the resolution of beta_iters bisections
+        self.beta_search_k = beta_search_k
+        self.beta_search_rounds = int(math.ceil(beta_iters * math.log(2) / math.log(beta_search_k) - 1e-6))
         self.max_total_iters = max_total_iters
         self.scene_bounding_sphere = scene_bounding_sphere
         self.add_tiny = add_tiny
+        # 1 / (4 log(1 + eps)) of the beta upper bound (Lemma 2), the float32 value
+        self.bound_scale = float(1.0 / (4.0 * torch.log(torch.tensor(eps + 1.0))))
 
         self.inverse_sphere_bg = inverse_sphere_bg
         if inverse_sphere_bg:
             self.inverse_sphere_sampler = UniformSampler(1.0, 0.0, N_samples_inverse_sphere, False, far=1.0)
 
+        # only keep sampling the rays whose beta has not converged, see get_z_vals_incremental
+        self.incremental = incremental
+        if incremental and inverse_sphere_bg:
+            raise ValueError('incremental error bounded sampling does not support inverse_sphere_bg')
+        self.active_rays = []               # rays evaluated in every round of the last get_z_vals_incremental
+
     def get_z_vals(self, ray_dirs_obj, cam_loc_obj, model, latent_feature, cat_feature, global_latent, uv, image_shape, model_input):
         """
         use more feature and deformable attention, and suitable for 'add' and 'cat' architecture mode
@@ -122,6 +156,9 @@ class ErrorBoundSampler(RaySampler):
         :param uv, sample pixel,                                                            (B, N_uv, 2)
         :param architecture_mode, 'add' or 'cat'
         """
+        if self.incremental:
+            return self.get_z_vals_incremental(ray_dirs_obj, cam_loc_obj, model, latent_feature, cat_feature, uv, model_input)
+
         beta0 = model.density.get_beta().detach()
         batch_size, N_uv, _ = uv.shape
 
@@ -132,7 +169,7 @@ class ErrorBoundSampler(RaySampler):
 
         # Get maximum beta from the upper bound (Lemma 2)
         dists = z_vals[:, 1:] - z_vals[:, :-1]
-        bound = (1.0 / (4.0 * torch.log(torch.tensor(self.eps + 1.0)))) * (dists ** 2.).sum(-1)
+        bound = self.bound_scale * (dists ** 2.).sum(-1)
         beta = torch.sqrt(bound)
 
         total_iters, not_converge = 0, True
@@ -156,40 +193,14 @@ class ErrorBoundSampler(RaySampler):
                 sdf = samples_sdf
 
             # Calculating the bound d* (Theorem 1)
-            d = sdf.reshape(z_vals.shape)
             dists = z_vals[:, 1:] - z_vals[:, :-1]
-            a, b, c = dists, d[:, :-1].abs(), d[:, 1:].abs()
-            first_cond = a.pow(2) + b.pow(2) <= c.pow(2)
-            second_cond = a.pow(2) + c.pow(2) <= b.pow(2)
-            d_star = torch.zeros(z_vals.shape[0], z_vals.shape[1] - 1).cuda()
-            d_star[first_cond] = b[first_cond]
-            d_star[second_cond] = c[second_cond]
-            s = (a + b + c) / 2.0
-            area_before_sqrt = s * (s - a) * (s - b) * (s - c)
-            mask = ~first_cond & ~second_cond & (b + c - a > 0)
-            d_star[mask] = (2.0 * torch.sqrt(area_before_sqrt[mask])) / (a[mask])
-            d_star = (d[:, 1:].sign() * d[:, :-1].sign() == 1) * d_star  # Fixing the sign
+            d_star = self.get_d_star(sdf.reshape(z_vals.shape), dists)
 
             # Updating beta using line search
-            curr_error = self.get_error_bound(beta0, model, sdf, z_vals, dists, d_star)
-            beta[curr_error <= self.eps] = beta0
-            beta_min, beta_max = beta0.unsqueeze(0).repeat(z_vals.shape[0]), beta
-            for j in range(self.beta_iters):
-                beta_mid = (beta_min + beta_max) / 2.
-                curr_error = self.get_error_bound(beta_mid.unsqueeze(-1), model, sdf, z_vals, dists, d_star)
-                beta_max[curr_error <= self.eps] = beta_mid[curr_error <= self.eps]
-                beta_min[curr_error > self.eps] = beta_mid[curr_error > self.eps]
-            beta = beta_max
+            beta = self.line_search_beta(beta0, beta, model, sdf, z_vals, dists, d_star)
 
             # Upsample more points
-            density = model.density(sdf.reshape(z_vals.shape), beta=beta.unsqueeze(-1))
-
-            dists = torch.cat([dists, torch.tensor([1e10]).cuda().unsqueeze(0).repeat(dists.shape[0], 1)], -1)
-            free_energy = dists * density
-            shifted_free_energy = torch.cat([torch.zeros(dists.shape[0], 1).cuda(), free_energy[:, :-1]], dim=-1)
-            alpha = 1 - torch.exp(-free_energy)
-            transmittance = torch.exp(-torch.cumsum(shifted_free_energy, dim=-1))
-            weights = alpha * transmittance  # probability of the ray hits something here
+            dists, transmittance, weights = self.get_weights(model, sdf, z_vals, dists, beta)
 
             #  Check if we are done and this is the last sampling
             total_iters += 1
@@ -199,49 +210,18 @@ class ErrorBoundSampler(RaySampler):
                 ''' Sample more points proportional to the current error bound'''
 
                 N = self.N_samples_eval
-
-                bins = z_vals
-                error_per_section = torch.exp(-d_star / beta.unsqueeze(-1)) * (dists[:,:-1] ** 2.) / (4 * beta.unsqueeze(-1) ** 2)
-                error_integral = torch.cumsum(error_per_section, dim=-1)
-                bound_opacity = (torch.clamp(torch.exp(error_integral),max=1.e6) - 1.0) * transmittance[:,:-1]
-
-                pdf = bound_opacity + self.add_tiny
-                pdf = pdf / torch.sum(pdf, -1, keepdim=True)
-                cdf = torch.cumsum(pdf, -1)
-                cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], -1)
+                cdf = self.get_error_cdf(d_star, beta, dists, transmittance)
 
             else:
                 ''' Sample the final sample set to be used in the volume rendering integral '''
 
                 N = self.N_samples
-
-                bins = z_vals
-                pdf = weights[..., :-1]
-                pdf = pdf + 1e-5  # prevent nans
-                pdf = pdf / torch.sum(pdf, -1, keepdim=True)
-                cdf = torch.cumsum(pdf, -1)
-                cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], -1)  # (batch, len(bins))
+                cdf = self.get_weights_cdf(weights)
 
             # Invert CDF
-            if (not_converge and total_iters < self.max_total_iters) or (not model.training):
-                u = torch.linspace(0., 1., steps=N).cuda().unsqueeze(0).repeat(cdf.shape[0], 1)
-            else:
-                u = torch.rand(list(cdf.shape[:-1]) + [N]).cuda()
-            u = u.contiguous()
-
-            inds = torch.searchsorted(cdf, u, right=True)
-            below = torch.max(torch.zeros_like(inds - 1), inds - 1)
-            above = torch.min((cdf.shape[-1] - 1) * torch.ones_like(inds), inds)
-            inds_g = torch.stack([below, above], -1)  # (batch, N_samples, 2)
-
-            matched_shape = [inds_g.shape[0], inds_g.shape[1], cdf.shape[-1]]
-            cdf_g = torch.gather(cdf.unsqueeze(1).expand(matched_shape), 2, inds_g)
-            bins_g = torch.gather(bins.unsqueeze(1).expand(matched_shape), 2, inds_g)
-
-            denom = (cdf_g[..., 1] - cdf_g[..., 0])
-            denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
-            t = (u - cdf_g[..., 0]) / denom
-            samples = bins_g[..., 0] + t * (bins_g[..., 1] - bins_g[..., 0])
+            bins = z_vals
+            deterministic = (not_converge and total_iters < self.max_total_iters) or (not model.training)
+            samples = self.invert_cdf(bins, cdf, N, deterministic)
 
             # Adding samples if we not converged
             if not_converge and total_iters < self.max_total_iters:
@@ -250,15 +230,15 @@ class ErrorBoundSampler(RaySampler):
         z_samples = samples
         
         #TODO Use near and far from intersection
-        near, far = self.near * torch.ones(ray_dirs_obj.shape[0], 1).cuda(), self.far * torch.ones(ray_dirs_obj.shape[0],1).cuda()
+        near, far = self.get_near_far(ray_dirs_obj.shape[0], z_vals.device, z_vals.dtype)
         if self.inverse_sphere_bg: # if inverse sphere then need to add the far sphere intersection
             far = rend_util.get_sphere_intersections(cam_loc_obj, ray_dirs_obj, r=self.scene_bounding_sphere)[:,1:]
 
         if self.N_samples_extra > 0:
             if model.training:
-                sampling_idx = torch.randperm(z_vals.shape[1])[:self.N_samples_extra]           # z_vals include uniform sample z_vals
+                sampling_idx = torch.randperm(z_vals.shape[1], device=z_vals.device)[:self.N_samples_extra]           # z_vals include uniform sample z_vals
             else:
-                sampling_idx = torch.linspace(0, z_vals.shape[1]-1, self.N_samples_extra).long()
+                sampling_idx = self.get_extra_index(z_vals.shape[1], z_vals.device)
             z_vals_extra = torch.cat([near, far, z_vals[:,sampling_idx]], -1)
         else:
             z_vals_extra = torch.cat([near, far], -1)
@@ -267,7 +247,7 @@ class ErrorBoundSampler(RaySampler):
 
 
         # add some of the near surface points
-        idx = torch.randint(z_vals.shape[-1], (z_vals.shape[0],)).cuda()
+        idx = torch.randint(z_vals.shape[-1], (z_vals.shape[0],), device=z_vals.device)
         z_samples_eik = torch.gather(z_vals, 1, idx.unsqueeze(-1))              # one random value on a ray
 
         if self.inverse_sphere_bg:
@@ -277,12 +257,219 @@ class ErrorBoundSampler(RaySampler):
 
         return z_vals, z_samples_eik
 
+    def get_z_vals_incremental(self, ray_dirs_obj, cam_loc_obj, model, latent_feature, cat_feature, uv, model_input):
+        """
+        get_z_vals that drops the converged rays (beta <= beta0) from later rounds, a ray draws its final samples
+        in the round it converges, so only the active rays get new samples and sdf evaluations.
+        The per-ray latent_feature / cat_feature are projected once (ImplicitNetwork.project_features) and reused by every round.
+        self.active_rays is the number of rays evaluated in every round.
+        :param latent_feature, (B*N_uv, 256)
+        :param cat_feature, (B, 256+9)
+        """
+        beta0 = model.density.get_beta().detach()
+        batch_size, N_uv, _ = uv.shape
+        device = ray_dirs_obj.device
+
+        # Start with uniform sampling
+        z_vals, near, far = self.uniform_sampler.get_z_vals(ray_dirs_obj, cam_loc_obj, model)
+
+        # Get maximum beta from the upper bound (Lemma 2)
+        dists = z_vals[:, 1:] - z_vals[:, :-1]
+        bound = self.bound_scale * (dists ** 2.).sum(-1)
+        beta = torch.sqrt(bound)
+
+        # per-ray features and object coords to cube coords transform
+        with torch.no_grad():
+            projections = model.implicit_network.project_features(latent_feature, repeat_interleave(cat_feature, N_uv))
+        scene_scale = repeat_interleave(model_input['scene_scale'], N_uv).unsqueeze(1)              # (B*N_uv, 1, 3)
+        centroid = repeat_interleave(model_input['centroid'], N_uv).unsqueeze(1)
+        none_equal_scale = repeat_interleave(model_input['none_equal_scale'], N_uv).unsqueeze(1)
+
+        def get_sdf(rays, samples):
+            points_obj = cam_loc_obj[rays].unsqueeze(1) + samples.unsqueeze(2) * ray_dirs_obj[rays].unsqueeze(1)      # (N_active, N_pts_per_ray, 3)
+            cube_coords = (points_obj / scene_scale[rays] - centroid[rays]) * none_equal_scale[rays]                # same as sdf_util.scene_obj2cube_coords
+            with torch.no_grad():
+                sdf = model.implicit_network.get_sdf_vals_projected(cube_coords.reshape(-1, 3), {l: projection[rays] for l, projection in projections.items()})
+            return sdf.reshape(samples.shape)
+
+        num_rays = z_vals.shape[0]
+        z_samples = torch.zeros(num_rays, self.N_samples, device=device)
+        z_vals_sampled = torch.zeros(num_rays, self.N_samples_extra, device=device)
+        rays = torch.arange(num_rays, device=device)                    # active rays
+        sdf = get_sdf(rays, z_vals)
+        self.active_rays = []
+
+        # Algorithm 1, per ray
+        total_iters = 0
+        while rays.shape[0] > 0:
+            self.active_rays.append(rays.shape[0])
+            total_iters += 1
+
+            # Calculating the bound d* (Theorem 1)
+            dists = z_vals[:, 1:] - z_vals[:, :-1]
+            d_star = self.get_d_star(sdf, dists)
+
+            # Updating beta using line search
+            beta = self.line_search_beta(beta0, beta, model, sdf.reshape(-1, 1), z_vals, dists, d_star)
+            dists, transmittance, weights = self.get_weights(model, sdf, z_vals, dists, beta)
+
+            # Sample the final sample set of the converged rays
+            done = beta <= beta0
+            if total_iters >= self.max_total_iters:
+                done = torch.ones_like(done)
+            if done.any():
+                done_rays = rays[done]
+                z_samples[done_rays] = self.invert_cdf(z_vals[done], self.get_weights_cdf(weights[done]), self.N_samples, not model.training)
+                if self.N_samples_extra > 0:
+                    if model.training:
+                        sampling_idx = torch.randperm(z_vals.shape[1], device=device)[:self.N_samples_extra]           # z_vals include uniform sample z_vals
+                    else:
+                        sampling_idx = self.get_extra_index(z_vals.shape[1], device)
+                    z_vals_sampled[done_rays] = z_vals[done][:, sampling_idx]
+
+            active = ~done
+            if not active.any():
+                break
+
+            # Sample more points proportional to the current error bound, only for the active rays
+            cdf = self.get_error_cdf(d_star[active], beta[active], dists[active], transmittance[active])
+            samples = self.invert_cdf(z_vals[active], cdf, self.N_samples_eval, True)
+            rays, beta = rays[active], beta[active]
+
+            # Calculating the SDF only for the new sampled points
+            samples_sdf = get_sdf(rays, samples)
+            z_vals, samples_idx = torch.sort(torch.cat([z_vals[active], samples], -1), -1)
+            sdf = torch.gather(torch.cat([sdf[active], samples_sdf], -1), 1, samples_idx)
+
+        #TODO Use near and far from intersection
+        near, far = self.get_near_far(num_rays, device, z_vals.dtype)
+        z_vals_extra = torch.cat([near, far, z_vals_sampled], -1)
+        z_vals, _ = torch.sort(torch.cat([z_samples, z_vals_extra], -1), -1)
+
+        # add some of the near surface points
+        idx = torch.randint(z_vals.shape[-1], (z_vals.shape[0],), device=device)
+        z_samples_eik = torch.gather(z_vals, 1, idx.unsqueeze(-1))              # one random value on a ray
+
+        return z_vals, z_samples_eik
+
+    def get_extra_index(self, num_samples, device):
+        """
+        evenly spaced index of the N_samples_extra samples kept from num_samples z_vals in eval
+        """
+        return self.get_constant(('extra_index', num_samples), device, torch.long,
+                                 lambda: torch.linspace(0, num_samples-1, self.N_samples_extra).long())
+
+    def get_d_star(self, d, dists):
+        """
+        the bound d* of every section (Theorem 1)
+        :param d, sdf of the samples, (N_rays, N_pts_per_ray)
+        """
+        a, b, c = dists, d[:, :-1].abs(), d[:, 1:].abs()
+        first_cond = a.pow(2) + b.pow(2) <= c.pow(2)
+        second_cond = a.pow(2) + c.pow(2) <= b.pow(2)
+        d_star = torch.zeros_like(dists)
+        d_star[first_cond] = b[first_cond]
+        d_star[second_cond] = c[second_cond]
+        s = (a + b + c) / 2.0
+        area_before_sqrt = s * (s - a) * (s - b) * (s - c)
+        mask = ~first_cond & ~second_cond & (b + c - a > 0)
+        d_star[mask] = (2.0 * torch.sqrt(area_before_sqrt[mask])) / (a[mask])
+        d_star = (d[:, 1:].sign() * d[:, :-1].sign() == 1) * d_star  # Fixing the sign
+        return d_star
+
+    def line_search_beta(self, beta0, beta, model, sdf, z_vals, dists, d_star):
+        """
+        the smallest beta (>= beta0) of every ray whose error bound is <= eps, beta is the upper bound.
+        K-ary search: every round evaluates the K-1 inner points of the interval of every ray in one batch,
+        the error bound decreases with beta, so the first candidate within eps is the new upper bound (K=2 is the bisection)
+        """
+        curr_error = self.get_error_bound(beta0, model, sdf, z_vals, dists, d_star)
+        beta = torch.where(curr_error <= self.eps, beta0, beta)
+        beta_min, beta_max = beta0.expand_as(beta), beta
+        fractions = torch.arange(1, self.beta_search_k, device=beta.device, dtype=beta.dtype) / self.beta_search_k     # (K-1,)
+        for j in range(self.beta_search_rounds):
+            candidates = beta_min.unsqueeze(-1) * (1 - fractions) + beta_max.unsqueeze(-1) * fractions              # (N_rays, K-1)
+            curr_error = self.get_error_bound(candidates.unsqueeze(-1), model, sdf, z_vals, dists, d_star)         # (N_rays, K-1)
+            idx = (curr_error > self.eps).sum(-1, keepdim=True)
+            bounds = torch.cat([beta_min.unsqueeze(-1), candidates, beta_max.unsqueeze(-1)], -1)                    # (N_rays, K+1)
+            beta_min, beta_max = bounds.gather(-1, idx).squeeze(-1), bounds.gather(-1, idx + 1).squeeze(-1)
+        return beta_max
+
+    def get_weights(self, model, sdf, z_vals, dists, beta):
+        """
+        :return dists with the last 1e10 section, transmittance and volume rendering weights with beta
+        """
+        density = model.density(sdf.reshape(z_vals.shape), beta=beta.unsqueeze(-1))
+
+        last_dist = self.get_constant('last_dist', dists.device, dists.dtype, lambda: torch.full((1, 1), 1e10))
+        dists = torch.cat([dists, last_dist.expand(dists.shape[0], 1)], -1)
+        free_energy = dists * density
+        shifted_free_energy = torch.cat([torch.zeros_like(free_energy[:, :1]), free_energy[:, :-1]], dim=-1)
+        alpha = 1 - torch.exp(-free_energy)
+        transmittance = torch.exp(-torch.cumsum(shifted_free_energy, dim=-1))
+        weights = alpha * transmittance  # probability of the ray hits something here
+        return dists, transmittance, weights
+
+    def get_error_cdf(self, d_star, beta, dists, transmittance):
+        ''' cdf proportional to the current error bound '''
+        error_per_section = torch.exp(-d_star / beta.unsqueeze(-1)) * (dists[:,:-1] ** 2.) / (4 * beta.unsqueeze(-1) ** 2)
+        error_integral = torch.cumsum(error_per_section, dim=-1)
+        bound_opacity = (torch.clamp(torch.exp(error_integral),max=1.e6) - 1.0) * transmittance[:,:-1]
+
+        pdf = bound_opacity + self.add_tiny
+        pdf = pdf / torch.sum(pdf, -1, keepdim=True)
+        cdf = torch.cumsum(pdf, -1)
+        cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], -1)
+        return cdf
+
+    def get_weights_cdf(self, weights):
+        ''' cdf of the volume rendering weights, for the final sample set '''
+        pdf = weights[..., :-1]
+        pdf = pdf + 1e-5  # prevent nans
+        pdf = pdf / torch.sum(pdf, -1, keepdim=True)
+        cdf = torch.cumsum(pdf, -1)
+        cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], -1)  # (batch, len(bins))
+        return cdf
+
+    def invert_cdf(self, bins, cdf, N, deterministic):
+        """
+        draw N samples of every ray from the piecewise linear cdf over bins, evenly spaced u if deterministic
+        """
+        if deterministic:
+            u = self.get_linspace(N, cdf.device, cdf.dtype).unsqueeze(0).expand(cdf.shape[0], N)
+        else:
+            u = torch.rand(list(cdf.shape[:-1]) + [N], device=cdf.device, dtype=cdf.dtype)
+        u = u.contiguous()
+
+        inds = torch.searchsorted(cdf, u, right=True)
+        below = torch.max(torch.zeros_like(inds - 1), inds - 1)
+        above = torch.min((cdf.shape[-1] - 1) * torch.ones_like(inds), inds)
+        inds_g = torch.stack([below, above], -1)  # (batch, N_samples, 2)
+
+        matched_shape = [inds_g.shape[0], inds_g.shape[1], cdf.shape[-1]]
+        cdf_g = torch.gather(cdf.unsqueeze(1).expand(matched_shape), 2, inds_g)
+        bins_g = torch.gather(bins.unsqueeze(1).expand(matched_shape), 2, inds_g)
+
+        denom = (cdf_g[..., 1] - cdf_g[..., 0])
+        denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
+        t = (u - cdf_g[..., 0]) / denom
+        samples = bins_g[..., 0] + t * (bins_g[..., 1] - bins_g[..., 0])
+        return samples
+
     def get_error_bound(self, beta, model, sdf, z_vals, dists, d_star):
-        density = model.density(sdf.reshape(z_vals.shape), beta=beta)
-        shifted_free_energy = torch.cat([torch.zeros(dists.shape[0], 1).cuda(), dists * density[:, :-1]], dim=-1)
+        """
+        :param beta, scalar or (N_rays, 1), or (N_rays, N_candidates, 1) for several betas of every ray
+        :return max error bound of the opacity of every ray, (N_rays,) or (N_rays, N_candidates)
+        """
+        sdf = sdf.reshape(z_vals.shape)
+        if beta.dim() == 3:
+            sdf, dists, d_star = sdf.unsqueeze(1), dists.unsqueeze(1), d_star.unsqueeze(1)
+        density = model.density(sdf, beta=beta)
+        free_energy = dists * density[..., :-1]
+        shifted_free_energy = torch.cat([torch.zeros_like(free_energy[..., :1]), free_energy], dim=-1)
         integral_estimation = torch.cumsum(shifted_free_energy, dim=-1)
         error_per_section = torch.exp(-d_star / beta) * (dists ** 2.) / (4 * beta ** 2)
         error_integral = torch.cumsum(error_per_section, dim=-1)
-        bound_opacity = (torch.clamp(torch.exp(error_integral), max=1.e6) - 1.0) * torch.exp(-integral_estimation[:, :-1])
+        bound_opacity = (torch.clamp(torch.exp(error_integral), max=1.e6) - 1.0) * torch.exp(-integral_estimation[..., :-1])
 
         return bound_opacity.max(-1)[0]
\ No newline at end of file
@@ -342,6 +342,11 @@ def load_device(cfg):
     :param config:
     :return:
     '''
+    num_threads = cfg.config['device'].get('num_threads', None)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+        cfg.log_string('CPU threads: %d.' % (num_threads))
+
     if cfg.config['device']['use_gpu'] and torch.cuda.is_available():
         cfg.log_string('GPU mode is on.')
         cfg.log_string('GPU Ids: %s used.' % (cfg.config['device']['gpu_ids']))
@@ -360,7 +365,7 @@ def get_model(cfg,device):
     if cfg['model']['stop_encoder_grad']:
         print("Encoder frozen, stop_encoder_grad")
         model.encoder.eval()
-    return model
+    return model.to(device)
 
 
 def get_loss(cfg, mode):
@@ -6,6 +6,7 @@ import torch
 from torch.utils.tensorboard import SummaryWriter
 
 from utils.model_utils.render_utils import get_psnr
+from utils.DataProcess.device_sampling import sample_batch_pixels
 
 
 def Recon_trainer(cfg,model,loss,optimizer,scheduler,train_loader,test_loader,device,checkpoint):
@@ -34,12 +35,15 @@ def Recon_trainer(cfg,model,loss,optimizer,scheduler,train_loader,test_loader,de
     min_eval_loss = 10000
     use_dino =  config["model"]["latent_feature"]["encoder"]["use_dino"]
     accumulation_steps = config["data"]["accumulation_steps"]  # 累积步数，尝试不同的值
+    device_sampling = config['data'].get('device_sampling', False)     # pixels are sampled on the device, see device_sampling.py
+    sampler_iters = config['model']['ray_sampler']['max_total_iters']
     
     for e in range(start_epoch, config['other']['nepoch']):
         torch.cuda.empty_cache()
         cfg.log_string("Switch Phase to Train")
         model.train()
         optimizer.zero_grad()   # 重置优化器梯度
+        sampler_active_rays = torch.zeros(sampler_iters, dtype=torch.long)     # model.ray_sampler.incremental statistics of this epoch
         for batch_id, (indices, model_input, ground_truth) in enumerate(train_loader):
             '''
             indices: [B*1]
@@ -54,19 +58,21 @@ def Recon_trainer(cfg,model,loss,optimizer,scheduler,train_loader,test_loader,de
                 2.depth: [B, num_pixels, 1]
                 3.normal: [B, num_pixels, 3]
             '''
-            model_input["image"] = model_input["image"].cuda().to(torch.float32)
-            model_input["intrinsics"] = model_input["intrinsics"].cuda().to(torch.float32)        # cpu -> gpu
-            model_input["uv"] = model_input["uv"].cuda().to(torch.float32)
-            model_input['pose'] = model_input['pose'].cuda().to(torch.float32)
-            model_input['extrinsics'] = model_input['extrinsics'].cuda().to(torch.float32)
-            model_input['obj_rot'] = model_input['obj_rot'].cuda().to(torch.float32)
-            model_input['obj_tran'] = model_input['obj_tran'].cuda().to(torch.float32)
-            model_input['world_to_obj'] = model_input['world_to_obj'].cuda().to(torch.float32)
-            model_input['centroid'] = model_input['centroid'].cuda().to(torch.float32)
-            model_input['none_equal_scale'] = model_input['none_equal_scale'].cuda().to(torch.float32)
-            model_input['scene_scale'] = model_input['scene_scale'].cuda().to(torch.float32)
+            model_input["image"] = model_input["image"].to(device, torch.float32)
+            if device_sampling:
+                model_input, ground_truth = sample_batch_pixels(model_input, ground_truth, config['data']['num_pixels']['train'], mask_filter=config['data']['mask_filter'])
+            model_input["intrinsics"] = model_input["intrinsics"].to(device, torch.float32)        # cpu -> gpu
+            model_input["uv"] = model_input["uv"].to(device, torch.float32)
+            model_input['pose'] = model_input['pose'].to(device, torch.float32)
+            model_input['extrinsics'] = model_input['extrinsics'].to(device, torch.float32)
+            model_input['obj_rot'] = model_input['obj_rot'].to(device, torch.float32)
+            model_input['obj_tran'] = model_input['obj_tran'].to(device, torch.float32)
+            model_input['world_to_obj'] = model_input['world_to_obj'].to(device, torch.float32)
+            model_input['centroid'] = model_input['centroid'].to(device, torch.float32)
+            model_input['none_equal_scale'] = model_input['none_equal_scale'].to(device, torch.float32)
+            model_input['scene_scale'] = model_input['scene_scale'].to(device, torch.float32)
             if use_dino:
-                model_input['dino_feat'] = model_input['dino_feat'].cuda().to(torch.float32)
+                model_input['dino_feat'] = model_input['dino_feat'].to(device, torch.float32)
 
 
             model_outputs = model(model_input, indices)
@@ -96,7 +102,7 @@ def Recon_trainer(cfg,model,loss,optimizer,scheduler,train_loader,test_loader,de
                 optimizer.step()
                 optimizer.zero_grad()            
 
-            psnr = get_psnr(model_outputs['rgb_values'], ground_truth['rgb'].cuda().reshape(-1,3))
+            psnr = get_psnr(model_outputs['rgb_values'], ground_truth['rgb'].to(device).reshape(-1,3))
             msg = '{:0>8},[epoch {}] ({}/{}): total_loss = {}, rgb_loss = {}, eikonal_loss = {}, depth_loss = {}, normal_l1 = {}, normal_cos = {}, ray_mask_loss = {}, instance_mask_loss = {}, sdf_loss = {}, vis_sdf_loss = {}, psnr = {}, bete={}, alpha={}, dino_weight={}, diffu_weight={} '.format(
                     str(datetime.timedelta(seconds=round(time.time() - start_t))),
                     e,
@@ -139,9 +145,24 @@ def Recon_trainer(cfg,model,loss,optimizer,scheduler,train_loader,test_loader,de
             tb_logger.add_scalar('Statistics/psnr', psnr.item(), iter)
             current_lr = optimizer.state_dict()['param_groups'][0]['lr']
             tb_logger.add_scalar("train/lr", current_lr, iter)
+            if 'sampler_active_rays' in model_outputs:
+                active_rays = model_outputs['sampler_active_rays'].reshape(-1, sampler_iters).sum(0).cpu()     # sum of the gpus
+                sampler_active_rays += active_rays
+                for i in range(sampler_iters):
+                    tb_logger.add_scalar('Sampler/active_rays_round{}'.format(i), active_rays[i].item(), iter)
 
             iter += 1
-        
+
+        # data loading statistics of this epoch (image cache hit rate etc.)
+        cfg.log_string('[epoch {}] loader: {}'.format(e, train_loader.dataset.metrics.report()))
+        for name, value in train_loader.dataset.metrics.snapshot().items():
+            tb_logger.add_scalar('Loader/' + name, value, iter)
+        train_loader.dataset.metrics.reset()
+        if sampler_active_rays[0] > 0:
+            # sdf evaluations of the rounds after the first, relative to evaluating all rays in every round
+            cfg.log_string('[epoch {}] sampler active rays per round: {}, evaluated = {:.3f}'.format(
+                e, sampler_active_rays.tolist(), sampler_active_rays[1:].sum().item() / (sampler_active_rays[0].item() * (sampler_iters - 1) + 1e-8)))
+
         # 调整学习率
         scheduler.step()
 
@@ -154,24 +175,26 @@ def Recon_trainer(cfg,model,loss,optimizer,scheduler,train_loader,test_loader,de
             cfg.log_string("Switch Phase to Test")
             for batch_id, (indices, model_input, ground_truth) in enumerate(test_loader):
                 torch.cuda.empty_cache()
-                model_input["image"] = model_input["image"].cuda().to(torch.float32)
-                model_input["intrinsics"] = model_input["intrinsics"].cuda().to(torch.float32)        # cpu -> gpu
-                model_input["uv"] = model_input["uv"].cuda().to(torch.float32)
-                model_input['pose'] = model_input['pose'].cuda().to(torch.float32)
-                model_input['extrinsics'] = model_input['extrinsics'].cuda().to(torch.float32)
-                model_input['obj_rot'] = model_input['obj_rot'].cuda().to(torch.float32)
-                model_input['obj_tran'] = model_input['obj_tran'].cuda().to(torch.float32)
-                model_input['world_to_obj'] = model_input['world_to_obj'].cuda().to(torch.float32)
-                model_input['centroid'] = model_input['centroid'].cuda().to(torch.float32)
-                model_input['none_equal_scale'] = model_input['none_equal_scale'].cuda().to(torch.float32)
-                model_input['scene_scale'] = model_input['scene_scale'].cuda().to(torch.float32)
+                model_input["image"] = model_input["image"].to(device, torch.float32)
+                if device_sampling:
+                    model_input, ground_truth = sample_batch_pixels(model_input, ground_truth, config['data']['num_pixels']['val'], mask_filter=config['data']['mask_filter'])
+                model_input["intrinsics"] = model_input["intrinsics"].to(device, torch.float32)        # cpu -> gpu
+                model_input["uv"] = model_input["uv"].to(device, torch.float32)
+                model_input['pose'] = model_input['pose'].to(device, torch.float32)
+                model_input['extrinsics'] = model_input['extrinsics'].to(device, torch.float32)
+                model_input['obj_rot'] = model_input['obj_rot'].to(device, torch.float32)
+                model_input['obj_tran'] = model_input['obj_tran'].to(device, torch.float32)
+                model_input['world_to_obj'] = model_input['world_to_obj'].to(device, torch.float32)
+                model_input['centroid'] = model_input['centroid'].to(device, torch.float32)
+                model_input['none_equal_scale'] = model_input['none_equal_scale'].to(device, torch.float32)
+                model_input['scene_scale'] = model_input['scene_scale'].to(device, torch.float32)
                 model_outputs = model(model_input, indices)
 
                 loss_output = loss(model_outputs, ground_truth, e)
                 total_loss = loss_output['total_loss']
             
 
-                psnr = get_psnr(model_outputs['rgb_values'], ground_truth['rgb'].cuda().reshape(-1,3))
+                psnr = get_psnr(model_outputs['rgb_values'], ground_truth['rgb'].to(device).reshape(-1,3))
                 msg = 'Validation {:0>8},[epoch {}] ({}/{}): total_loss = {}, rgb_loss = {}, eikonal_loss = {}, depth_loss = {}, normal_l1 = {}, normal_cos = {}, ray_mask_loss = {}, instance_mask_loss = {}, sdf_loss = {}, vis_sdf_loss = {}, psnr = {}, bete={}, alpha={}, dino_weight={}, diffu_weight={}'.format(
                     str(datetime.timedelta(seconds=round(time.time() - start_t))),
                     e,
@@ -0,0 +1,124 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import numpy as np
+import json
+from tqdm import tqdm
+
+from utils.DataProcess.packed_store import get_split_list
+
+
+ANNOTATION_INDEX_VERSION = 1
+
+# per-image columns, [num_images, ...]
+IMAGE_COLUMNS = {
+    'camera_pose_tran': [3],
+    'camera_pose_rot': [3, 3],
+    'camera_intrinsics': [3, 3],
+    'camera_extrinsics': [3, 4],
+}
+
+# per-object columns, [num_objects, ...]
+OBJECT_COLUMNS = {
+    'bbox3d_world': [3, 8],
+    'bbox3d_world_center': [3],
+    'bbox3d_camera': [3, 8],
+    'half_length': [3],
+    'obj_rot': [3, 3],
+    'obj_tran': [3],
+    'obj_scale': [3],
+}
+
+
+def annotation_fields(annotation, objid):
+    """
+    camera and object fields of an object from a per-image json annotation, the same layout as AnnotationIndex.get
+    """
+    obj = annotation['obj_dict'][objid]
+    fields = {name: np.array(annotation[name]) for name in IMAGE_COLUMNS}
+    fields.update({name: np.array(obj[name]) for name in OBJECT_COLUMNS})
+    fields['obj_id'] = obj['obj_id'][0]                         # [xxx], a list
+    fields['model_file_name'] = obj['model_file_name'][0]       # ['xxxxxxxxx'], a list
+    return fields
+
+
+def build_annotation_index(config, mode, out_path):
+    """
+    flatten the json annotations of all objects of the split images into one columnar .npz, see AnnotationIndex
+    """
+    data_path = config['data']['data_path']
+    imgids = list(dict.fromkeys(item[0] for item in get_split_list(config, mode)))
+
+    columns = {name: [] for name in list(IMAGE_COLUMNS) + list(OBJECT_COLUMNS)}
+    object_image, object_keys, obj_ids, model_file_names = [], [], [], []
+    for image_row, imgid in enumerate(tqdm(imgids, desc=f'annotation index {mode}')):
+        img_path = os.path.join(data_path, imgid)
+        post_fix = img_path.split('.')[-1]
+        with open(img_path.replace('rgb', 'annotation').replace(f'.{post_fix}', '.json'), 'r') as f:
+            annotation = json.load(f)
+
+        for name in IMAGE_COLUMNS:
+            columns[name].append(annotation[name])
+        for objid, obj in annotation['obj_dict'].items():
+            for name in OBJECT_COLUMNS:
+                columns[name].append(obj[name])
+            object_image.append(image_row)
+            object_keys.append(objid)
+            obj_ids.append(obj['obj_id'][0])
+            model_file_names.append(obj['model_file_name'][0])
+
+    arrays = {'version': np.array(ANNOTATION_INDEX_VERSION)}
+    for name, shape in list(IMAGE_COLUMNS.items()) + list(OBJECT_COLUMNS.items()):
+        arrays[name] = np.array(columns[name], dtype=np.float32).reshape([-1] + shape)
+    arrays['image_ids'] = np.array(imgids)
+    arrays['object_image'] = np.array(object_image, dtype=np.int32)
+    arrays['object_keys'] = np.array(object_keys)
+    arrays['obj_id'] = np.array(obj_ids, dtype=np.int64)
+    arrays['model_file_name'] = np.array(model_file_names)
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    np.savez(out_path, **arrays)
+    return arrays
+
+
+class AnnotationIndex(object):
+    """
+    Columnar annotations of a split made by utils/DataProcess/build_annotation_index.py.
+    Camera columns are indexed by image row, object columns by object row, both found by (imgid, objid).
+    Columns are stored as float32 and returned as float64 views of one row, the same as np.array of the json lists.
+    """
+    def __init__(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'annotation index {path} not found, run utils/DataProcess/build_annotation_index.py first')
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        if int(arrays['version']) != ANNOTATION_INDEX_VERSION:
+            raise ValueError(f'annotation index version {int(arrays["version"])} is not supported, please rebuild')
+
+        self.image_columns = {name: arrays[name].astype(np.float64) for name in IMAGE_COLUMNS}
+        self.object_columns = {name: arrays[name].astype(np.float64) for name in OBJECT_COLUMNS}
+        self.obj_id = arrays['obj_id']
+        self.model_file_name = arrays['model_file_name']
+        self.object_image = arrays['object_image']
+
+        image_ids = arrays['image_ids'].tolist()
+        self.object_rows = {(image_ids[image_row], objid): row
+                            for row, (image_row, objid) in enumerate(zip(self.object_image.tolist(), arrays['object_keys'].tolist()))}
+
+    def __len__(self):
+        return len(self.object_rows)
+
+    def __contains__(self, key):
+        return key in self.object_rows
+
+    def get(self, imgid, objid):
+        """
+        :return dict of camera and object fields of an object, see annotation_fields
+        """
+        row = self.object_rows[(imgid, objid)]
+        image_row = self.object_image[row]
+        fields = {name: column[image_row] for name, column in self.image_columns.items()}
+        fields.update({name: column[row] for name, column in self.object_columns.items()})
+        fields['obj_id'] = int(self.obj_id[row])
+        fields['model_file_name'] = str(self.model_file_name[row])
+        return fields
@@ -0,0 +1,126 @@
+import numpy as np
+import torch
+from collections import OrderedDict
+from torch.utils.data import Sampler
+
+
+def asset_nbytes(value):
+    """
+    bytes held by the arrays of a (nested) asset dict, other python objects (e.g. annotation lists) are not counted,
+    walking the annotation lists would cost more than decoding a small image
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(asset_nbytes(v) for v in value.values())
+    return 0
+
+
+class LRUAssetCache(object):
+    """
+    Least-recently-used cache of decoded assets with a byte budget, one instance per DataLoader worker.
+    Cached assets are shared by every sample that reads them, callers must not modify them in place.
+    :params max_bytes, byte budget, an asset larger than the budget is not cached
+    :params metrics, LoaderMetrics, count '{name}_hit', '{name}_miss' and '{name}_evict'
+    """
+    def __init__(self, max_bytes, metrics=None, name='cache'):
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.name = name
+        self.nbytes = 0
+        self._items = OrderedDict()         # key -> (value, nbytes)
+        if self.metrics is not None:
+            for suffix in ['hit', 'miss', 'evict']:
+                self.metrics.register(f'{name}_{suffix}')
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def _count(self, suffix):
+        if self.metrics is not None:
+            self.metrics.add(f'{self.name}_{suffix}')
+
+    def get(self, key, load_fn):
+        """
+        return the cached asset of key, or load_fn(key) and cache it
+        """
+        if key in self._items:
+            self._items.move_to_end(key)
+            self._count('hit')
+            return self._items[key][0]
+
+        self._count('miss')
+        value = load_fn(key)
+        nbytes = asset_nbytes(value)
+        if nbytes <= self.max_bytes:
+            while self.nbytes + nbytes > self.max_bytes:
+                _, (_, evict_nbytes) = self._items.popitem(last=False)
+                self.nbytes -= evict_nbytes
+                self._count('evict')
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+        return value
+
+    def clear(self):
+        self._items.clear()
+        self.nbytes = 0
+
+
+class ImageGroupedBatchSampler(Sampler):
+    """
+    Batch sampler that keeps all objects of an image in one DataLoader worker, so the worker's
+    image cache decodes every image once per epoch.
+    The DataLoader hands batch i to worker i % num_workers, so image groups are assigned to num_workers
+    lanes once (balanced by object number), and each epoch interleaves the batches of the lanes in that order.
+    Shuffling permutes the groups within a lane and the objects within a group.
+    :params split, dataset split list of (imgid, objid, cname)
+    :params num_workers, DataLoader num_workers, 0 means loading in the main process
+    """
+    def __init__(self, split, batch_size, num_workers=0, shuffle=False, drop_last=False):
+        self.batch_size = batch_size
+        self.num_lanes = max(num_workers, 1)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+        groups = OrderedDict()              # imgid -> dataset indices
+        for index, (imgid, _, _) in enumerate(split):
+            groups.setdefault(imgid, []).append(index)
+        groups = list(groups.values())
+
+        # largest groups first to the least loaded lane, keep the split order inside a lane
+        self.lanes = [[] for _ in range(self.num_lanes)]
+        num_objects = [0] * self.num_lanes
+        for group_id in sorted(range(len(groups)), key=lambda i: len(groups[i]), reverse=True):
+            lane = num_objects.index(min(num_objects))
+            self.lanes[lane].append(group_id)
+            num_objects[lane] += len(groups[group_id])
+        self.lanes = [[groups[group_id] for group_id in sorted(lane)] for lane in self.lanes]
+        self.lane_sizes = num_objects
+
+    def _lane_batches(self, lane):
+        if self.shuffle:
+            lane = [lane[i] for i in torch.randperm(len(lane)).tolist()]
+            lane = [[group[i] for i in torch.randperm(len(group)).tolist()] for group in lane]
+        indices = [index for group in lane for index in group]
+
+        batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+    def __iter__(self):
+        lane_batches = [self._lane_batches(lane) for lane in self.lanes]
+        for batch_round in range(max(len(batches) for batches in lane_batches)):
+            for batches in lane_batches:
+                if batch_round < len(batches):
+                    yield batches[batch_round]
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(n // self.batch_size for n in self.lane_sizes)
+        return sum((n + self.batch_size - 1) // self.batch_size for n in self.lane_sizes)
@@ -0,0 +1,69 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import time
+import yaml
+import numpy as np
+import torch
+
+from utils.DataProcess.dataloader import Front3D_Recon_Dataset
+
+
+class CachedAssetsDataset(Front3D_Recon_Dataset):
+    """
+    keep the decoded image and sdf assets in memory, so __getitem__ only measures the sample construction
+    """
+    def __init__(self, config, mode):
+        super(CachedAssetsDataset, self).__init__(config, mode)
+        self._sequences = {}
+        self._sdfs = {}
+
+    def load_sequence(self, imgid):
+        if imgid not in self._sequences:
+            self._sequences[imgid] = super(CachedAssetsDataset, self).load_sequence(imgid)
+        return self._sequences[imgid]
+
+    def load_sdf(self, cname, jid):
+        key = (cname, jid)
+        if key not in self._sdfs:
+            self._sdfs[key] = super(CachedAssetsDataset, self).load_sdf(cname, jid)
+        return self._sdfs[key]
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('micro-benchmark of Front3D_Recon_Dataset sample construction')
+    parser.add_argument('--config', type=str, default='train.yaml', help='configure file for training or testing.')
+    parser.add_argument('--mode', type=str, nargs='+', default=['train', 'test'], help='train samples num_pixels.train, test uses the full image.')
+    parser.add_argument('--num_samples', type=int, default=16, help='samples per mode, -1 for the whole split.')
+    parser.add_argument('--repeat', type=int, default=3)
+    return parser.parse_args()
+
+
+def bench(dataset, num_samples, repeat):
+    indices = range(len(dataset) if num_samples == -1 else min(num_samples, len(dataset)))
+    for index in indices:               # warm up, decode assets once
+        dataset[index]
+
+    latency = []
+    for _ in range(repeat):
+        for index in indices:
+            torch.manual_seed(index)
+            start = time.perf_counter()
+            dataset[index]
+            latency.append(time.perf_counter() - start)
+    return np.array(latency) * 1000
+
+
+if __name__=="__main__":
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    config['model']['latent_feature']['encoder']['use_depthStream'] = False    # depth prior is read from disk in __getitem__
+
+    for mode in args.mode:
+        dataset = CachedAssetsDataset(config, mode)
+        latency = bench(dataset, args.num_samples, args.repeat)
+        print(f'{mode}: num_pixels {dataset.num_pixels}, {len(latency)} samples, '
+              f'mean {latency.mean():.2f} ms, median {np.median(latency):.2f} ms, p90 {np.percentile(latency, 90):.2f} ms')
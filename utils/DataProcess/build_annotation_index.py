@@ -0,0 +1,28 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import yaml
+
+from utils.DataProcess.annotation_index import build_annotation_index
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('flatten the json annotations of a split into a columnar .npz')
+    parser.add_argument('--config', type=str, required=True, help='configure file for training or testing.')
+    parser.add_argument('--mode', type=str, nargs='+', default=['train', 'val', 'test'], help='splits to index.')
+    parser.add_argument('--out', type=str, default=None, help='output directory, default is data.annotation_index_path in config.')
+    return parser.parse_args()
+
+
+if __name__=="__main__":
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    out_root = args.out if args.out is not None else config['data']['annotation_index_path']
+    for mode in args.mode:
+        out_path = os.path.join(out_root, mode + '.npz')
+        arrays = build_annotation_index(config, mode, out_path)
+        print(f'{mode}: {len(arrays["image_ids"])} images, {len(arrays["obj_id"])} objects into {out_path}')
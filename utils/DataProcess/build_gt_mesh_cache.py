@@ -0,0 +1,113 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import tempfile
+import yaml
+import json
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from utils.DataProcess.packed_store import get_split_list, read_sdf_assets
+from utils.DataProcess.annotation_index import annotation_fields
+from utils.DataProcess.gt_mesh_cache import GTMeshCache, gt_mesh_key
+from utils.model_utils.plots import get_surface_sliding
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('extract the gt label meshes of the test models once into eval.gt_mesh_cache')
+    parser.add_argument('--config', type=str, required=True, help='configure file for training or testing.')
+    parser.add_argument('--mode', type=str, nargs='+', default=['test'], help='splits whose models are processed.')
+    parser.add_argument('--cache_dir', type=str, default=None, help='default eval.gt_mesh_cache of the config.')
+    parser.add_argument('--cpu', action='store_true')
+    return parser.parse_args()
+
+
+def gt_inputs(voxels, spacing_dic, scene_scale, device):
+    """
+    model_input / ground_truth of one object for get_surface_sliding(eval_gt=True), the object at the world origin:
+    the cube coords -> world -> object coords round trip of the gt sdf does not depend on the object pose
+    """
+    def tensor(value):
+        return torch.as_tensor(np.asarray(value), dtype=torch.float32, device=device)[None]
+
+    model_input = {
+        'none_equal_scale': tensor(spacing_dic['none_equal_scale']),
+        'centroid': tensor(spacing_dic['centroid']),
+        'scene_scale': tensor(scene_scale),
+        'obj_rot': tensor(np.eye(3)),
+        'obj_tran': tensor(np.zeros(3)),
+    }
+    ground_truth = {
+        'voxel_sdf': tensor(voxels[None]),                              # (1, 1, R, R, R)
+        'voxel_spacing': tensor(spacing_dic['spacing']),
+        'voxel_padding': tensor(float(spacing_dic['padding'])),
+        'centroid': model_input['centroid'],
+        'voxel_range': tensor(np.ones(3)),
+        'none_equal_scale': model_input['none_equal_scale'],
+        'scene_scale': model_input['scene_scale'],
+        'world_to_obj': tensor(np.eye(4)),
+    }
+    return model_input, ground_truth
+
+
+if __name__=="__main__":
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    sdf_path = config['data']['sdf_path']
+    data_path = config['data']['data_path']
+    cache_dir = args.cache_dir if args.cache_dir is not None else config['eval']['gt_mesh_cache']
+    resolution = config['eval'].get('mesh_resolution', 256)
+    extractor = config['eval'].get('mesh_extractor', 'dense')
+    delta = 0.03
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    cache = GTMeshCache(cache_dir)
+
+    # one mesh per (model, scene scale), objects of several images share it
+    objects = {}
+    annotations = {}
+    for mode in args.mode:
+        for imgid, objid, cname in get_split_list(config, mode):
+            if imgid not in annotations:
+                img_path = os.path.join(data_path, imgid)
+                post_fix = img_path.split('.')[-1]
+                with open(img_path.replace('rgb', 'annotation').replace(f'.{post_fix}', '.json'), 'r') as f:
+                    annotations[imgid] = json.load(f)
+            anno = annotation_fields(annotations[imgid], objid)
+            jid, scene_scale = anno['model_file_name'], anno['obj_scale']
+            objects.setdefault((cname, jid), []).append(scene_scale)
+
+    num_built, num_cached = 0, 0
+    for (cname, jid), scene_scales in tqdm(sorted(objects.items())):
+        voxels, spacing_dic = read_sdf_assets(sdf_path, cname, jid)
+        keys = {}
+        for scene_scale in scene_scales:
+            key, fields = gt_mesh_key(jid, scene_scale, float(spacing_dic['padding']), resolution, extractor, delta)
+            keys[key] = (fields, scene_scale)
+        for key, (fields, scene_scale) in keys.items():
+            if cache.contains(key):
+                num_cached += 1
+                continue
+            model_input, ground_truth = gt_inputs(voxels, spacing_dic, scene_scale, device)
+            with torch.no_grad():
+                mesh_gt = get_surface_sliding(
+                    path="", epoch="",
+                    model=None, img=torch.zeros(1, 1, 1, 1, device=device),
+                    intrinsics=None, extrinsics=None,
+                    model_input=model_input,
+                    ground_truth=ground_truth,
+                    resolution=resolution,
+                    return_mesh=True,
+                    delta=delta,
+                    eval_gt=True,
+                    extractor=extractor,
+                )
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                mesh_path = os.path.join(tmp_dir, 'label_cube.ply')
+                mesh_gt.export(mesh_path)
+                cache.put(key, fields, mesh_path)
+            num_built += 1
+    print(f'{len(objects)} models, {num_built} gt meshes built, {num_cached} already cached in {cache_dir}')
@@ -0,0 +1,56 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import yaml
+import json
+import numpy as np
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.DataProcess.packed_store import get_split_list, read_sdf_assets, surface_voxel_index, SURFACE_INDEX_NAME
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('precompute near-surface voxel indices of the gt sdf volumes for add_bdb3d_points')
+    parser.add_argument('--config', type=str, required=True, help='configure file for training or testing.')
+    parser.add_argument('--mode', type=str, nargs='+', default=['train', 'val'], help='splits whose models are processed.')
+    parser.add_argument('--num_threads', type=int, default=8)
+    parser.add_argument('--overwrite', action='store_true')
+    return parser.parse_args()
+
+
+def build_model(sdf_path, cname, jid, overwrite=False):
+    surface_path = os.path.join(sdf_path, cname, jid, SURFACE_INDEX_NAME)
+    if os.path.exists(surface_path) and not overwrite:
+        return 0
+    voxels, _ = read_sdf_assets(sdf_path, cname, jid)
+    surface_index = surface_voxel_index(voxels)
+    np.save(surface_path, surface_index)            # next to voxels.npy.gz
+    return surface_index.shape[0]
+
+
+if __name__=="__main__":
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    sdf_path = config['data']['sdf_path']
+    data_path = config['data']['data_path']
+
+    models = set()
+    annotations = {}
+    for mode in args.mode:
+        for imgid, objid, cname in get_split_list(config, mode):
+            if imgid not in annotations:
+                img_path = os.path.join(data_path, imgid)
+                post_fix = img_path.split('.')[-1]
+                with open(img_path.replace('rgb', 'annotation').replace(f'.{post_fix}', '.json'), 'r') as f:
+                    annotations[imgid] = json.load(f)
+            jid = annotations[imgid]['obj_dict'][objid]['model_file_name'][0]
+            models.add((cname, jid))
+
+    models = sorted(models)
+    with ThreadPoolExecutor(max_workers=args.num_threads) as pool:
+        counts = list(tqdm(pool.map(lambda model: build_model(sdf_path, *model, overwrite=args.overwrite), models), total=len(models)))
+    print(f'{len(models)} models, {sum(count > 0 for count in counts)} surface indices built')
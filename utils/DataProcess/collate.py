@@ -0,0 +1,38 @@
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+IMAGE_KEYS = ['image', 'depth_prior']           # per-image tensors of a sample, the same for all objects of an image
+GT_IMAGE_KEYS = ['depth_map', 'normal_map']     # per-image dense ground truth of data.device_sampling
+
+
+def image_grouped_collate(batch):
+    """
+    collate (index, sample, ground_truth) samples, keeping the per-image tensors once per unique image:
+    sample['image'] is [U, 3, H, W], sample['depth_prior'] is [U, H, W] (U unique images of the batch),
+    and sample['image_index'] [B] is the row of each object in them (also for the dense ground truth 'depth_map', 'normal_map'),
+    the other items are collated as default_collate
+    """
+    image_rows = {}
+    image_index = []
+    unique_items = []
+    for _, sample, ground_truth in batch:
+        imgid = ground_truth['img_id']
+        if imgid not in image_rows:
+            image_rows[imgid] = len(image_rows)
+            unique_items.append((sample, ground_truth))
+        image_index.append(image_rows[imgid])
+
+    stripped = [(index, {key: value for key, value in sample.items() if key not in IMAGE_KEYS},
+                 {key: value for key, value in ground_truth.items() if key not in GT_IMAGE_KEYS})
+                for index, sample, ground_truth in batch]
+    indices, samples, ground_truths = default_collate(stripped)
+
+    for key in IMAGE_KEYS:
+        if key in unique_items[0][0]:
+            samples[key] = torch.stack([torch.as_tensor(sample[key]) for sample, _ in unique_items])
+    for key in GT_IMAGE_KEYS:
+        if key in unique_items[0][1]:
+            ground_truths[key] = torch.stack([torch.as_tensor(ground_truth[key]) for _, ground_truth in unique_items])
+    samples['image_index'] = torch.tensor(image_index, dtype=torch.long)
+    return indices, samples, ground_truths
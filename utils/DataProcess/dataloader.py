@@ -1,6 +1,5 @@
 import os, sys
 sys.path.append(os.getcwd())
-import copy
 
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
@@ -8,10 +7,20 @@ import torch.utils.data
 from torchvision import transforms
 import numpy as np
 import json, gzip
+import skimage
 from tqdm import tqdm
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.model_utils.sdf_utils import *
 from utils.model_utils.render_utils import load_rgb
+from utils.DataProcess.packed_store import PackedSampleStore, read_sdf_assets, read_surface_index, surface_voxel_index
+from utils.DataProcess.asset_cache import LRUAssetCache, ImageGroupedBatchSampler, asset_nbytes
+from utils.DataProcess.loader_metrics import LoaderMetrics
+from utils.DataProcess.depth_prior_store import DepthPriorStore
+from utils.DataProcess.sdf_pool import SDFVolumePool
+from utils.DataProcess.annotation_index import AnnotationIndex, annotation_fields
+from utils.DataProcess.collate import image_grouped_collate
 
 
 category_label_mapping = {
@@ -25,6 +34,16 @@ data_transforms_mask = transforms.Compose([
 ])
 
 
+def pixel_grid(ymin, ymax, xmin, xmax):
+    """
+    all pixels of an image window, row-major
+    :return uv, [(ymax-ymin)*(xmax-xmin), 2] int32, uv[:, 0] -> x -> img_W, uv[:, 1] -> y -> img_H
+    """
+    ys, xs = np.meshgrid(np.arange(ymin, ymax, dtype=np.int32), np.arange(xmin, xmax, dtype=np.int32), indexing='ij')
+    uv = np.stack([xs.reshape(-1), ys.reshape(-1)], axis=-1)
+    return torch.from_numpy(uv)
+
+
 class Front3D_Recon_Dataset(Dataset):
     def __init__(self, config, mode):
         super(Front3D_Recon_Dataset, self).__init__()
@@ -40,6 +59,8 @@ class Front3D_Recon_Dataset(Dataset):
         self.mask_filter = self.config['data']['mask_filter']
         self.bdb2d_filter = self.config['data']['bdb2d_filter']
         self.soft_pixels = self.config['data']['soft_pixels']
+        # sample pixels and gather their ground truth on the device (see device_sampling.py), not in inference
+        self.device_sampling = self.config['data'].get('device_sampling', False) and self.num_pixels != -1
         self.use_depth_prior = self.config['model']['latent_feature']['encoder']['use_depthStream']
         if mode=="train":
             classnames = self.config['data']['train_class_name']
@@ -86,105 +107,226 @@ class Front3D_Recon_Dataset(Dataset):
 
         self.use_cls_encoder = self.config['model']['latent_feature']['use_cls_encoder']
 
+        # packed, memory-mapped shards made by utils/DataProcess/pack_dataset.py
+        self.use_packed = self.config['data'].get('use_packed', False)
+        if self.use_packed:
+            self.packed_store = PackedSampleStore(os.path.join(self.config['data']['packed_path'], mode))
+
+        # columnar annotation index made by utils/DataProcess/build_annotation_index.py, replaces the per-image json
+        self.annotation_index = None
+        if self.config['data'].get('annotation_index_path', None):
+            self.annotation_index = AnnotationIndex(os.path.join(self.config['data']['annotation_index_path'], mode + '.npz'))
+
+        # counters shared by the DataLoader workers, register them here (before workers start)
+        self.metrics = LoaderMetrics()
+
+        # decoded image assets are shared by the objects of the same image, each worker keeps its own LRU cache
+        image_cache_bytes = int(self.config['data'].get('image_cache_mb', 0) * 2**20)
+        self.image_cache = LRUAssetCache(image_cache_bytes, metrics=self.metrics, name='image_cache')
+
+        # decoded gt sdf volumes shared by all workers of the node, deduplicated by model
+        self.sdf_pool = None
+        if self.use_sdf and not self.use_packed and self.config['data'].get('sdf_pool_dir', None):
+            self.sdf_pool = SDFVolumePool(self.config['data']['sdf_pool_dir'], self.config['data']['sdf_path'],
+                                          int(self.config['data'].get('sdf_pool_mb', 4096) * 2**20), metrics=self.metrics)
+
+        if self.add_bdb3d_points:
+            self.metrics.register('surface_index_scan')         # models without a precomputed surface index
+
         if self.use_depth_prior:
-            self.depth_prior_path = 'depth_anything/'
-            self.depth_prior = None
+            self.depth_prior_store = DepthPriorStore(self.config['data'].get('depth_prior_path', 'depth_anything'), self.img_res,
+                                                     missing=self.config['data'].get('depth_prior_missing', 'error'), metrics=self.metrics)
+
+        # load_dynamic False: load all images and sdf volumes of the split into memory now
+        self.load_dynamic = self.config['data']['load_dynamic']
+        if not self.load_dynamic:
+            self.preload(num_threads=self.config['data'].get('preload_threads', 8))
 
     def __len__(self):
         return len(self.split)
 
-    def __getitem__(self, index):
-        imgid, objid, cname = self.split[index]
+    def load_sequence(self, imgid):
+        """
+        load annotation and image assets of an image
+        :return sequence, annotation dict with 'rgb_img' [C, H, W], 'all_mask' [H, W, 2], 'vis_mask' [H, W], 'depth' [H, W], 'normal' [H, W, 3]
+        """
+        if self.use_packed:
+            sequence = dict(self.packed_store.get_annotation(imgid))
+            fields = ['rgb', 'mask']
+            if self.vis_mask_loss:
+                fields.append('segm')
+            if self.use_depth:
+                fields.append('depth')
+            if self.use_normal:
+                fields.append('normal')
+            arrays = self.packed_store.get_image(imgid, fields)             # read-only views of the memory map
 
-        if self.use_depth_prior:
-            # img_name = imgid.split('/')[-1]
-            file_name = os.path.splitext(os.path.basename(imgid))[0] + '_pred.npy'  # 生成完整的文件名
-            file_path = os.path.join(self.depth_prior_path, file_name)  # 生成文件路径
-            if os.path.exists(file_path):       # 加载 .npy 文件
-                np_data = np.load(file_path)
-                torch_data = torch.from_numpy(np_data).float() # 将 numpy 数组转换为 torch 张量
-                self.depth_prior = torch_data     # torch.Size([484, 648])
-            else:
-                print(f"File {file_name} does not exist in the folder.")
-            
+            sequence['rgb_img'] = skimage.img_as_float32(arrays['rgb']).transpose(2, 0, 1)       # [C, H, W], same as load_rgb
+            sequence['all_mask'] = arrays['mask']
+            if self.vis_mask_loss:
+                sequence['vis_mask'] = arrays['segm']
+            if self.use_depth:
+                sequence['depth'] = arrays['depth']
+            if self.use_normal:
+                sequence['normal'] = arrays['normal']
+            return sequence
 
-        if self.config['data']['load_dynamic'] == True:
-            img_path = os.path.join(self.config['data']['data_path'], imgid)
-            post_fix = img_path.split('.')[-1]      # avoid '.png' '.jpg' '.jpeg'
-            img_np = load_rgb(img_path)         # load image
+        img_path = os.path.join(self.config['data']['data_path'], imgid)
+        post_fix = img_path.split('.')[-1]      # avoid '.png' '.jpg' '.jpeg'
+        img_np = load_rgb(img_path)         # load image
 
+        if self.annotation_index is not None:
+            sequence = {}                       # camera and object annotations come from the annotation index
+        else:
             anno_path = img_path.replace('rgb', 'annotation').replace(f'.{post_fix}', '.json')
             with open(anno_path, 'r') as f:
-                sequence = json.load(f)             # load annotation
-            
-            sequence['rgb_img'] = img_np
-
-            # load mask
-            mask_path = img_path.replace('rgb', 'mask').replace(f'.{post_fix}', '.npy.gz')           
-            with gzip.GzipFile(mask_path, 'r') as f:
-                segm = np.load(f)                   # load full mask, later this is mask predicted by 2D mask branch
-            _, height, width = img_np.shape     # [C, H, W]
-            segm = segm[100:100+height, 100:100+width, :]       # axis = 0 is height, axis = 1 is width
-            sequence['all_mask'] = segm             # all objects mask
-
-            if self.vis_mask_loss:          # load visible mask
-                vis_mask_path = img_path.replace('rgb', 'segm').replace(f'.{post_fix}', '.npy.gz')
-                with gzip.GzipFile(vis_mask_path, 'r') as f:
-                    vis_mask = np.load(f)
-                sequence['vis_mask'] = vis_mask
+                sequence = json.load(f)         # load annotation
+        
+        sequence['rgb_img'] = img_np
+
+        # load mask
+        mask_path = img_path.replace('rgb', 'mask').replace(f'.{post_fix}', '.npy.gz')           
+        with gzip.GzipFile(mask_path, 'r') as f:
+            segm = np.load(f)                   # load full mask, later this is mask predicted by 2D mask branch
+        _, height, width = img_np.shape     # [C, H, W]
+        segm = segm[100:100+height, 100:100+width, :]       # axis = 0 is height, axis = 1 is width
+        sequence['all_mask'] = segm             # all objects mask
+
+        if self.vis_mask_loss:          # load visible mask
+            vis_mask_path = img_path.replace('rgb', 'segm').replace(f'.{post_fix}', '.npy.gz')
+            with gzip.GzipFile(vis_mask_path, 'r') as f:
+                vis_mask = np.load(f)
+            sequence['vis_mask'] = vis_mask
 
-            if self.use_depth:
-                # load depth
-                depth_path = img_path.replace('rgb', 'depth').replace(f'.{post_fix}', '.npy.gz')
-                with gzip.GzipFile(depth_path, 'r') as f:
-                    depth = np.load(f)
-                sequence['depth'] = depth
+        if self.use_depth:
+            # load depth
+            depth_path = img_path.replace('rgb', 'depth').replace(f'.{post_fix}', '.npy.gz')
+            with gzip.GzipFile(depth_path, 'r') as f:
+                depth = np.load(f)
+            sequence['depth'] = depth
 
-            if self.use_normal:
-                # load normal
-                normal_path = img_path.replace('rgb', 'normal').replace(f'.{post_fix}', '.npy.gz')
-                with gzip.GzipFile(normal_path, 'r') as f:
-                    normal = np.load(f)
-                sequence['normal'] = normal
+        if self.use_normal:
+            # load normal
+            normal_path = img_path.replace('rgb', 'normal').replace(f'.{post_fix}', '.npy.gz')
+            with gzip.GzipFile(normal_path, 'r') as f:
+                normal = np.load(f)
+            sequence['normal'] = normal
+
+        return sequence
+
+    def preload(self, num_threads=8):
+        """
+        load the image assets (anno_dict, imgid -> sequence) and gt sdf volumes (sdf_dict, (cname, jid) -> (voxels, spacing_dic))
+        of the split into memory, DataLoader workers share them copy-on-write
+        """
+        imgids = list(OrderedDict.fromkeys(item[0] for item in self.split))
+
+        def load_image(imgid):
+            sequence = self.load_sequence(imgid)
+            all_mask = sequence['all_mask']
+            if all_mask.dtype == np.float64 and np.array_equal(all_mask, all_mask.astype(np.int32)):
+                sequence['all_mask'] = all_mask.astype(np.int32)           # semantic ids are stored as float64
+            return sequence
+
+        self.anno_dict = {}
+        self.sdf_dict = {}
+        self.surface_dict = {}
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:        # gzip and image decoding release the GIL
+            for imgid, sequence in zip(imgids, tqdm(pool.map(load_image, imgids), total=len(imgids), desc=f'preload {self.mode} images')):
+                self.anno_dict[imgid] = sequence
 
-            cid = category_label_mapping[cname]
-            
+            if self.use_sdf:
+                models = list(OrderedDict.fromkeys(
+                    (cname, self.load_annotation(self.anno_dict[imgid], imgid, objid)['model_file_name']) for imgid, objid, cname in self.split))
+                for model, sdf in zip(models, tqdm(pool.map(lambda model: self.load_sdf(*model), models), total=len(models), desc=f'preload {self.mode} sdf')):
+                    self.sdf_dict[model] = sdf
+
+        if self.add_bdb3d_points and self.use_surface_points:
+            for (cname, jid), (voxels, _) in self.sdf_dict.items():
+                self.surface_dict[(cname, jid)] = self.load_surface_index(cname, jid, voxels)
+
+        image_bytes = sum(asset_nbytes(sequence) for sequence in self.anno_dict.values())
+        sdf_bytes = sum(voxels.nbytes for voxels, _ in self.sdf_dict.values()) + sum(index.nbytes for index in self.surface_dict.values())
+        print(f'preload {self.mode}: {len(self.anno_dict)} images {image_bytes / 2**20:.1f} MB, '
+              f'{len(self.sdf_dict)} sdf volumes {sdf_bytes / 2**20:.1f} MB')
+
+    def load_annotation(self, sequence, imgid, objid):
+        """
+        camera and object annotations of an object, from the columnar annotation index or the image json annotation
+        :return dict, see annotation_index.annotation_fields
+        """
+        if self.annotation_index is not None:
+            return self.annotation_index.get(imgid, objid)
+        return annotation_fields(sequence, objid)
+
+    def load_sdf(self, cname, jid):
+        """
+        load gt sdf volume of a model
+        :return voxels [R, R, R], spacing_centroid dict
+        """
+        if self.use_packed:
+            voxels, spacing_dic = self.packed_store.get_sdf(cname, jid)
+            return np.array(voxels), spacing_dic            # copy out of the memory map, it goes into the batch
+
+        if self.sdf_pool is not None:
+            voxels, spacing_dic = self.sdf_pool.get(cname, jid)
+            return np.array(voxels), spacing_dic
+
+        return read_sdf_assets(self.config['data']['sdf_path'], cname, jid)
+
+    def load_surface_index(self, cname, jid, voxels):
+        """
+        near-surface voxel indices of a model, packed or precomputed by utils/DataProcess/build_surface_index.py,
+        otherwise scan the gt sdf volume
+        :return [N, 3] voxel indices
+        """
+        if not self.load_dynamic and (cname, jid) in self.surface_dict:
+            return self.surface_dict[(cname, jid)]
+
+        if self.use_packed:
+            surface_index = self.packed_store.get_surface_index(cname, jid)
         else:
-            sequence = self.anno_dict[imgid]
+            surface_index = read_surface_index(self.config['data']['sdf_path'], cname, jid)
 
-            if self.use_sdf:
-                jid = sequence['obj_dict'][objid]['model_file_name'][0]        # ['xxxxxxxxx'], a list
-                cid = self.cid_dict[jid]
+        if surface_index is None:
+            self.metrics.add('surface_index_scan')
+            surface_index = surface_voxel_index(voxels)
+        return surface_index
+
+    def __getitem__(self, index):
+        imgid, objid, cname = self.split[index]
+
+        if self.load_dynamic:
+            sequence = self.image_cache.get(imgid, self.load_sequence)       # shared with other objects, do not modify
+        else:
+            sequence = self.anno_dict[imgid]                                # preloaded, do not modify
+        height, width = sequence['rgb_img'].shape[1:]
+        cid = category_label_mapping[cname]
 
         object_ind = objid
+        anno = self.load_annotation(sequence, imgid, object_ind)
 
         # camera pose (from camera to world)
-        camera_pose_tran = np.array(sequence['camera_pose_tran'])
-        camera_pose_rot = np.array(sequence['camera_pose_rot'])
         camera_pose = np.eye(4)
-        camera_pose[0:3, 3] = camera_pose_tran
-        camera_pose[0:3, 0:3] = camera_pose_rot
+        camera_pose[0:3, 3] = anno['camera_pose_tran']
+        camera_pose[0:3, 0:3] = anno['camera_pose_rot']
         
-        camera_intrinsics = np.array(sequence['camera_intrinsics'])
+        camera_intrinsics = anno['camera_intrinsics']
 
         # camera extrinsics (from world to camera)
-        camera_extrinsics_raw = np.array(sequence['camera_extrinsics'])	# ndarray 3*4
         camera_extrinsics = np.eye(4)
-        camera_extrinsics[0:3, :] = camera_extrinsics_raw
+        camera_extrinsics[0:3, :] = anno['camera_extrinsics']     # ndarray 3*4
 
         # an object full mask, obj_id is semantic id in front3d mask map; objid is object index in this image
-        obj_id = sequence['obj_dict'][object_ind]['obj_id'][0]              # [xxx], a list
+        obj_id = anno['obj_id']
         segm = sequence['all_mask']
-        segm_index = np.argwhere(segm == obj_id)
-        px = [index[0] for index in segm_index]                 # height    uv[1]
-        py = [index[1] for index in segm_index]                 # width     uv[0]
-        obj_map = np.zeros((height, width), dtype=np.uint8)
-        obj_map[px, py] = 1
+        obj_mask = segm == obj_id                               # [H, W, L], L mask layers
+        segm_index = np.argwhere(obj_mask)
+        px = segm_index[:, 0]                                   # height    uv[1]
+        py = segm_index[:, 1]                                   # width     uv[0]
+        obj_map = obj_mask.any(axis=-1).astype(np.uint8)        # [H, W]
 
-        height, width, _ = segm.shape
-        full_mask_array = np.zeros(height*width, dtype=bool)         # [H*W, ]
-        for full_index in segm_index:
-            full_mask_array[full_index[0]*width + full_index[1]] = True
+        full_mask_array = obj_map.reshape(-1).astype(bool)      # [H*W, ]
 
         # full bbox (get from full mask)
         xmin, xmax = int(np.min(py)), int(np.max(py))
@@ -193,19 +335,15 @@ class Front3D_Recon_Dataset(Dataset):
 
         if self.vis_mask_loss:
             vis_mask = sequence['vis_mask']                 # [H, W]
-            height, width = vis_mask.shape
-            vis_mask_array = np.zeros(height*width, dtype=bool)         # [H*W, ]
-            vis_mask_index = np.argwhere(vis_mask == obj_id)
-            for index in vis_mask_index:
-                vis_mask_array[index[0]*width + index[1]] = True
+            vis_mask_array = (vis_mask == obj_id).reshape(-1)           # [H*W, ]
 
         # load 2D bbox, 3D bdb
         bdb_2d = np.array(full_bbox_2d)
-        bdb_3d = np.array(sequence['obj_dict'][object_ind]['bbox3d_world'])
-        bdb_3d_center = np.array(sequence['obj_dict'][object_ind]['bbox3d_world_center'])
-        half_length = np.array(sequence['obj_dict'][object_ind]['half_length'])
-        obj_rot = np.array(sequence['obj_dict'][object_ind]['obj_rot'])
-        obj_tran = np.array(sequence['obj_dict'][object_ind]['obj_tran'])               # obj_tran is different with bdb_3d_center
+        bdb_3d = anno['bbox3d_world']
+        bdb_3d_center = anno['bbox3d_world_center']
+        half_length = anno['half_length']
+        obj_rot = anno['obj_rot']
+        obj_tran = anno['obj_tran']               # obj_tran is different with bdb_3d_center
         
         obj_to_world = np.eye(4)
         obj_to_world[0:3, 0:3] = obj_rot
@@ -213,35 +351,31 @@ class Front3D_Recon_Dataset(Dataset):
         world_to_obj = np.linalg.inv(obj_to_world)          # from world coords to obj coords
 
         # set sample bound according to bbox3d_camera 
-        bdb_3d_camera = np.array(sequence['obj_dict'][object_ind]['bbox3d_camera'])
+        bdb_3d_camera = anno['bbox3d_camera']
 
         if self.use_sdf:
             # load object SDF
-            jid = sequence['obj_dict'][object_ind]['model_file_name'][0]        # ['xxxxxxxxx'], a list
-            scene_scale = np.array(sequence['obj_dict'][object_ind]['obj_scale'])
+            jid = anno['model_file_name']
+            scene_scale = anno['obj_scale']
             # scale_name = format(scale[0], '.6f') + '_' + format(scale[1], '.6f') + '_' + format(scale[2], '.6f')
         
-            if self.config['data']['load_dynamic'] == True:
-                spacing_path = os.path.join(self.config['data']['sdf_path'], cname, jid, 'spacing_centroid.json')
-                sdf_path = os.path.join(self.config['data']['sdf_path'], cname, jid, 'voxels.npy.gz')
-                with open(spacing_path, 'r') as f:
-                    spacing_dic = json.load(f)
-                spacing = np.array(spacing_dic['spacing'])
-                padding = float(spacing_dic['padding'])
-                centroid = np.array(spacing_dic['centroid'])
-                voxel_range = np.array([1.0, 1.0, 1.0])                          # voxel_range include padding : voxel_range is the range of voxel after none_equal_scale coords transfer
-                none_equal_scale = np.array(spacing_dic['none_equal_scale'])     # none_equal_scale = (2 - padding) / mesh.bounding_box.extents
-                with gzip.GzipFile(sdf_path, 'r') as f:
-                    voxels = np.load(f)                             # [R, R, R]
-
+            if self.load_dynamic:
+                voxels, spacing_dic = self.load_sdf(cname, jid)
             else:
-                raise ValueError('Not support load static sdf now!')
+                voxels, spacing_dic = self.sdf_dict[(cname, jid)]          # preloaded, do not modify
+            spacing = np.array(spacing_dic['spacing'])
+            padding = float(spacing_dic['padding'])
+            centroid = np.array(spacing_dic['centroid'])
+            voxel_range = np.array([1.0, 1.0, 1.0])                          # voxel_range include padding : voxel_range is the range of voxel after none_equal_scale coords transfer
+            none_equal_scale = np.array(spacing_dic['none_equal_scale'])     # none_equal_scale = (2 - padding) / mesh.bounding_box.extents
 
 
         # !!! numpy array index is different with image uv coordinate 
+        sample_window = [0, 0, self.img_res[1], self.img_res[0]]           # [xmin, ymin, xmax, ymax], xmax and ymax excluded
         if self.mask_filter:
-            uv = torch.from_numpy(np.array([py, px])).transpose(1, 0)
-            real_total_pixels = uv.shape[0]
+            if not self.device_sampling:
+                uv = torch.from_numpy(np.array([py, px])).transpose(1, 0)
+                real_total_pixels = uv.shape[0]
             
         else:
             if self.bdb2d_filter:
@@ -251,19 +385,17 @@ class Front3D_Recon_Dataset(Dataset):
                 xmax = min(xmax+self.soft_pixels, self.img_res[1])
                 ymin = max(ymin-self.soft_pixels, 0)
                 ymax = min(ymax+self.soft_pixels, self.img_res[0])
-                uv = np.mgrid[ymin:ymax, xmin:xmax].astype(np.int32)
-                uv = torch.from_numpy(np.flip(uv, axis=0).copy())           # flip
-                uv = uv.reshape(2, -1).transpose(1, 0)                      # uv [x, y] x->img_W, y->img_H
-                real_total_pixels = uv.shape[0]
+                sample_window = [xmin, ymin, xmax, ymax]
+                if not self.device_sampling:
+                    uv = pixel_grid(ymin, ymax, xmin, xmax)                 # uv [x, y] x->img_W, y->img_H
+                    real_total_pixels = uv.shape[0]
 
-            else:
-                uv = np.mgrid[0:self.img_res[0], 0:self.img_res[1]].astype(np.int32)
-                uv = torch.from_numpy(np.flip(uv, axis=0).copy())
-                uv = uv.reshape(2, -1).transpose(1, 0)                          # uv [x, y] x->img_W, y->img_H
+            elif not self.device_sampling:
+                uv = pixel_grid(0, self.img_res[0], 0, self.img_res[1])     # uv [x, y] x->img_W, y->img_H
                 real_total_pixels = self.total_pixels
 
         # sample pixels
-        if self.num_pixels != -1:       # -1 represent not sampler in inference
+        if self.num_pixels != -1 and not self.device_sampling:       # -1 represent not sampler in inference
             if real_total_pixels < self.num_pixels:             # mask pixels less than num_pixels
                 sampling_idx = torch.randperm(real_total_pixels)
                 for i in range((self.num_pixels-1)//real_total_pixels):
@@ -278,17 +410,8 @@ class Front3D_Recon_Dataset(Dataset):
         image = sequence['rgb_img']             # [C, H, W]
         _, height, width = image.shape
 
-        uv_sampling_idx = torch.tensor([xy[1]*width+xy[0] for xy in uv])              # img_H * W + img_W
-
-        # width, height = image.size
-        image_gt = copy.deepcopy(image)         # for calculate loss
-        image_gt = image_gt.reshape(3, -1).transpose(1, 0)
-        image_gt = image_gt[uv_sampling_idx]
-
-
         # ground_truth.image for calculate loss
         ground_truth = {
-            'rgb': image_gt,
             'mask': obj_map,
             'bdb_2d': bdb_2d,
             'bdb_3d': bdb_3d,
@@ -303,12 +426,26 @@ class Front3D_Recon_Dataset(Dataset):
             'cname': str(cname)
         }
 
-        if self.vis_mask_loss:
-            vis_pixel = vis_mask_array[uv_sampling_idx]
-            ground_truth['vis_pixel'] = torch.tensor(vis_pixel)
+        if self.device_sampling:
+            # dense maps, sampled on the device by sample_batch_pixels
+            if self.vis_mask_loss:
+                ground_truth['vis_mask_map'] = torch.from_numpy(vis_mask_array.reshape(height, width))
+            if self.use_depth:
+                ground_truth['depth_map'] = sequence['depth'].reshape(height, width)
+            if self.use_normal:
+                ground_truth['normal_map'] = sequence['normal'].reshape(height, width, 3)
+        else:
+            uv_sampling_idx = (uv[:, 1].long() * width + uv[:, 0].long()).numpy()          # img_H * W + img_W
 
-        full_mask_pixel = full_mask_array[uv_sampling_idx]
-        ground_truth['full_mask_pixel'] = torch.tensor(full_mask_pixel)
+            image_gt = image.reshape(3, -1).transpose(1, 0)
+            ground_truth['rgb'] = image_gt[uv_sampling_idx]                 # for calculate loss
+
+            if self.vis_mask_loss:
+                vis_pixel = vis_mask_array[uv_sampling_idx]
+                ground_truth['vis_pixel'] = torch.from_numpy(vis_pixel)
+
+            full_mask_pixel = full_mask_array[uv_sampling_idx]
+            ground_truth['full_mask_pixel'] = torch.from_numpy(full_mask_pixel)
 
         if self.use_instance_mask:
             crop_mask = obj_map[ymin:ymax, xmin:xmax]       # [H, W], y --> img_H, x --> img_W
@@ -316,20 +453,19 @@ class Front3D_Recon_Dataset(Dataset):
 
             ground_truth['instance_mask'] = crop_mask
 
-        if self.use_depth:
-            depth_gt = copy.deepcopy(sequence['depth'])         # [H, W]
-            depth_gt = depth_gt.reshape(-1, 1)                  
-            depth_gt = depth_gt[uv_sampling_idx]
+        if self.use_depth and not self.device_sampling:
+            depth_gt = sequence['depth'].reshape(-1, 1)         # [H*W, 1]
+            depth_gt = depth_gt[uv_sampling_idx]                # fancy index copies only the sampled pixels
             # modify error depth (cause: mask edge near to window)
-            depth_error_idx = np.argwhere(depth_gt > 1000)
-            depth_gt[depth_error_idx] = -1
-            depth_gt[depth_error_idx] = max(depth_gt)       # modify to maximum
+            # only the error pixels, np.argwhere on the [N, 1] array also hit sampled pixel 0 (column index 0 used as a row)
+            depth_error = depth_gt > 1000
+            depth_gt[depth_error] = -1
+            depth_gt[depth_error] = depth_gt.max()              # modify to maximum
 
             ground_truth['depth'] = depth_gt
 
-        if self.use_normal:
-            normal_gt = copy.deepcopy(sequence['normal'])       # [H, W, 3]
-            normal_gt = normal_gt.reshape(-1, 3)
+        if self.use_normal and not self.device_sampling:
+            normal_gt = sequence['normal'].reshape(-1, 3)       # [H*W, 3]
             normal_gt = normal_gt[uv_sampling_idx]
 
             ground_truth['normal'] = normal_gt * 2.0 - 1.0      # [0, 1] --> [-1, 1]
@@ -342,11 +478,11 @@ class Front3D_Recon_Dataset(Dataset):
             ground_truth['voxel_range'] = voxel_range
             ground_truth['none_equal_scale'] = none_equal_scale             # model scale to cube
             ground_truth['scene_scale'] = scene_scale                       # model in different scene, may have different scene scale
+            ground_truth['jid'] = jid                                       # model of the gt sdf, key of the gt mesh cache
 
         # sample.image for extractor image feature
         sample = {
             "image": image,                     # [C, H, W]
-            "uv": uv,
             "intrinsics": camera_intrinsics,
             "pose": camera_pose,
             "extrinsics": camera_extrinsics,
@@ -358,9 +494,13 @@ class Front3D_Recon_Dataset(Dataset):
             'scene_scale': scene_scale,
             'voxel_range': voxel_range,
         }
+        if self.device_sampling:
+            sample['sample_window'] = torch.tensor(sample_window, dtype=torch.int32)
+        else:
+            sample['uv'] = uv
 
         if self.use_depth_prior:
-            sample["depth_prior"] = self.depth_prior
+            sample["depth_prior"] = self.depth_prior_store.get(imgid)          # [H, W]
 
         # add bdb3d world points
         if self.add_bdb3d_points:
@@ -368,25 +508,26 @@ class Front3D_Recon_Dataset(Dataset):
             addpoints_total = self.total_add_points             
             
             if self.use_surface_points:         # add object surface points
-                voxel_index = np.argwhere((voxels < 0.1) & (voxels > -0.1))
-                surface_points = voxel_index2obj_coordinate(voxel_index, centroid, voxel_range, spacing, none_equal_scale)            # [N, 3], in model object coords
-                surface_points = surface_points * scene_scale                                                       # [N, 3], in scene object coords
-                surface_sample_count = surface_points.shape[0]
-                points = surface_points + np.random.normal(scale=0.0025, size=(surface_sample_count, 3))
+                voxel_index = self.load_surface_index(cname, jid, voxels)        # [N, 3], near-surface voxel indices
+                surface_sample_count = voxel_index.shape[0]
 
             else:                               # random add object bdb3d points
                 raise ValueError('not use surface points')
 
-            if points.shape[0] < addpoints_total:
-                add_points_sampling_idx = np.random.permutation(points.shape[0])
-                for i in range((addpoints_total-1)//points.shape[0]):
-                    add_sample_num = min(points.shape[0], addpoints_total-add_points_sampling_idx.shape[0])
-                    temp_add_sample_idx = np.random.permutation(points.shape[0])[:add_sample_num]
+            # sample voxel indices first, then only the sampled points are converted
+            if surface_sample_count < addpoints_total:
+                add_points_sampling_idx = np.random.permutation(surface_sample_count)
+                for i in range((addpoints_total-1)//surface_sample_count):
+                    add_sample_num = min(surface_sample_count, addpoints_total-add_points_sampling_idx.shape[0])
+                    temp_add_sample_idx = np.random.permutation(surface_sample_count)[:add_sample_num]
                     add_points_sampling_idx = np.concatenate((add_points_sampling_idx, temp_add_sample_idx), axis=0)
             else:
-                add_points_sampling_idx = np.random.permutation(points.shape[0])[:addpoints_total]    
+                add_points_sampling_idx = np.random.permutation(surface_sample_count)[:addpoints_total]    
 
-            add_points_flat = points[add_points_sampling_idx]                           # in scene object coords
+            voxel_index = voxel_index[add_points_sampling_idx]
+            surface_points = voxel_index2obj_coordinate(voxel_index, centroid, voxel_range, spacing, none_equal_scale)            # [N, 3], in model object coords
+            surface_points = surface_points * scene_scale                                                       # [N, 3], in scene object coords
+            add_points_flat = surface_points + np.random.normal(scale=0.0025, size=(surface_points.shape[0], 3))      # in scene object coords
             # transfer to world coords
             add_points_world_flat = obj2world_numpy(add_points_flat, obj_rot, obj_tran)
             add_points_world = add_points_world_flat.reshape(100, addpoints_total // 100, 3)     # (100, addpoints_total // 100, 3), similar to ray 
@@ -418,12 +559,34 @@ def worker_init_fn(worker_id):
 
 def Front3D_Recon_dataloader(config, mode='train'):
     batch_size = config['data']['batch_size'][mode]
-    
+    dataset = Front3D_Recon_Dataset(config, mode)
+
+    collate_fn = None
+    if config['data'].get('image_grouped_collate', False):
+        # image and depth prior once per unique image, DataParallel would split them and image_index differently
+        if len(str(config['device']['gpu_ids']).split(',')) > 1:
+            raise ValueError('image_grouped_collate does not support multi-gpu DataParallel, use one gpu')
+        collate_fn = image_grouped_collate
+
+    if config['data'].get('group_by_image', False):
+        # objects of an image go to the same worker, its image cache decodes the image once
+        batch_sampler = ImageGroupedBatchSampler(dataset.split, batch_size, num_workers=config['data']['num_workers'], shuffle=(mode == 'train'))
+        dataloader = DataLoader(
+            dataset=dataset,
+            num_workers=config['data']['num_workers'],
+            batch_sampler=batch_sampler,
+            collate_fn=collate_fn,
+            worker_init_fn=worker_init_fn,
+            pin_memory=True
+        )
+        return dataloader
+
     dataloader = DataLoader(
-        dataset=Front3D_Recon_Dataset(config, mode),
+        dataset=dataset,
         num_workers=config['data']['num_workers'],
         batch_size=batch_size,
         shuffle=(mode == 'train'),
+        collate_fn=collate_fn,
         worker_init_fn=worker_init_fn,
         pin_memory=True
     )
@@ -0,0 +1,126 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import numpy as np
+import json
+import torch
+from tqdm import tqdm
+
+
+DEPTH_PRIOR_VERSION = 1
+DEPTH_PRIOR_SUFFIX = '_pred.npy'
+MISSING_POLICIES = ['error', 'zeros']
+
+
+def depth_prior_key(imgid):
+    """
+    depth anything prior of 'xxx/rgb/000643_rgb_003267.jpeg' is '000643_rgb_003267_pred.npy'
+    """
+    return os.path.splitext(os.path.basename(imgid))[0]
+
+
+def pack_depth_priors(prior_dir, imgids, out_dir, dtype=None):
+    """
+    pack the depth priors of images into one flat binary file with an index, see DepthPriorStore
+    :params dtype, storage dtype, e.g. 'float16' for float priors, None keeps the dtype of the .npy files
+    :return index dict
+    """
+    keys = sorted(set(depth_prior_key(imgid) for imgid in imgids))
+    os.makedirs(out_dir, exist_ok=True)
+
+    index = {'version': DEPTH_PRIOR_VERSION, 'dtype': None, 'shape': None, 'images': {}, 'missing': []}
+    with open(os.path.join(out_dir, 'depth_prior.bin'), 'wb') as writer:
+        for key in tqdm(keys, desc='pack depth prior'):
+            prior_path = os.path.join(prior_dir, key + DEPTH_PRIOR_SUFFIX)
+            if not os.path.exists(prior_path):
+                index['missing'].append(key)
+                continue
+            prior = np.load(prior_path)
+            if dtype is not None:
+                prior = prior.astype(dtype)
+            prior = np.ascontiguousarray(prior)
+            if index['shape'] is None:
+                index['dtype'], index['shape'] = prior.dtype.str, list(prior.shape)
+            elif prior.dtype.str != index['dtype'] or list(prior.shape) != index['shape']:
+                raise ValueError(f'depth prior {prior_path} is {prior.dtype} {prior.shape}, others are {index["dtype"]} {index["shape"]}')
+            index['images'][key] = writer.tell()
+            writer.write(prior.tobytes())
+
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+class DepthPriorStore(object):
+    """
+    Depth prior lookup by image id.
+    root is either a directory of <image name>_pred.npy files (indexed once at construction and read with mmap),
+    or a pack made by utils/DataProcess/pack_depth_prior.py (one memory-mapped file, mapped lazily after workers fork).
+    :params missing, 'error' raises when an image has no prior, 'zeros' returns a zero prior of shape img_res
+    :params metrics, LoaderMetrics, count 'depth_prior_lookup' and 'depth_prior_missing'
+    """
+    def __init__(self, root, img_res, missing='error', metrics=None):
+        if missing not in MISSING_POLICIES:
+            raise ValueError(f'depth prior missing policy {missing} is not in {MISSING_POLICIES}')
+        self.root = root
+        self.img_res = list(img_res)
+        self.missing = missing
+        self.metrics = metrics
+        if self.metrics is not None:
+            self.metrics.register('depth_prior_lookup')
+            self.metrics.register('depth_prior_missing')
+
+        index_path = os.path.join(root, 'index.json')
+        self.packed = os.path.exists(index_path)
+        if self.packed:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if index['version'] != DEPTH_PRIOR_VERSION:
+                raise ValueError(f'depth prior pack version {index["version"]} is not supported, please repack')
+            self.dtype = np.dtype(index['dtype']) if index['dtype'] is not None else None
+            self.shape = index['shape']
+            self.offsets = index['images']
+            self._mmap = None
+        elif os.path.isdir(root):
+            self.paths = {}
+            for entry in os.scandir(root):
+                if entry.name.endswith(DEPTH_PRIOR_SUFFIX):
+                    self.paths[entry.name[:-len(DEPTH_PRIOR_SUFFIX)]] = entry.path
+        else:
+            raise FileNotFoundError(f'depth prior {root} not found')
+
+    def __len__(self):
+        return len(self.offsets) if self.packed else len(self.paths)
+
+    def __contains__(self, imgid):
+        return self._has(depth_prior_key(imgid))
+
+    def _has(self, key):
+        return key in (self.offsets if self.packed else self.paths)
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.add(name)
+
+    def _read(self, key):
+        if self.packed:
+            if self._mmap is None:
+                self._mmap = np.memmap(os.path.join(self.root, 'depth_prior.bin'), dtype=np.uint8, mode='r')
+            count = int(np.prod(self.shape))
+            return np.frombuffer(self._mmap, dtype=self.dtype, count=count, offset=self.offsets[key]).reshape(self.shape)
+        return np.load(self.paths[key], mmap_mode='r')
+
+    def get(self, imgid):
+        """
+        :return depth prior, float32 tensor [H, W]
+        """
+        self._count('depth_prior_lookup')
+        key = depth_prior_key(imgid)
+        if not self._has(key):
+            self._count('depth_prior_missing')
+            if self.missing == 'error':
+                raise FileNotFoundError(f'depth prior of {imgid} ({key}{DEPTH_PRIOR_SUFFIX}) does not exist in {self.root}')
+            return torch.zeros(self.img_res, dtype=torch.float32)
+
+        return torch.from_numpy(np.array(self._read(key), dtype=np.float32))         # copy out of the mmap
@@ -0,0 +1,91 @@
+import torch
+
+
+def sample_pixel_index(valid, num_pixels, generator=None):
+    """
+    draw num_pixels valid pixels of every image in one batched op, without replacement while there are enough
+    valid pixels, otherwise the valid pixels are repeated (the same as the loader's randperm sampling)
+    :params valid, [B, H*W] bool, candidate pixels
+    :return flat pixel index [B, num_pixels], long
+    """
+    keys = torch.rand(valid.shape, device=valid.device, generator=generator)
+    keys = keys.masked_fill(~valid, 2.0)                                     # invalid pixels sort last
+    sampling_idx = torch.topk(keys, num_pixels, dim=1, largest=False, sorted=True).indices      # [B, num_pixels]
+
+    # fewer valid pixels than num_pixels: cycle over the valid ones
+    valid_count = valid.sum(dim=1, keepdim=True).clamp(min=1)                 # [B, 1]
+    position = torch.arange(num_pixels, device=valid.device).unsqueeze(0)     # [1, num_pixels]
+    return torch.gather(sampling_idx, 1, position % valid_count)
+
+
+def window_mask(window, height, width):
+    """
+    :params window, [B, 4] (xmin, ymin, xmax, ymax), xmax and ymax excluded
+    :return [B, H*W] bool
+    """
+    device = window.device
+    ys = torch.arange(height, device=device).view(1, height, 1)
+    xs = torch.arange(width, device=device).view(1, 1, width)
+    xmin, ymin, xmax, ymax = [window[:, i].view(-1, 1, 1) for i in range(4)]
+    valid = (xs >= xmin) & (xs < xmax) & (ys >= ymin) & (ys < ymax)          # [B, H, W]
+    return valid.reshape(window.shape[0], -1)
+
+
+def gather_pixels(dense, pixel_index):
+    """
+    :params dense, [B, H*W, C]
+    :params pixel_index, [B, N]
+    :return [B, N, C]
+    """
+    return torch.gather(dense, 1, pixel_index.unsqueeze(-1).expand(-1, -1, dense.shape[-1]))
+
+
+def sample_batch_pixels(model_input, ground_truth, num_pixels, mask_filter=False, generator=None):
+    """
+    device-side pixel sampling and ground truth gathering of a batch loaded with data.device_sampling,
+    fills model_input['uv'] and ground_truth 'rgb', 'full_mask_pixel', 'vis_pixel', 'depth', 'normal'
+    the same as the loader does on cpu
+    :params mask_filter, sample in the object full mask, otherwise in model_input['sample_window']
+    """
+    image = model_input['image']                                    # [B, 3, H, W], image-grouped batch [U, 3, H, W]
+    device = image.device
+    image_index = model_input.get('image_index', None)
+    if image_index is not None:
+        image_index = image_index.to(device)
+
+    def per_object(dense):                                          # per-image dense maps of an image-grouped batch to per object
+        dense = dense.to(device)
+        return dense if image_index is None else dense[image_index]
+
+    image = per_object(image)
+    batch_size, _, height, width = image.shape
+
+    full_mask = ground_truth['mask'].to(device).reshape(batch_size, -1).bool()     # [B, H*W]
+    if mask_filter:
+        valid = full_mask
+    else:
+        valid = window_mask(model_input['sample_window'].to(device), height, width)
+    pixel_index = sample_pixel_index(valid, num_pixels, generator=generator)      # [B, N]
+
+    uv = torch.stack([pixel_index % width, torch.div(pixel_index, width, rounding_mode='floor')], dim=-1)     # uv [x, y] x->img_W, y->img_H
+    model_input['uv'] = uv.to(torch.float32)
+
+    ground_truth['rgb'] = gather_pixels(image.reshape(batch_size, 3, -1).transpose(1, 2), pixel_index)     # [B, N, 3]
+    ground_truth['full_mask_pixel'] = torch.gather(full_mask, 1, pixel_index)
+
+    if 'vis_mask_map' in ground_truth:
+        vis_mask = ground_truth['vis_mask_map'].to(device).reshape(batch_size, -1)
+        ground_truth['vis_pixel'] = torch.gather(vis_mask, 1, pixel_index)
+
+    if 'depth_map' in ground_truth:
+        depth = gather_pixels(per_object(ground_truth['depth_map']).reshape(batch_size, -1, 1), pixel_index)    # [B, N, 1]
+        # modify error depth (cause: mask edge near to window)
+        depth_error = depth > 1000
+        depth_max = depth.masked_fill(depth_error, -1).amax(dim=(1, 2), keepdim=True)
+        ground_truth['depth'] = torch.where(depth_error, depth_max, depth)
+
+    if 'normal_map' in ground_truth:
+        normal = gather_pixels(per_object(ground_truth['normal_map']).reshape(batch_size, -1, 3), pixel_index)
+        ground_truth['normal'] = normal * 2.0 - 1.0                # [0, 1] --> [-1, 1]
+
+    return model_input, ground_truth
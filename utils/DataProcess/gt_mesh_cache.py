@@ -0,0 +1,95 @@
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+from utils.model_utils.mesh_writer import write_mesh
+
+# bump when the gt label mesh extraction changes, the old entries are then not addressed anymore
+GT_MESH_VERSION = 1
+
+
+def gt_mesh_key(jid, scene_scale, padding, resolution, extractor='sparse', delta=0.03):
+    """
+    content address of a gt label mesh (label_cube.ply), it depends on the dataset model only, not on the model weights
+    :return sha1 hex key, the key fields
+    """
+    fields = {
+        'version': GT_MESH_VERSION,
+        'jid': str(jid),
+        'scene_scale': [round(float(value), 6) for value in np.reshape(np.asarray(scene_scale, dtype=np.float64), -1)],
+        'padding': round(float(padding), 6),
+        'resolution': int(resolution),
+        'extractor': str(extractor),
+        'delta': round(float(delta), 6),
+    }
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest(), fields
+
+
+def batch_gt_mesh_key(ground_truth, b, resolution, extractor='sparse', delta=0.03):
+    """
+    gt_mesh_key of the b-th object of a test batch
+    """
+    scene_scale = ground_truth['scene_scale'][b]
+    padding = ground_truth['voxel_padding'][b]
+    return gt_mesh_key(ground_truth['jid'][b], np.asarray(scene_scale), float(padding), resolution, extractor, delta)
+
+
+class GTMeshCache(object):
+    """
+    Content-addressed gt label meshes shared by all experiments, cache_dir/<key[:2]>/<key>.ply with the key fields in <key>.json.
+    Built once by utils/DataProcess/build_gt_mesh_cache.py, inference copies the cached mesh instead of extracting it,
+    and caches the meshes it had to extract.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hit = 0
+        self.miss = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.ply')
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def lookup(self, key):
+        """
+        :return path of the cached mesh of key, None if key is not cached
+        """
+        if not self.contains(key):
+            self.miss += 1
+            return None
+        self.hit += 1
+        return self.path(key)
+
+    def get(self, key, dst):
+        """
+        copy the cached mesh of key to dst (through <dst>.part, see write_mesh)
+        :return False if key is not cached
+        """
+        src = self.lookup(key)
+        if src is None:
+            return False
+        write_mesh(src, dst)
+        return True
+
+    def put(self, key, fields, src):
+        """
+        cache the mesh file src under key, the files are renamed into place so other processes never see partial files
+        """
+        mesh_path = self.path(key)
+        fields_path = mesh_path[:-len('.ply')] + '.json'
+        os.makedirs(os.path.dirname(mesh_path), exist_ok=True)
+
+        tmp_suffix = f'.tmp{os.getpid()}'
+        with open(fields_path + tmp_suffix, 'w') as f:
+            json.dump(fields, f)
+        shutil.copyfile(src, mesh_path + tmp_suffix)
+        os.replace(fields_path + tmp_suffix, fields_path)
+        os.replace(mesh_path + tmp_suffix, mesh_path)           # mesh last, its existence marks a complete entry
+
+    def report(self):
+        return f'gt_mesh_cache_hit = {self.hit}, gt_mesh_cache_miss = {self.miss}'
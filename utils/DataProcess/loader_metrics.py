@@ -0,0 +1,55 @@
+import multiprocessing
+from collections import OrderedDict
+
+
+class LoaderMetrics(object):
+    """
+    Counters of the data loading shared by the DataLoader workers.
+    Counters live in shared memory, so they must be registered in the main process
+    (i.e. in the dataset __init__) before the workers start; workers only add to them.
+    Gauges (e.g. resident bytes) are set instead of added and are not cleared by reset.
+    """
+    def __init__(self, names=()):
+        self._counters = OrderedDict()
+        self._gauges = set()
+        for name in names:
+            self.register(name)
+
+    def register(self, name, gauge=False):
+        if name not in self._counters:
+            self._counters[name] = multiprocessing.Value('q', 0)
+        if gauge:
+            self._gauges.add(name)
+
+    def set(self, name, value):
+        counter = self._counters[name]
+        with counter.get_lock():
+            counter.value = int(value)
+
+    def add(self, name, value=1):
+        counter = self._counters[name]
+        with counter.get_lock():
+            counter.value += int(value)
+
+    def snapshot(self):
+        return OrderedDict((name, counter.value) for name, counter in self._counters.items())
+
+    def reset(self):
+        for name, counter in self._counters.items():
+            if name in self._gauges:
+                continue
+            with counter.get_lock():
+                counter.value = 0
+
+    def report(self):
+        """
+        one line summary, xxx_hit / xxx_miss pairs also report the hit rate of xxx
+        """
+        values = self.snapshot()
+        msg = [f'{name} = {value}' for name, value in values.items()]
+        for name in values:
+            if name.endswith('_hit') and name[:-4] + '_miss' in values:
+                lookups = values[name] + values[name[:-4] + '_miss']
+                if lookups > 0:
+                    msg.append(f'{name[:-4]}_hit_rate = {values[name] / lookups:.3f}')
+        return ', '.join(msg)
@@ -0,0 +1,30 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import yaml
+
+from utils.DataProcess.packed_store import pack_split
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('pack FRONT3D split into memory-mapped shards')
+    parser.add_argument('--config', type=str, required=True, help='configure file for training or testing.')
+    parser.add_argument('--mode', type=str, nargs='+', default=['train', 'val', 'test'], help='splits to pack.')
+    parser.add_argument('--out', type=str, default=None, help='output root, default is data.packed_path in config.')
+    parser.add_argument('--images_per_shard', type=int, default=256)
+    parser.add_argument('--num_threads', type=int, default=8)
+    return parser.parse_args()
+
+
+if __name__=="__main__":
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    out_root = args.out if args.out is not None else config['data']['packed_path']
+    for mode in args.mode:
+        out_dir = os.path.join(out_root, mode)
+        index = pack_split(config, mode, out_dir, images_per_shard=args.images_per_shard, num_threads=args.num_threads)
+        print(f'{mode}: packed {len(index["images"])} images and {len(index["models"])} sdf volumes into {out_dir}')
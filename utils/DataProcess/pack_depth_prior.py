@@ -0,0 +1,31 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import yaml
+
+from utils.DataProcess.packed_store import get_split_list
+from utils.DataProcess.depth_prior_store import pack_depth_priors
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('pack depth anything priors into one memory-mapped file')
+    parser.add_argument('--config', type=str, required=True, help='configure file for training or testing.')
+    parser.add_argument('--mode', type=str, nargs='+', default=['train', 'val', 'test'], help='splits whose images are packed.')
+    parser.add_argument('--prior_dir', type=str, default='depth_anything', help='directory of <image name>_pred.npy.')
+    parser.add_argument('--out', type=str, required=True, help='output directory, set it as data.depth_prior_path to use it.')
+    parser.add_argument('--dtype', type=str, default=None, help='storage dtype, e.g. float16 for float priors, default keeps the .npy dtype.')
+    return parser.parse_args()
+
+
+if __name__=="__main__":
+    args = parse_args()
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    imgids = []
+    for mode in args.mode:
+        imgids += [item[0] for item in get_split_list(config, mode)]
+    index = pack_depth_priors(args.prior_dir, imgids, args.out, dtype=args.dtype)
+    print(f'packed {len(index["images"])} depth priors ({index["dtype"]} {index["shape"]}) into {args.out}, {len(index["missing"])} missing')
@@ -0,0 +1,244 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import numpy as np
+import json, gzip
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+
+PACK_VERSION = 1
+IMAGE_FIELDS = ['rgb', 'mask', 'segm', 'depth', 'normal']
+MASK_OFFSET = 100                           # full mask is padded by 100 pixels on each side
+SURFACE_BAND = 0.1                          # near-surface voxels, |sdf| < SURFACE_BAND, sampled by add_bdb3d_points
+SURFACE_INDEX_NAME = 'surface_index.npy'
+
+
+def get_split_list(config, mode):
+    """
+    read the (image, object, class) split list of a mode, the same as Front3D_Recon_Dataset
+    """
+    if mode in ['train', 'val']:
+        classnames = config['data']['train_class_name']             # val is in training time
+    else:
+        classnames = config['data']['test_class_name']
+    if not isinstance(classnames, list):
+        classnames = [classnames]
+
+    split = []
+    for class_name in classnames:
+        split_path = os.path.join(config['data']['split_dir'], config['data']['dataset'], 'split', mode, class_name + ".json")
+        with open(split_path, 'r') as f:
+            split += json.load(f)
+    return split
+
+
+def read_image_assets(data_path, imgid):
+    """
+    decode all per-image assets of a split item from the original (gzip) files
+    :return annotation dict, and arrays dict {'rgb': [H, W, 3] uint8, 'mask': [H, W, 2], 'segm': [H, W], 'depth': [H, W], 'normal': [H, W, 3]}
+    """
+    import imageio
+
+    img_path = os.path.join(data_path, imgid)
+    post_fix = img_path.split('.')[-1]      # avoid '.png' '.jpg' '.jpeg'
+
+    anno_path = img_path.replace('rgb', 'annotation').replace(f'.{post_fix}', '.json')
+    with open(anno_path, 'r') as f:
+        annotation = json.load(f)
+
+    arrays = {}
+    arrays['rgb'] = np.asarray(imageio.imread(img_path))[:, :, :3]         # keep uint8, decoded once
+    height, width, _ = arrays['rgb'].shape
+
+    for field in IMAGE_FIELDS[1:]:
+        field_path = img_path.replace('rgb', field).replace(f'.{post_fix}', '.npy.gz')
+        if not os.path.exists(field_path):
+            continue
+        with gzip.GzipFile(field_path, 'r') as f:
+            array = np.load(f)
+        if field == 'mask':
+            array = array[MASK_OFFSET:MASK_OFFSET+height, MASK_OFFSET:MASK_OFFSET+width, :]
+            if np.array_equal(array, array.astype(np.int32)):       # semantic ids are stored as float64
+                array = array.astype(np.int32)
+        arrays[field] = np.ascontiguousarray(array)
+
+    return annotation, arrays
+
+
+def read_sdf_assets(sdf_path, cname, jid):
+    """
+    decode the gt sdf volume and its spacing info of a model
+    """
+    spacing_path = os.path.join(sdf_path, cname, jid, 'spacing_centroid.json')
+    voxels_path = os.path.join(sdf_path, cname, jid, 'voxels.npy.gz')
+    with open(spacing_path, 'r') as f:
+        spacing_dic = json.load(f)
+    with gzip.GzipFile(voxels_path, 'r') as f:
+        voxels = np.load(f)                             # [R, R, R]
+
+    return voxels, spacing_dic
+
+
+def surface_voxel_index(voxels, band=SURFACE_BAND):
+    """
+    voxel indices of the near-surface band of a gt sdf volume
+    :return [N, 3] int16, in np.argwhere order
+    """
+    return np.argwhere((voxels < band) & (voxels > -band)).astype(np.int16)
+
+
+def read_surface_index(sdf_path, cname, jid):
+    """
+    precomputed near-surface voxel indices of a model, see build_surface_index.py
+    :return [N, 3] int16, or None if not built
+    """
+    surface_path = os.path.join(sdf_path, cname, jid, SURFACE_INDEX_NAME)
+    if not os.path.exists(surface_path):
+        return None
+    return np.load(surface_path)
+
+
+def pack_split(config, mode, out_dir, images_per_shard=256, num_threads=8):
+    """
+    convert a split into uncompressed shards with a per-image index, see PackedSampleStore
+    every field of a shard is one flat binary file, arrays are appended 64-byte aligned,
+    the index keeps (offset, dtype, shape) per image since e.g. the full mask layer number varies
+    :params images_per_shard, number of images in one shard
+    :params num_threads, decoding threads (gzip and jpeg decoding release the GIL)
+    """
+    data_path = config['data']['data_path']
+    sdf_path = config['data']['sdf_path']
+    split = get_split_list(config, mode)
+
+    imgids = sorted(set(item[0] for item in split))
+    os.makedirs(out_dir, exist_ok=True)
+
+    index = {'version': PACK_VERSION, 'shards': [], 'images': {}, 'models': {}}
+
+    pool = ThreadPoolExecutor(max_workers=num_threads)
+    for shard_id, start in enumerate(range(0, len(imgids), images_per_shard)):
+        shard_imgids = imgids[start:start + images_per_shard]
+        shard_name = 'shard_%05d' % shard_id
+        shard_dir = os.path.join(out_dir, shard_name)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        writers = {}
+        for imgid, (annotation, arrays) in zip(shard_imgids, tqdm(
+                pool.map(lambda imgid: read_image_assets(data_path, imgid), shard_imgids),
+                total=len(shard_imgids), desc=f'pack {mode} {shard_name}')):
+            entries = {}
+            for field, array in arrays.items():
+                if field not in writers:
+                    writers[field] = open(os.path.join(shard_dir, field + '.bin'), 'wb')
+                entries[field] = _append_array(writers[field], array)
+
+            index['images'][imgid] = {'shard': shard_id, 'fields': entries, 'annotation': annotation}
+
+        for writer in writers.values():
+            writer.close()
+        index['shards'].append(shard_name)
+
+    # gt sdf volumes, only the models referenced by the split
+    models = {}                                 # 'cname/jid' -> (cname, jid)
+    for imgid, objid, cname in split:
+        jid = index['images'][imgid]['annotation']['obj_dict'][objid]['model_file_name'][0]
+        models[f'{cname}/{jid}'] = (cname, jid)
+
+    if config['data']['use_sdf']:
+        model_keys = sorted(models.keys())
+        with open(os.path.join(out_dir, 'sdf_voxels.bin'), 'wb') as writer, \
+                open(os.path.join(out_dir, 'sdf_surface.bin'), 'wb') as surface_writer:
+            for key, (voxels, spacing_dic) in zip(model_keys, tqdm(
+                    pool.map(lambda key: read_sdf_assets(sdf_path, *models[key]), model_keys),
+                    total=len(model_keys), desc=f'pack {mode} sdf')):
+                index['models'][key] = {'voxels': _append_array(writer, voxels), 'spacing': spacing_dic,
+                                        'surface': _append_array(surface_writer, surface_voxel_index(voxels))}
+    pool.shutdown()
+
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+def _append_array(writer, array, alignment=64):
+    """
+    append an array to a flat binary file, return its index entry
+    """
+    offset = writer.tell()
+    if offset % alignment != 0:
+        writer.write(bytes(alignment - offset % alignment))
+        offset = writer.tell()
+    array = np.ascontiguousarray(array)
+    writer.write(array.tobytes())
+    return {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+
+class PackedSampleStore(object):
+    """
+    Read-only view of a packed split. Every field of a shard is one flat binary file,
+    they are memory-mapped lazily (after DataLoader workers fork), so getting an image
+    is slicing the page cache without decompression.
+    """
+    def __init__(self, root):
+        self.root = root
+        index_path = os.path.join(root, 'index.json')
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(f'packed index {index_path} not found, run utils/DataProcess/pack_dataset.py first')
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index['version'] != PACK_VERSION:
+            raise ValueError(f'packed version {index["version"]} is not supported, please repack')
+
+        self.shards = index['shards']
+        self.images = index['images']
+        self.models = index['models']
+        self._mmaps = {}
+
+    def _open(self, name):
+        if name not in self._mmaps:
+            self._mmaps[name] = np.memmap(os.path.join(self.root, name), dtype=np.uint8, mode='r')
+        return self._mmaps[name]
+
+    def _view(self, name, entry):
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape']))
+        buffer = self._open(name)
+        return np.frombuffer(buffer, dtype=dtype, count=count, offset=entry['offset']).reshape(entry['shape'])
+
+    def has_image(self, imgid):
+        return imgid in self.images
+
+    def get_annotation(self, imgid):
+        return self.images[imgid]['annotation']
+
+    def get_image(self, imgid, fields=IMAGE_FIELDS):
+        """
+        :return dict of read-only array views, rgb is [H, W, 3] uint8
+        """
+        item = self.images[imgid]
+        shard_name = self.shards[item['shard']]
+        arrays = {}
+        for field in fields:
+            if field not in item['fields']:
+                raise KeyError(f'{field} of {imgid} is not packed')
+            arrays[field] = self._view(os.path.join(shard_name, field + '.bin'), item['fields'][field])
+        return arrays
+
+    def get_sdf(self, cname, jid):
+        """
+        :return read-only voxels view [R, R, R] and the spacing_centroid dict
+        """
+        item = self.models[f'{cname}/{jid}']
+        voxels = self._view('sdf_voxels.bin', item['voxels'])
+        return voxels, item['spacing']
+
+    def get_surface_index(self, cname, jid):
+        """
+        :return read-only near-surface voxel indices view [N, 3], or None if packed without it
+        """
+        item = self.models[f'{cname}/{jid}']
+        if 'surface' not in item:
+            return None
+        return self._view('sdf_surface.bin', item['surface'])
@@ -0,0 +1,140 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import numpy as np
+import json
+import hashlib
+import time
+from collections import OrderedDict
+
+from utils.DataProcess.packed_store import read_sdf_assets
+
+
+class SDFVolumePool(object):
+    """
+    Node-wide pool of decoded gt sdf volumes, deduplicated by model (cname, jid) and its source files
+    (path, size, mtime), so datasets or gt sdf versions sharing a pool_dir never read each other's volumes.
+    The first process that needs a model decodes voxels.npy.gz once into pool_dir (e.g. /dev/shm) as an .npy,
+    every DataLoader worker then memory-maps it, so the page cache holds one copy per node.
+    Each process also keeps an LRU of opened volumes, its hits do not touch the source files. Files of the pool are
+    evicted by last access time (mtime, refreshed at most every touch_interval seconds) when the pool is larger than max_bytes.
+    :params metrics, LoaderMetrics, count 'sdf_pool_hit', 'sdf_pool_miss', 'sdf_pool_evict', gauge 'sdf_pool_resident_bytes'
+    """
+    def __init__(self, pool_dir, sdf_path, max_bytes, max_open=256, metrics=None, touch_interval=60.0):
+        self.pool_dir = pool_dir
+        self.sdf_path = sdf_path
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        self.metrics = metrics
+        self.touch_interval = touch_interval
+        self._open = OrderedDict()          # (cname, jid) -> (voxels mmap, spacing_dic, pool voxels path)
+        self._touched = {}                  # pool voxels path -> time of the last mtime refresh
+        os.makedirs(self.pool_dir, exist_ok=True)
+        if self.metrics is not None:
+            for name in ['sdf_pool_hit', 'sdf_pool_miss', 'sdf_pool_evict']:
+                self.metrics.register(name)
+            self.metrics.register('sdf_pool_resident_bytes', gauge=True)
+        self.evict()                        # the pool may be left by a previous run with a larger cap
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.add(name)
+
+    def _paths(self, cname, jid):
+        source = os.path.realpath(os.path.join(self.sdf_path, cname, jid))
+        stats = [source]
+        for file_name in ['voxels.npy.gz', 'spacing_centroid.json']:
+            stat = os.stat(os.path.join(source, file_name))
+            stats.append(f'{file_name}:{stat.st_size}:{stat.st_mtime_ns}')
+        digest = hashlib.sha1('|'.join(stats).encode()).hexdigest()[:16]
+        name = os.path.join(self.pool_dir, f'{cname}__{jid}__{digest}')
+        return name + '.npy', name + '.json'
+
+    def _decode(self, cname, jid, voxels_path, spacing_path):
+        """
+        decode a model into the pool, the files are renamed into place so other processes never see partial files
+        """
+        voxels, spacing_dic = read_sdf_assets(self.sdf_path, cname, jid)
+
+        tmp_suffix = f'.tmp{os.getpid()}'
+        with open(spacing_path + tmp_suffix, 'w') as f:
+            json.dump(spacing_dic, f)
+        with open(voxels_path + tmp_suffix, 'wb') as f:
+            np.save(f, voxels)
+        os.replace(spacing_path + tmp_suffix, spacing_path)
+        os.replace(voxels_path + tmp_suffix, voxels_path)           # voxels last, its existence marks a complete model
+
+        self.evict()
+
+    def get(self, cname, jid):
+        """
+        :return read-only voxels [R, R, R] (memory map), spacing_centroid dict
+        """
+        key = (cname, jid)
+        if key in self._open:
+            self._open.move_to_end(key)
+            self._count('sdf_pool_hit')
+            voxels, spacing_dic, voxels_path = self._open[key]
+            self._touch(voxels_path)
+            return voxels, spacing_dic
+
+        voxels_path, spacing_path = self._paths(cname, jid)
+
+        if os.path.exists(voxels_path):
+            self._count('sdf_pool_hit')
+            self._touch(voxels_path)
+        else:
+            self._count('sdf_pool_miss')
+            self._decode(cname, jid, voxels_path, spacing_path)
+
+        try:
+            with open(spacing_path, 'r') as f:
+                spacing_dic = json.load(f)
+            voxels = np.load(voxels_path, mmap_mode='r')
+        except FileNotFoundError:           # evicted by another process in between
+            voxels, spacing_dic = read_sdf_assets(self.sdf_path, cname, jid)
+
+        self._open[key] = (voxels, spacing_dic, voxels_path)
+        if len(self._open) > self.max_open:
+            _, _, closed_path = self._open.popitem(last=False)[1]
+            self._touched.pop(closed_path, None)
+        return voxels, spacing_dic
+
+    def _touch(self, path):
+        now = time.time()
+        if now - self._touched.get(path, -float('inf')) < self.touch_interval:
+            return
+        self._touched[path] = now
+        try:
+            os.utime(path)                  # mtime is the last access time used by evict
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """
+        remove the least recently used models until the pool fits max_bytes,
+        processes that still map an evicted file keep a valid mapping until they close it
+        """
+        entries = []
+        for entry in os.scandir(self.pool_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                os.remove(path[:-len('.npy')] + '.json')
+            except FileNotFoundError:
+                continue
+            total -= size
+            self._count('sdf_pool_evict')
+
+        if self.metrics is not None:
+            self.metrics.set('sdf_pool_resident_bytes', total)
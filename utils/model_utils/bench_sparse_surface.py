@@ -0,0 +1,99 @@
+import os, sys
+sys.path.append(os.getcwd())
+
+import argparse
+import json
+import resource
+import subprocess
+import time
+import yaml
+import numpy as np
+import torch
+import trimesh
+
+from utils.model_utils.plots import dense_surface_meshes
+from utils.model_utils.sparse_surface import sparse_surface_meshes
+
+
+def parse_args():
+    '''PARAMETERS'''
+    parser = argparse.ArgumentParser('points evaluated, peak memory and time of the dense and sparse mesh extraction')
+    parser.add_argument('--config', type=str, default='train.yaml', help='configure file for training or testing.')
+    parser.add_argument('--resolution', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--sdf', type=str, default='analytic', help='analytic (sphere + box) or network (geometric init implicit network).')
+    parser.add_argument('--threads', type=int, default=None, help='torch cpu threads.')
+    parser.add_argument('--cpu', action='store_true')
+    parser.add_argument('--run', type=str, default=None, help='internal, one extractor,resolution run in this process.')
+    return parser.parse_args()
+
+
+def make_sdf(args, device):
+    """
+    sdf of [N, 3] cube coords points
+    """
+    if args.sdf == 'analytic':
+        def sdf(points):
+            sphere = points.norm(dim=-1) - 0.6
+            q = (points - torch.tensor([0., -0.5, 0.], device=points.device)).abs() - torch.tensor([0.8, 0.15, 0.8], device=points.device)
+            box = q.clamp(min=0).norm(dim=-1) + q.max(dim=-1)[0].clamp(max=0)
+            return torch.minimum(sphere, box)
+        return sdf
+
+    from decode.bench_implicit_network import make_network
+    with open(args.config, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    torch.manual_seed(0)
+    network = make_network(config, factorized=True).to(device).eval()
+    latent_feature, cat_feature = torch.randn(1, 256, device=device), torch.randn(1, 265, device=device)
+
+    def sdf(points):
+        return torch.cat([network(pnts, latent_feature, cat_feature)[:, 0] for pnts in torch.split(points, 100000)])
+    return sdf
+
+
+def run(args, extractor, resolution, device):
+    sdf = make_sdf(args, device)
+    delta = 0.03
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    with torch.no_grad():
+        if extractor == 'sparse':
+            grid_min = torch.full((3,), -1.0 - delta, device=device)
+            grid_max = torch.full((3,), 1.0 + delta, device=device)
+            crops, num_evaluated = sparse_surface_meshes(sdf, grid_min, grid_max, resolution)
+            num_evaluated = sum(num_evaluated)
+        else:
+            crops, num_evaluated = dense_surface_meshes(sdf, resolution, delta, device=device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    mesh = trimesh.util.concatenate([trimesh.Trimesh(verts, faces, process=False) for verts, faces, normals in crops])
+    with torch.no_grad():
+        surface_error = sdf(torch.from_numpy(mesh.vertices).float().to(device)).abs().mean().item()
+    peak = torch.cuda.max_memory_allocated() if device.type == 'cuda' else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {'points': int(num_evaluated), 'time': elapsed, 'peak_mb': peak / 2 ** 20, 'faces': len(mesh.faces),
+            'area': float(mesh.area), 'surface_error': surface_error}
+
+
+if __name__=="__main__":
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+
+    if args.run is not None:
+        extractor, resolution = args.run.split(',')
+        print(json.dumps(run(args, extractor, int(resolution), device)))
+        sys.exit(0)
+
+    # every run in its own process, the cpu peak memory is the max rss of the process
+    for resolution in args.resolution:
+        for extractor in ['dense', 'sparse']:
+            if extractor == 'dense' and resolution % 256 != 0:
+                continue
+            command = [sys.executable] + sys.argv + ['--run', f'{extractor},{resolution}']
+            result = json.loads(subprocess.check_output(command).decode().strip().split('\n')[-1])
+            print(f'{extractor} {resolution}: {result["points"]} points, {result["time"]:.2f} s, peak {result["peak_mb"]:.0f} MB, '
+                  f'{result["faces"]} faces, area {result["area"]:.4f}, mean |sdf| of the vertices {result["surface_error"]:.2e}')
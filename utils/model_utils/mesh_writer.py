@@ -0,0 +1,240 @@
+import os
+import json
+import shutil
+import struct
+
+import numpy as np
+import torch
+
+""" Streaming binary mesh writers: the vertices are written chunk by chunk as they come off the device, the vertex and
+face counts are known up front, so no full-size host copy of the mesh is made. The files are written to <path>.part and
+renamed on close, a failed export leaves no mesh the resume check of inference.py takes as done. """
+
+PLY_VERTEX = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+PLY_COLOR_VERTEX = np.dtype(PLY_VERTEX.descr + [('red', 'u1'), ('green', 'u1'), ('blue', 'u1'), ('alpha', 'u1')])
+PLY_FACE = np.dtype([('count', 'u1'), ('index', '<i4', (3,))])
+
+GLB_MAGIC, GLB_JSON, GLB_BIN = 0x46546C67, 0x4E4F534A, 0x004E4942
+# widest json float, the json chunk is reserved with it and rewritten with the bounds on close
+FLOAT_PLACEHOLDER = -1.7976931348623157e+308
+
+
+def to_rgba8(rgb):
+    """
+    [N, 3] colours in [0, 1] (torch, any device) -> [N, 4] uint8 rgba, the trimesh vertex_colors conversion, on the device
+    """
+    rgb = torch.nan_to_num(rgb.detach().float(), nan=0.0, posinf=0.0, neginf=0.0)
+    rgb = (rgb * 255.0).clamp(0.0, 255.0).round().to(torch.uint8)
+    return torch.cat([rgb, torch.full_like(rgb[:, :1], 255)], dim=1)
+
+
+def write_mesh(mesh, path):
+    """
+    export the trimesh mesh (or copy the mesh file at the path mesh) to <path>.part and rename it to path, like MeshStream
+    """
+    try:
+        if isinstance(mesh, str):
+            shutil.copyfile(mesh, path + '.part')
+        else:
+            mesh.export(path + '.part', file_type=os.path.splitext(path)[1][1:])
+        os.replace(path + '.part', path)
+    except BaseException:
+        if os.path.exists(path + '.part'):
+            os.remove(path + '.part')
+        raise
+
+
+class MeshStream(object):
+    """
+    <path>.part of a streamed mesh, renamed to path by finish, removed by abort
+    """
+    def open(self, path):
+        self.path = path
+        self.file = open(path + '.part', 'wb')
+
+    def finish(self):
+        assert self.written == self.num_vertices, f'{self.written} of {self.num_vertices} vertices written'
+        self.file.close()
+        os.replace(self.path + '.part', self.path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.path + '.part')
+        except FileNotFoundError:
+            pass
+
+
+class PLYStream(MeshStream):
+    """
+    binary little endian ply (the trimesh export layout): write_vertices chunks, then write_faces chunks
+    """
+    def __init__(self, path, num_vertices, num_faces, color=False):
+        self.num_vertices = num_vertices
+        self.num_faces = num_faces
+        self.color = color
+        self.written = 0
+        self.open(path)
+        properties = ['property float x', 'property float y', 'property float z']
+        if color:
+            properties += ['property uchar red', 'property uchar green', 'property uchar blue', 'property uchar alpha']
+        header = ['ply', 'format binary_little_endian 1.0', f'element vertex {num_vertices}'] + properties + \
+                 [f'element face {num_faces}', 'property list uchar int vertex_indices', 'end_header']
+        self.file.write(('\n'.join(header) + '\n').encode('ascii'))
+
+    def write_vertices(self, verts, colors=None):
+        """
+        :params verts, [n, 3] float numpy, colors [n, 4] uint8 numpy (color stream only)
+        """
+        vertex = np.empty(verts.shape[0], dtype=PLY_COLOR_VERTEX if self.color else PLY_VERTEX)
+        vertex['x'], vertex['y'], vertex['z'] = verts[:, 0], verts[:, 1], verts[:, 2]
+        if self.color:
+            vertex['red'], vertex['green'], vertex['blue'], vertex['alpha'] = colors.T
+        self.file.write(vertex.tobytes())
+        self.written += verts.shape[0]
+
+    def write_faces(self, faces):
+        """
+        :params faces, [m, 3] int numpy
+        """
+        face = np.empty(faces.shape[0], dtype=PLY_FACE)
+        face['count'] = 3
+        face['index'] = faces
+        self.file.write(face.tobytes())
+
+    def close(self):
+        self.finish()
+
+
+class GLBStream(MeshStream):
+    """
+    binary gltf 2.0, one triangle mesh: the json chunk (its size is reserved) | positions | rgba8 colours | uint32 indices,
+    every block has a known offset, so a vertex chunk is written at its place in the positions and colours,
+    the position bounds the json needs are rewritten on close
+    """
+    def __init__(self, path, num_vertices, num_faces, color=False):
+        self.num_vertices = num_vertices
+        self.num_faces = num_faces
+        self.color = color
+        self.written = 0
+        self.bounds_min = np.full(3, np.inf)
+        self.bounds_max = np.full(3, -np.inf)
+
+        self.position_bytes = num_vertices * 12
+        self.color_bytes = num_vertices * 4 if color else 0
+        self.index_bytes = num_faces * 12
+        self.bin_bytes = self.position_bytes + self.color_bytes + self.index_bytes
+        self.json_bytes = len(self.json_chunk([FLOAT_PLACEHOLDER] * 3, [FLOAT_PLACEHOLDER] * 3))
+
+        self.open(path)
+        self.file.write(b'\0' * (12 + 8 + self.json_bytes))                    # header and json chunk, written on close
+        self.file.write(struct.pack('<II', self.bin_bytes, GLB_BIN))
+        self.bin_offset = self.file.tell()
+        self.faces_written = 0
+
+    def json_chunk(self, bounds_min, bounds_max):
+        views = [{'buffer': 0, 'byteOffset': 0, 'byteLength': self.position_bytes, 'target': 34962}]
+        accessors = [{'bufferView': 0, 'componentType': 5126, 'count': self.num_vertices, 'type': 'VEC3',
+                      'min': [float(value) for value in bounds_min], 'max': [float(value) for value in bounds_max]}]
+        attributes = {'POSITION': 0}
+        if self.color:
+            views.append({'buffer': 0, 'byteOffset': self.position_bytes, 'byteLength': self.color_bytes, 'target': 34962})
+            accessors.append({'bufferView': 1, 'componentType': 5121, 'normalized': True, 'count': self.num_vertices, 'type': 'VEC4'})
+            attributes['COLOR_0'] = 1
+        views.append({'buffer': 0, 'byteOffset': self.position_bytes + self.color_bytes, 'byteLength': self.index_bytes, 'target': 34963})
+        accessors.append({'bufferView': len(views) - 1, 'componentType': 5125, 'count': self.num_faces * 3, 'type': 'SCALAR'})
+        gltf = {
+            'asset': {'version': '2.0'},
+            'scene': 0, 'scenes': [{'nodes': [0]}], 'nodes': [{'mesh': 0}],
+            'meshes': [{'primitives': [{'attributes': attributes, 'indices': len(accessors) - 1, 'mode': 4}]}],
+            'buffers': [{'byteLength': self.bin_bytes}], 'bufferViews': views, 'accessors': accessors,
+        }
+        chunk = json.dumps(gltf, separators=(',', ':')).encode('ascii')
+        return chunk + b' ' * (-len(chunk) % 4)                                 # chunks are 4 byte aligned, space padded
+
+    def write_vertices(self, verts, colors=None):
+        verts = np.ascontiguousarray(verts, dtype='<f4')
+        if verts.shape[0] > 0:
+            self.bounds_min = np.minimum(self.bounds_min, verts.min(axis=0))
+            self.bounds_max = np.maximum(self.bounds_max, verts.max(axis=0))
+        self.file.seek(self.bin_offset + self.written * 12)
+        self.file.write(verts.tobytes())
+        if self.color:
+            self.file.seek(self.bin_offset + self.position_bytes + self.written * 4)
+            self.file.write(np.ascontiguousarray(colors, dtype='u1').tobytes())
+        self.written += verts.shape[0]
+
+    def write_faces(self, faces):
+        self.file.seek(self.bin_offset + self.position_bytes + self.color_bytes + self.faces_written * 12)
+        self.file.write(np.ascontiguousarray(faces, dtype='<u4').tobytes())
+        self.faces_written += faces.shape[0]
+
+    def close(self):
+        if self.num_vertices == 0:
+            self.bounds_min, self.bounds_max = np.zeros(3), np.zeros(3)
+        chunk = self.json_chunk(self.bounds_min, self.bounds_max)
+        chunk = chunk + b' ' * (self.json_bytes - len(chunk))
+        self.file.seek(0)
+        self.file.write(struct.pack('<III', GLB_MAGIC, 2, 12 + 8 + len(chunk) + 8 + self.bin_bytes))
+        self.file.write(struct.pack('<II', len(chunk), GLB_JSON))
+        self.file.write(chunk)
+        self.finish()
+
+
+MESH_STREAMS = {'ply': PLYStream, 'glb': GLBStream}
+
+
+class ColorMeshWriter(object):
+    """
+    mesh_color / mesh_none_color of Net.forward(mesh=...) from one vertex buffer: every vertex chunk (device tensors)
+    is copied to the host once and written to both files, the rgb is converted to rgba8 on the device.
+    open once the vertex / face counts are known, then write_vertices chunks, then close;
+    used as a context manager, an error before close aborts (the partial files are closed and removed)
+    """
+    def __init__(self, mesh_folder, mesh_format='ply', face_chunk=1000000):
+        self.paths = [os.path.join(mesh_folder, f'mesh_color.{mesh_format}'), os.path.join(mesh_folder, f'mesh_none_color.{mesh_format}')]
+        self.mesh_format = mesh_format
+        self.face_chunk = face_chunk
+        self.streams = []
+
+    def open(self, num_vertices, num_faces):
+        stream = MESH_STREAMS[self.mesh_format]
+        self.color_stream = stream(self.paths[0], num_vertices, num_faces, color=True)
+        self.streams.append(self.color_stream)
+        self.none_color_stream = stream(self.paths[1], num_vertices, num_faces, color=False)
+        self.streams.append(self.none_color_stream)
+
+    def write_vertices(self, verts, rgb):
+        """
+        :params verts, [n, 3] torch, rgb [n, 3] torch in [0, 1]
+        """
+        verts = verts.detach().float().cpu().numpy()
+        colors = to_rgba8(rgb).cpu().numpy()
+        self.color_stream.write_vertices(verts, colors)
+        self.none_color_stream.write_vertices(verts)
+
+    def close(self, faces):
+        """
+        :params faces, [M, 3] int numpy of the mesh
+        """
+        for stream in self.streams:
+            for start in range(0, faces.shape[0], self.face_chunk):
+                stream.write_faces(faces[start:start + self.face_chunk])
+            stream.close()
+        self.streams = []
+        return self.paths
+
+    def abort(self):
+        """
+        close and remove the partial files, the written meshes are not touched
+        """
+        for stream in self.streams:
+            stream.abort()
+        self.streams = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.abort()
+        return False
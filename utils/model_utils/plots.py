@@ -5,42 +5,143 @@ import torchvision
 import trimesh
 from PIL import Image
 
-from utils import rend_util
-from utils.sdf_util import *
+from utils.model_utils import render_utils as rend_util
+from utils.model_utils.sdf_utils import *
+from utils.model_utils.sparse_surface import sparse_narrow_band_steps, run_steps, marching_cubes_cells, cells_to_numpy
 
 
 avg_pool_3d = torch.nn.AvgPool3d(2, stride=2)
 upsample = torch.nn.Upsample(scale_factor=2, mode='nearest')
 
 
+def get_sdf_function(model, intrinsics, extrinsics, model_input, ground_truth, context=None, eval_gt=False, chunk_size=100000):
+    """
+    :params context, model.get_feature_context of model_input (after model.encoder), not used by eval_gt
+    :return evaluate, sdf of [B, N, 3] points in the cube coords of the B objects of model_input -> [B, N],
+            the predicted sdf or the gt sdf (eval_gt), in chunks of chunk_size points
+    """
+    def evaluate(points):
+        batch_size = points.shape[0]
+        z = []
+        for _, pnts in enumerate(torch.split(points, max(chunk_size // batch_size, 1), dim=1)):
+            # get model object coords
+            model_obj = pnts / model_input['none_equal_scale'].unsqueeze(1) + model_input['centroid'].unsqueeze(1)
+            scene_obj = model_obj * model_input['scene_scale'].unsqueeze(1)                                             # [B, N, 3]
+            scene_obj = scene_obj.unsqueeze(1)                                                                          # [B, 1, N, 3]
+            world_coords = obj2world(scene_obj, model_input['obj_rot'], model_input['obj_tran'])                        # [B, 1, N, 3]
+
+            if eval_gt:
+                sdf = get_sdf_gt_worldcoords(world_coords, ground_truth)
+            else:
+                latent_feature, cat_feature = rend_util.get_latent_feature(model, world_coords, intrinsics, extrinsics, model_input, context)
+                sdf = model.implicit_network(pnts.reshape(-1, 3), latent_feature, cat_feature)[:, 0]
+            z.append(sdf.reshape(batch_size, -1))
+        z = torch.cat(z, axis=1)
+        return z
+
+    return evaluate
+
+
 @torch.no_grad()
-def get_surface_sliding(path, epoch, model, img, intrinsics, extrinsics, model_input, ground_truth, resolution=512, grid_boundary=[-2.0, 2.0], return_mesh=False, delta=0, level=0, eval_gt=False, export_color_mesh=False):
-    assert resolution % 256 == 0
+def get_surface_cells(model, img, intrinsics, extrinsics, model_input, ground_truth, resolution=256, delta=0, level=0.0, eval_gt=False):
+    """
+    sparse_surface narrow band sdf of the B objects of model_input together, every level of the objects is one
+    batched evaluation (the points of an object are padded to the most of the batch by repeating its first point)
+    :return list of the B sparse_narrow_band_steps results (cells, cell_sdf, spacing, num_evaluated), grid_min
+    """
+    if not eval_gt:
+        model.encoder(img, image_index=model_input.get('image_index', None))          # img: (B, C, H, W)
+    context = model.get_feature_context(model_input) if not eval_gt else None         # object features once, every point chunk only indexes the latent
+    evaluate = get_sdf_function(model, intrinsics, extrinsics, model_input, ground_truth, context, eval_gt)
+    batch_size = model_input['obj_rot'].shape[0]
+
+    def evaluate_padded(points):
+        num_points = max(pnts.shape[0] for pnts in points)
+        if num_points == 0:
+            return [pnts[:, 0] for pnts in points]
+        padded = torch.stack([torch.cat([pnts, pnts[:1].expand(num_points - pnts.shape[0], 3)]) if pnts.shape[0] > 0 else
+                              pnts.new_zeros(num_points, 3) for pnts in points])                                  # [B, N, 3]
+        sdf = evaluate(padded)
+        return [sdf[b, :pnts.shape[0]] for b, pnts in enumerate(points)]
+
+    grid_min = torch.full((3,), -1.0 - delta, dtype=torch.float32, device=img.device)
+    grid_max = torch.full((3,), 1.0 + delta, dtype=torch.float32, device=img.device)
+    steps = [sparse_narrow_band_steps(grid_min, grid_max, resolution, level=level) for _ in range(batch_size)]
+    return run_steps(steps, evaluate_padded), grid_min
+
+
+@torch.no_grad()
+def get_surface_sliding(path, epoch, model, img, intrinsics, extrinsics, model_input, ground_truth, resolution=512, grid_boundary=[-2.0, 2.0], return_mesh=False, delta=0, level=0, eval_gt=False, export_color_mesh=False, extractor='sparse'):
+    """
+    :params extractor, 'sparse' narrow band extraction of sparse_surface (any resolution) or 'dense' crop pyramid (resolution multiple of 256)
+    """
+    level = 0.0
+
+    # for evaluation, align InstPIFu size
+    bbox_scale_value = 2.0 / (2.0 - ground_truth['voxel_padding'][0])
+
+    # grid_min = grid_boundary.min(dim=1)[0]          # .min -> (values, indices)   .min[0] -> values
+    # grid_max = grid_boundary.max(dim=1)[0]
+    if extractor == 'sparse':
+        results, grid_min = get_surface_cells(model, img, intrinsics, extrinsics, model_input, ground_truth,
+                                              resolution=resolution, delta=delta, level=level, eval_gt=eval_gt)
+        cells, cell_sdf, spacing, _ = results[0]
+        crops = marching_cubes_cells(*cells_to_numpy(cells, cell_sdf, grid_min, spacing), level=level)
+    else:
+        context = None
+        if not eval_gt:
+            model.encoder(img, image_index=model_input.get('image_index', None))          # img: (B, C, H, W)
+            context = model.get_feature_context(model_input)          # object features once, every point chunk only indexes the latent
+        evaluate = get_sdf_function(model, intrinsics, extrinsics, model_input, ground_truth, context, eval_gt)
+        crops, _ = dense_surface_meshes(lambda points: evaluate(points[None])[0], resolution, delta, level=level, device=img.device)
+
+    # for evaluation
+    combined = crops_to_mesh(crops, None if export_color_mesh else bbox_scale_value.detach().cpu().numpy())
+
+    if return_mesh:
+        return combined
+    else:
+        combined.export('{0}/surface_{1}.ply'.format(path, epoch), 'ply')    
+
+
+def crops_to_mesh(crops, scale=None):
+    """
+    :params crops, list of (verts, faces, normals) in cube coords
+    :params scale, verts scale (for evaluation, align InstPIFu size), None keeps the cube coords
+    """
+    meshes = []
+    for verts, faces, normals in crops:
+        if scale is not None:
+            verts = verts * scale
+
+        meshcrop = trimesh.Trimesh(verts, faces, normals)
 
-    model.encoder(img)                           # img: (B, C, H, W)
-    image_shape = torch.empty(2).cuda()          # (W, H)
-    image_shape[0] = img.shape[-1]               # W
-    image_shape[1] = img.shape[-2]               # H
+        #meshcrop.export(f"{i}_{j}_{k}.ply")
+        meshes.append(meshcrop)
 
-    batch_size = img.shape[0]
+    return trimesh.util.concatenate(meshes)
+
+
+def dense_surface_meshes(evaluate, resolution, delta, level=0.0, device='cpu'):
+    """
+    marching cubes of dense cropN^3 crops of [-1-delta, 1+delta]^3, the sdf of each crop is refined by an avg pool point pyramid
+    :params evaluate, sdf of [N, 3] points -> [N]
+    :return list of (verts, faces, normals) in cube coords, number of points evaluated
+    """
+    assert resolution % 256 == 0
 
     resN = resolution
     cropN = 256
-    level = 0.0
     N = resN // cropN
 
-    # grid_min = grid_boundary.min(dim=1)[0]          # .min -> (values, indices)   .min[0] -> values
-    # grid_max = grid_boundary.max(dim=1)[0]
     grid_min = np.array([-1, -1, -1])
     grid_max = np.array([1, 1, 1])
     xs = np.linspace(grid_min[0]-delta, grid_max[0]+delta, N+1)
     ys = np.linspace(grid_min[1]-delta, grid_max[1]+delta, N+1)
     zs = np.linspace(grid_min[2]-delta, grid_max[2]+delta, N+1)
 
-    # for evaluation, align InstPIFu size
-    bbox_scale_value = 2.0 / (2.0 - ground_truth['voxel_padding'][0])
-
     meshes = []
+    num_evaluated = 0
     for i in range(N):
         for j in range(N):
             for k in range(N):
@@ -54,34 +155,7 @@ def get_surface_sliding(path, epoch, model, img, intrinsics, extrinsics, model_i
                 z = np.linspace(z_min, z_max, cropN)
 
                 xx, yy, zz = np.meshgrid(x, y, z, indexing='ij')
-                points = torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float).cuda().to(torch.float32)          # in cube coords
-
-                def evaluate(points):
-                    z = []
-                    for _, pnts in enumerate(torch.split(points, 100000, dim=0)):
-                        # get model object coords
-                        model_obj = pnts / model_input['none_equal_scale'] + model_input['centroid']
-                        scene_obj = model_obj * model_input['scene_scale']                                                          # [N, 3]
-                        scene_obj = scene_obj[None, None, ...]                                                                      # [1, 1, N, 3]
-                        world_coords = obj2world(scene_obj, model_input['obj_rot'], model_input['obj_tran'])                        # [1, 1, N, 3]
-
-                        latent_feature, cat_feature = rend_util.get_latent_feature(model, world_coords.reshape(-1, 3), intrinsics, extrinsics, model_input)
-
-                        sdf = model.implicit_network(pnts, latent_feature, cat_feature)[:, 0]
-                        z.append(sdf)
-                    z = torch.cat(z, axis=0)
-                    return z
-
-                def evaluate_gt(points, ground_truth):
-                    model_obj = points / model_input['none_equal_scale'] + model_input['centroid']
-                    scene_obj = model_obj * model_input['scene_scale']                                                          # [N, 3]
-                    scene_obj = scene_obj[None, None, ...]                                                                      # [1, 1, N, 3]
-                    world_coords = obj2world(scene_obj, model_input['obj_rot'], model_input['obj_tran'])                        # [1, 1, N, 3]
-
-                    sdf_gt = get_sdf_gt_worldcoords(world_coords, ground_truth)
-
-                    z = sdf_gt.squeeze(1)
-                    return z
+                points = torch.tensor(np.vstack([xx.ravel(), yy.ravel(), zz.ravel()]).T, dtype=torch.float32, device=device)          # in cube coords
 
                 # construct point pyramids
                 points = points.reshape(cropN, cropN, cropN, 3).permute(3, 0, 1, 2)
@@ -99,20 +173,16 @@ def get_surface_sliding(path, epoch, model, img, intrinsics, extrinsics, model_i
                     pts = pts.reshape(3, -1).permute(1, 0).contiguous()
 
                     if mask is None:
-                        if eval_gt:
-                            pts_sdf = evaluate_gt(pts, ground_truth)
-                        else:
-                            pts_sdf = evaluate(pts)
+                        pts_sdf = evaluate(pts)
+                        num_evaluated += pts.shape[0]
                     else:
                         mask = mask.reshape(-1)
                         pts_to_eval = pts[mask]
                         #import pdb; pdb.set_trace()
                         if pts_to_eval.shape[0] > 0:
-                            if eval_gt:
-                                pts_sdf_eval = evaluate_gt(pts_to_eval.contiguous(), ground_truth)
-                            else:
-                                pts_sdf_eval = evaluate(pts_to_eval.contiguous())
+                            pts_sdf_eval = evaluate(pts_to_eval.contiguous())
                             pts_sdf[mask] = pts_sdf_eval
+                            num_evaluated += pts_to_eval.shape[0]
                         # print("ratio", pts_to_eval.shape[0] / pts.shape[0])
 
                     if pid < 3:
@@ -144,22 +214,9 @@ def get_surface_sliding(path, epoch, model, img, intrinsics, extrinsics, model_i
                     # print(np.array([x_min, y_min, z_min]))
                     # print(verts.min(), verts.max())
                     verts = verts + np.array([x_min, y_min, z_min])     # in cube coords
+                    meshes.append((verts, faces, normals))
 
-                    if not export_color_mesh:
-                        # for evaluation
-                        verts = verts * bbox_scale_value.detach().cpu().numpy()
-
-                    meshcrop = trimesh.Trimesh(verts, faces, normals)
-
-                    #meshcrop.export(f"{i}_{j}_{k}.ply")
-                    meshes.append(meshcrop)
-
-    combined = trimesh.util.concatenate(meshes)
-
-    if return_mesh:
-        return combined
-    else:
-        combined.export('{0}/surface_{1}.ply'.format(path, epoch), 'ply')    
+    return meshes, num_evaluated
 
 
 def plot_normal_maps(normal_maps, ground_true, path, epoch, img_res, indices, ray_mask):
@@ -176,8 +233,6 @@ def plot_normal_maps(normal_maps, ground_true, path, epoch, img_res, indices, ra
     ray_mask_map = ray_mask_map.convert('L')
     normal_maps.putalpha(ray_mask_map)
 
-    ground_true = ground_true.cuda()            # [B, N, 3]
-
     normal_maps_plot = lin2img(ground_true, img_res)
 
     tensor = torchvision.utils.make_grid(normal_maps_plot,
@@ -206,7 +261,6 @@ def plot_images(rgb_points, ground_true, path, epoch, img_res, indices, exposure
     rgb_map.putalpha(ray_mask_map)
 
 
-    ground_true = ground_true.cuda()
     ground_true = lin2img(ground_true, img_res)
 
     tensor = torchvision.utils.make_grid(ground_true,
@@ -263,7 +317,7 @@ def split_input(model_input, total_pixels, n_pixels=10000):
      Can decrease the value of n_pixels in case of cuda out of memory error.
      '''
     split = []
-    for i, indx in enumerate(torch.split(torch.arange(total_pixels).cuda(), n_pixels, dim=0)):
+    for i, indx in enumerate(torch.split(torch.arange(total_pixels, device=model_input['uv'].device), n_pixels, dim=0)):
         data = model_input.copy()
         data['uv'] = torch.index_select(model_input['uv'], 1, indx)
         if 'object_mask' in data:
@@ -4,7 +4,7 @@ import skimage
 import torch
 from torch.nn import functional as F
 
-from utils.model_utils import sdf_utils
+from utils.model_utils import sdf_utils as sdf_util
 
 
 def get_psnr(img1, img2, normalize_rgb=False):
@@ -13,7 +13,7 @@ def get_psnr(img1, img2, normalize_rgb=False):
         img2 = (img2 + 1. ) / 2.
 
     mse = torch.mean((img1 - img2) ** 2)
-    psnr = -10. * torch.log(mse) / torch.log(torch.Tensor([10.]).cuda())
+    psnr = -10. * torch.log(mse) / np.log(10.)
 
     return psnr
 
@@ -35,10 +35,10 @@ def get_camera_params_cam(uv, intrinsics, get_obj_dirs=False, model_input=None):
     """
     batch_size, num_samples, _ = uv.shape
 
-    cam_loc = torch.tensor([0, 0, 0]).cuda().float()                        # cam is the origin point
+    cam_loc = torch.zeros(3, device=uv.device)                              # cam is the origin point
     cam_loc = torch.repeat_interleave(cam_loc.unsqueeze(0), batch_size, dim=0)
 
-    depth = torch.ones((batch_size, num_samples)).cuda()
+    depth = torch.ones((batch_size, num_samples), device=uv.device)
     x_cam = uv[:, :, 0].view(batch_size, -1)
     y_cam = uv[:, :, 1].view(batch_size, -1)
     z_cam = depth.view(batch_size, -1)
@@ -97,7 +97,7 @@ def get_camera_params_world(uv, pose, intrinsics):
 
     batch_size, num_samples, _ = uv.shape
 
-    depth = torch.ones((batch_size, num_samples)).cuda()
+    depth = torch.ones((batch_size, num_samples), device=uv.device)
     x_cam = uv[:, :, 0].view(batch_size, -1)
     y_cam = uv[:, :, 1].view(batch_size, -1)
     z_cam = depth.view(batch_size, -1)
@@ -119,7 +119,7 @@ def get_camera_params_world(uv, pose, intrinsics):
 
 def lift(x, y, z, intrinsics):
     # parse intrinsics
-    intrinsics = intrinsics.cuda()
+    intrinsics = intrinsics.to(x.device)
     fx = intrinsics[:, 0, 0]
     fy = intrinsics[:, 1, 1]
     cx = intrinsics[:, 0, 2]
@@ -130,7 +130,7 @@ def lift(x, y, z, intrinsics):
     y_lift = (y - cy.unsqueeze(-1)) / fy.unsqueeze(-1) * z
 
     # homogeneous
-    return torch.stack((x_lift, y_lift, z, torch.ones_like(z).cuda()), dim=-1)
+    return torch.stack((x_lift, y_lift, z, torch.ones_like(z)), dim=-1)
 
 
 def camera_to_world(points_cam, pose):
@@ -140,7 +140,7 @@ def camera_to_world(points_cam, pose):
     :params pose, [B, 4, 4]
     """
     B, N, M, _ = points_cam.shape
-    ones = torch.ones((B, N, M)).cuda()          # homogeneous
+    ones = torch.ones((B, N, M), device=points_cam.device, dtype=points_cam.dtype)          # homogeneous
     x_cam = points_cam[:, :, :, 0]
     y_cam = points_cam[:, :, :, 1]
     z_cam = points_cam[:, :, :, 2]
@@ -196,10 +196,12 @@ def camera_coords_transfer(points):
     return points_cam
 
 
-def get_latent_feature(model, pnts, intrinsics, extrinsics, input):
-    
+def get_latent_feature(model, pnts, intrinsics, extrinsics, input, context=None):
+    """
+    :params context, model.get_feature_context of input, the object features are reused instead of recomputed
+    """
     uv_align, z_vals_pnts = get_uv_world(pnts, intrinsics, extrinsics)
-    latent_feature, cat_feature = model.get_feature(input, uv_align, z_vals_pnts)
+    latent_feature, cat_feature = model.get_feature(input, uv_align, z_vals_pnts, context)
     return latent_feature, cat_feature
 
 
@@ -247,6 +249,7 @@ def rot_angle(rot, axis, angle):
     cos = np.cos(angle)
     sin = np.sin(angle)
 
+    device = rot.device
     rot = rot.cpu().numpy()
 
     if axis == 'x':
@@ -272,7 +275,7 @@ def rot_angle(rot, axis, angle):
 
     rot_new = rot @ rot_max             # rotation local coordinate, right multiply
 
-    return torch.from_numpy(rot_new).cuda()
+    return torch.from_numpy(rot_new).to(device)
 
 
 def compose_matrix(rot, trans):
@@ -280,11 +283,11 @@ def compose_matrix(rot, trans):
     :params rot, [3, 3]
     :params trans, [3, 1]
     """
-    M = torch.eye(4)
+    M = torch.eye(4, device=rot.device)
     M[:3, :3] = rot
     M[:3, 3] = trans
 
-    return M.cuda()
+    return M
 
 
 def rot_camera_pose(pose, obj_bdb_3d_camera, angle, axis='y'):
@@ -295,8 +298,8 @@ def rot_camera_pose(pose, obj_bdb_3d_camera, angle, axis='y'):
     :params axis, 'x, y, z', rot axis, NOTE: rot in camera coords, y is up
     """
     obj_to_cam_trans = torch.mean(obj_bdb_3d_camera, dim=1)
-    obj_to_cam = compose_matrix(torch.eye(3), obj_to_cam_trans)
-    obj2_to_obj = compose_matrix(rot_angle(torch.eye(3), axis, angle), torch.tensor([0, 0, 0]))
+    obj_to_cam = compose_matrix(torch.eye(3, device=pose.device), obj_to_cam_trans)
+    obj2_to_obj = compose_matrix(rot_angle(torch.eye(3, device=pose.device), axis, angle), torch.tensor([0, 0, 0]))
     new_pose = pose @ obj_to_cam @ obj2_to_obj @ torch.inverse(obj_to_cam)
 
     return new_pose
@@ -311,10 +314,10 @@ def trans_camera_pose(pose, x_dist, y_dist, z_dist):
     rot = pose[:3, :3]
     trans = pose[:3, 3]
 
-    dist = torch.tensor([x_dist, y_dist, z_dist], dtype=torch.float32).cuda()
+    dist = torch.tensor([x_dist, y_dist, z_dist], dtype=torch.float32, device=pose.device)
     new_trans = trans + dist
 
-    new_pose = torch.eye(4, dtype=torch.float32).cuda()
+    new_pose = torch.eye(4, dtype=torch.float32, device=pose.device)
     new_pose[:3, :3] = rot
     new_pose[:3, 3] = new_trans
 
@@ -3,7 +3,7 @@ import torch
 import numpy as np
 import torch.nn.functional as F
 
-from utils.model_utils import render_utils
+from utils.model_utils import render_utils as rend_util
 
 
 def obj_coordinate2voxel_index(obj_coordinate, centroid, voxel_range, spacing, none_equal_scale):
@@ -200,13 +200,14 @@ def get_sdf_gt_objcoords(points, ground_truth):
     :params points, [B, Num_pixels, Num_points_a_ray, 3], points in object coords
     :params ground_truth, list of gt
     """
-    voxel_sdf_gt = ground_truth['voxel_sdf'].cuda()             # (B, 1, R, R, R)
-    voxel_resolution = voxel_sdf_gt.shape[-1]                   # R: voxel_resolution
-    centroid = ground_truth['centroid'].cuda()                  # (B, 3)
-    voxel_range = ground_truth['voxel_range'].cuda()            # (B, 3)
-    spacing = ground_truth['voxel_spacing'].cuda()              # (B, 3)
-    none_equal_scale = ground_truth['none_equal_scale'].cuda()  # (B, 3)
-    scene_scale = ground_truth['scene_scale'].cuda()            # (B, 3)
+    device = points.device
+    voxel_sdf_gt = ground_truth['voxel_sdf'].to(device)             # (B, 1, R, R, R)
+    voxel_resolution = voxel_sdf_gt.shape[-1]                       # R: voxel_resolution
+    centroid = ground_truth['centroid'].to(device)                  # (B, 3)
+    voxel_range = ground_truth['voxel_range'].to(device)            # (B, 3)
+    spacing = ground_truth['voxel_spacing'].to(device)              # (B, 3)
+    none_equal_scale = ground_truth['none_equal_scale'].to(device)  # (B, 3)
+    scene_scale = ground_truth['scene_scale'].to(device)            # (B, 3)
 
     batch_size, num_pixels, num_points_a_ray, _ = points.shape
     # transfer to model object coords
@@ -234,7 +235,7 @@ def get_sdf_gt_worldcoords(points, ground_truth):
     if len(points.shape) == 2:                    # inference shape [N, 3]
         points = points[None, None, ...]            # [1, 1, N, 3]
 
-    world_to_obj = ground_truth['world_to_obj'].float().cuda()
+    world_to_obj = ground_truth['world_to_obj'].float().to(points.device)
     obj_coords = world2obj(points, world_to_obj)
     sdf_gt = get_sdf_gt_objcoords(obj_coords, ground_truth)
 
@@ -0,0 +1,181 @@
+import math
+
+import numpy as np
+import torch
+from skimage import measure
+
+""" Sparse narrow band mesh extraction: the sdf is refined level by level only in the cells near the surface. """
+
+# corner offsets of a cell, in the order of the [M, 8] corner tensors
+CORNERS = torch.tensor([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)], dtype=torch.int64)
+
+
+def coarsest_stride(resolution, coarse_cells=32):
+    """
+    power of two stride (in fine cells) of the coarsest level, so that it has about coarse_cells cells per axis
+    """
+    return 2 ** max(0, math.ceil(math.log2(max(resolution - 1, 1) / coarse_cells)))
+
+
+def lookup(keys, values, query):
+    """
+    :params keys, [K] sorted int64, values [K]
+    :params query, [Q] int64
+    :return values of query [Q] (0 if not found), found [Q] bool
+    """
+    if keys.shape[0] == 0:
+        return values.new_zeros(query.shape), torch.zeros_like(query, dtype=torch.bool)
+    pos = torch.searchsorted(keys, query).clamp(max=keys.shape[0] - 1)
+    return values[pos], keys[pos] == query
+
+
+def sparse_narrow_band_steps(grid_min, grid_max, resolution, level=0.0, band=1.0, coarse_cells=32, chunk_cells=1000000):
+    """
+    sdf of the cells of a resolution^3 vertex grid that cross the level set, without the dense grid:
+    the coarsest level (stride of coarsest_stride fine cells) is evaluated densely, then every level keeps the cells
+    whose corner sdf is within band * cell size of level (or changes sign) and splits them into 8 child cells,
+    only the 27 lattice points of a split cell not evaluated at the parent level are evaluated.
+    Vertices are int64 keys (x * P + y) * P + z of a grid padded to P = R + stride, the coarse cells of the last row
+    reach out of the box (evaluated there), the fine cells are the resolution^3 grid, so any resolution works.
+    A generator: it yields the [N, 3] points of every level (device of grid_min) and is sent their sdf [N], see run_steps
+    :params grid_min, grid_max, [3] box of the grid (cube coords)
+    :params band, in cells of the level, a cell of size h contains the surface of an exact sdf only if
+            a corner is within sqrt(3)/2 h of it
+    :params chunk_cells, cells whose corners are looked up at once
+    :return cells [M, 3] int64 min corner of the fine cells crossing level, sdf [M, 8] of their corners (CORNERS order),
+            spacing [3] of the fine grid, number of points evaluated per level (coarse to fine)
+    """
+    R = resolution
+    device = grid_min.device
+    spacing = (grid_max - grid_min) / (R - 1)
+    stride = coarsest_stride(R, coarse_cells)
+    P = R + stride
+
+    def to_index(key):
+        return torch.stack([key // (P * P), (key // P) % P, key % P], dim=-1)
+
+    def to_key(index):
+        return (index[..., 0] * P + index[..., 1]) * P + index[..., 2]
+
+    corner_offsets = to_key(CORNERS).to(device)                                                         # [8], stride 1
+    lattice_offsets = to_key(torch.stack(torch.meshgrid(*[torch.arange(3)] * 3, indexing='ij'), dim=-1).reshape(-1, 3)).to(device)
+
+    # coarsest level, dense
+    axis = torch.arange(0, R - 1 + stride, stride, device=device)
+    level_keys = to_key(torch.stack(torch.meshgrid(axis, axis, axis, indexing='ij'), dim=-1).reshape(-1, 3))
+    cells = level_keys[(to_index(level_keys) < R - 1).all(dim=1)]
+    keys, values = torch.zeros(0, dtype=torch.int64, device=device), torch.zeros(0, device=device)
+    num_evaluated = []
+
+    while True:
+        # corners of the parent level are known, the others are evaluated
+        level_values, found = lookup(keys, values, level_keys)
+        missing = torch.nonzero(~found).squeeze(1)
+        points = grid_min + to_index(level_keys[missing]).to(spacing.dtype) * spacing
+        level_values[missing] = (yield points).to(level_values.dtype)
+        num_evaluated.append(missing.shape[0])
+        keys, values = level_keys, level_values
+        del level_keys, level_values, found, missing, points
+
+        # cells crossing the level / in the narrow band
+        kept, kept_sdf = [], []
+        for chunk in torch.split(cells, chunk_cells):
+            cell_sdf = lookup(keys, values, chunk[:, None] + corner_offsets * stride)[0]               # [c, 8]
+            keep = (cell_sdf.min(dim=1)[0] <= level) & (cell_sdf.max(dim=1)[0] >= level)
+            if stride > 1:
+                keep |= (cell_sdf - level).abs().min(dim=1)[0] < band * stride * spacing.max()
+            kept.append(chunk[keep])
+            kept_sdf.append(cell_sdf[keep])
+        if stride == 1:
+            return to_index(torch.cat(kept)), torch.cat(kept_sdf), spacing, num_evaluated
+
+        active = torch.cat(kept)
+        del kept, kept_sdf, cells
+        stride //= 2
+        level_keys = torch.unique((active[:, None] + lattice_offsets * stride).reshape(-1))
+        cells = (active[:, None] + corner_offsets * stride).reshape(-1)
+        cells = cells[(to_index(cells) < R - 1).all(dim=1)]
+
+
+def run_steps(steps, evaluate):
+    """
+    run the sparse_narrow_band_steps of several objects level by level,
+    the points of a level of all the objects are evaluated by one evaluate call
+    :params evaluate, list of [N_b, 3] points -> list of [N_b] sdf
+    :return list of the sparse_narrow_band_steps results
+    """
+    results = [None] * len(steps)
+    points = {b: next(step) for b, step in enumerate(steps)}
+    while len(points) > 0:
+        objects = list(points.keys())
+        sdf = evaluate([points[b] for b in objects])
+        points = {}
+        for b, values in zip(objects, sdf):
+            try:
+                points[b] = steps[b].send(values)
+            except StopIteration as stop:
+                results[b] = stop.value
+    return results
+
+
+def sparse_narrow_band_sdf(evaluate, grid_min, grid_max, resolution, level=0.0, band=1.0, coarse_cells=32, chunk_cells=1000000):
+    """
+    sparse_narrow_band_steps of one object
+    :params evaluate, sdf of [N, 3] points (device of the points) -> [N]
+    """
+    steps = sparse_narrow_band_steps(grid_min, grid_max, resolution, level, band, coarse_cells, chunk_cells)
+    return run_steps([steps], lambda points: [evaluate(points[0]) if points[0].shape[0] > 0 else points[0][:, 0]])[0]
+
+
+def marching_cubes_cells(cells, cell_sdf, grid_min, spacing, level=0.0, block_cells=64):
+    """
+    marching cubes of the sparse cells (numpy), block by block: every block of block_cells^3 fine cells with crossing cells is
+    a small dense volume whose marching cubes mask keeps only those cells
+    :params cells, [M, 3] int64 min corner of the cells, cell_sdf [M, 8] (CORNERS order)
+    :return list of (verts, faces, normals), verts in the coords of grid_min / spacing
+    """
+    corners = CORNERS.numpy()
+    if cells.shape[0] == 0:
+        return []
+
+    blocks = cells // block_cells
+    block_keys = np.ravel_multi_index(blocks.T, blocks.max(axis=0) + 1)
+    order = np.argsort(block_keys, kind='stable')
+    splits = np.flatnonzero(np.diff(block_keys[order])) + 1
+
+    meshes = []
+    size = block_cells + 1
+    for block_cells_index in np.split(order, splits):
+        origin = blocks[block_cells_index[0]] * block_cells
+        local = cells[block_cells_index] - origin                                         # [m, 3]
+        corner_local = (local[:, None, :] + corners).reshape(-1, 3)                       # [m*8, 3]
+
+        # not crossing vertices are masked out, any value
+        volume = np.full((size, size, size), level + 1.0, dtype=np.float32)
+        volume[tuple(corner_local.T)] = cell_sdf[block_cells_index].reshape(-1)
+        # skimage marching cubes keeps the cube of a True mask at its max corner
+        mask = np.zeros((size, size, size), dtype=bool)
+        mask[tuple((local + 1).T)] = True
+
+        verts, faces, normals, values = measure.marching_cubes(volume=volume, level=level, spacing=tuple(spacing), mask=mask)
+        verts = verts + grid_min + origin * spacing
+        meshes.append((verts, faces, normals))
+    return meshes
+
+
+def cells_to_numpy(cells, cell_sdf, grid_min, spacing):
+    """
+    the sparse_narrow_band_steps results to the cpu, the marching_cubes_cells inputs
+    """
+    return cells.cpu().numpy(), cell_sdf.float().cpu().numpy(), grid_min.cpu().numpy(), spacing.cpu().numpy()
+
+
+def sparse_surface_meshes(evaluate, grid_min, grid_max, resolution, level=0.0, band=1.0, coarse_cells=32, block_cells=64):
+    """
+    :return list of (verts, faces, normals) of the level set on a resolution^3 grid of [grid_min, grid_max],
+            number of points evaluated per level
+    """
+    cells, cell_sdf, spacing, num_evaluated = sparse_narrow_band_sdf(
+        evaluate, grid_min, grid_max, resolution, level=level, band=band, coarse_cells=coarse_cells)
+    meshes = marching_cubes_cells(*cells_to_numpy(cells, cell_sdf, grid_min, spacing), level=level, block_cells=block_cells)
+    return meshes, num_evaluated